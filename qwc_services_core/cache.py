@@ -1,13 +1,157 @@
+import collections
+import datetime
+import decimal
+import heapq
+import io
+import itertools
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import threading
 import time
+import weakref
 import copy
+from collections import OrderedDict
+
+from .json_utils import (
+    RestrictedPickler, RestrictedUnpickler, env_flag, private_cache_dir
+)
+
+
+class FrozenDict(dict):
+    """Read-only dict for frozen cache values.
+
+    NOTE: copy.deepcopy() returns a mutable copy.
+    """
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("'%s' object is read-only" % type(self).__name__)
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+class FrozenList(list):
+    """Read-only list for frozen cache values.
+
+    NOTE: copy.deepcopy() returns a mutable copy.
+    """
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("'%s' object is read-only" % type(self).__name__)
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = clear = extend = insert = pop = remove = _readonly
+    reverse = sort = _readonly
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (type(self), (list(self),))
+
+
+# immutable scalar types, which are returned as is instead of copied
+IMMUTABLE_TYPES = (str, int, float, bool, type(None), bytes)
+
+
+def freeze(value):
+    """Return read-only deep copy of value.
+
+    Dicts and lists are converted to FrozenDict and FrozenList, which are
+    still dict and list instances, tuples and sets to tuples and frozensets.
+    Already frozen values are returned as is.
+
+    :param obj value: Value to freeze
+    """
+    if type(value) in IMMUTABLE_TYPES:
+        return value
+    elif isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    elif isinstance(value, dict):
+        # NOTE: skip calls for scalar values
+        return FrozenDict({
+            k: v if type(v) in IMMUTABLE_TYPES else freeze(v)
+            for k, v in value.items()
+        })
+    elif isinstance(value, list):
+        return FrozenList([
+            v if type(v) in IMMUTABLE_TYPES else freeze(v) for v in value
+        ])
+    elif isinstance(value, tuple):
+        return tuple(freeze(v) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    else:
+        return copy.deepcopy(value)
+
+
+def thaw(value):
+    """Return mutable deep copy of a (frozen) value.
+
+    :param obj value: Value to copy
+    """
+    if type(value) in IMMUTABLE_TYPES:
+        return value
+    elif isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [thaw(v) for v in value]
+    elif isinstance(value, tuple):
+        return tuple(thaw(v) for v in value)
+    elif isinstance(value, frozenset):
+        return set(value)
+    else:
+        return copy.deepcopy(value)
+
+
+def copy_value(value, frozen, mutable):
+    """Return cached value for a lookup.
+
+    :param obj value: Stored value
+    :param bool frozen: Whether value is frozen
+    :param bool mutable: Return a mutable copy of a frozen value
+    """
+    if not frozen:
+        return copy.deepcopy(value)
+    elif mutable:
+        return thaw(value)
+    else:
+        # shared read-only value
+        return value
 
 
 class ExpiringDict:
     """Dict for values where each key will expire after some time."""
 
-    def __init__(self):
-        """Constructor"""
+    def __init__(self, frozen=False):
+        """Constructor
+
+        :param bool frozen: Store read-only values and return them without
+                            copying, instead of deep copies on every set and
+                            lookup
+        """
         self.cache = {}
+        self.frozen = frozen
+        self.lock = threading.Lock()
 
     def set(self, key, value, duration=300):
         """Store value under key until expiry.
@@ -16,41 +160,1009 @@ class ExpiringDict:
         :param obj value: Value to store
         :param int duration: Time in seconds until expiry (default: 300s)
         """
-        self.cache[key] = {
-            'value': copy.deepcopy(value),
-            'expires': time.time() + duration
-        }
+        if self.frozen:
+            value = freeze(value)
+        else:
+            value = copy.deepcopy(value)
+        with self.lock:
+            self.cache[key] = {
+                'value': value,
+                'expires': time.time() + duration
+            }
 
-    def lookup(self, key):
+    def lookup(self, key, mutable=False):
         """Return dict with value or None if not present or expired.
 
         :param str key: Key for value
+        :param bool mutable: Return a mutable copy of a frozen value
 
         Returns {'value': <value>} or None
         """
-        res = None
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
 
-        if key in self.cache:
-            entry = self.cache[key]
             # check expiry
-            if time.time() < entry['expires']:
-                # return value
-                res = {'value':  copy.deepcopy(entry['value'])}
-            else:
+            if time.time() >= entry['expires']:
                 # remove expired value
                 del self.cache[key]
+                return None
+
+        # return value
+        return {'value': copy_value(entry['value'], self.frozen, mutable)}
+
+
+def approximate_size(value):
+    """Return approximate memory size of value in bytes.
+
+    Sums up sys.getsizeof of the value and all nested dict keys and values,
+    list, tuple and set items. Shared objects are only counted once.
+
+    :param obj value: Value to measure
+    """
+    size = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+
+    return size
+
+
+class CacheBackend:
+    """Base class for cache backends used by Cache.
+
+    A backend stores values under flat tuple keys until expiry.
+    """
+
+    # optional listener for removed entries as
+    #   func(<event>, <key>) with event 'expiration' or 'eviction'
+    listener = None
+
+    def notify(self, event, key):
+        """Notify listener about a removed entry.
+
+        :param str event: 'expiration' or 'eviction'
+        :param tuple key: Key of removed entry
+        """
+        if self.listener is not None:
+            self.listener(event, key)
+
+    def set(self, key, value, duration=300, stale_duration=0, tags=()):
+        """Store value under key until expiry.
+
+        :param tuple key: Key for value
+        :param obj value: Value to store
+        :param int duration: Time in seconds until expiry (default: 300s)
+        :param int stale_duration: Additional time in seconds to keep an
+                                   expired value for stale lookups
+        :param frozenset tags: Tags as (<name>, <value>) tuples for
+                               invalidation
+        """
+        raise NotImplementedError
+
+    def lookup(self, key, mutable=False, stale=False):
+        """Return dict with value or None if not present or expired.
+
+        :param tuple key: Key for value
+        :param bool mutable: Return a mutable copy of a frozen value
+        :param bool stale: Also return expired values within their stale
+                           duration, marked with 'stale': True
+
+        Returns {'value': <value>} or {'value': <value>, 'stale': True}
+        or None
+        """
+        raise NotImplementedError
+
+    def remove(self, key):
+        """Remove entry for key if present.
+
+        :param tuple key: Key for value
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all entries."""
+        raise NotImplementedError
+
+    def invalidate(self, tags):
+        """Remove all entries with all of the tags and return their number.
+
+        :param list tags: Tags as (<name>, <value>) tuples
+        """
+        raise NotImplementedError
+
+    def usage(self):
+        """Return number of entries and approximate size in bytes per
+        stats label as {(<service>, <first key>): [<entries>, <bytes>]}.
+        """
+        return {}
+
 
+def stats_label(key):
+    """Return stats label (service, first key) for a cache key.
+
+    :param tuple key: Cache key as (service, group, username, *keys)
+    """
+    return (key[0], key[3] if len(key) > 3 else None)
+
+
+class LRUCacheSegment:
+    """Bounded cache with per-entry expiry and least recently used eviction.
+
+    The cache is limited by the number of entries and the approximate memory
+    size of the stored values. Expired entries are removed proactively on
+    every access, not only when their key is looked up again.
+
+    All access is guarded by a lock per segment.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, frozen=False,
+                 notify=None):
+        """Constructor
+
+        :param int max_entries: Max number of entries (0 for unlimited)
+        :param int max_bytes: Max approximate size of all values in bytes
+                              (0 for unlimited)
+        :param bool frozen: Store read-only values and return them without
+                            copying (see ExpiringDict)
+        :param func notify: Optional callback for removed entries
+                            (see CacheBackend.notify)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.frozen = frozen
+        self.notify = notify or (lambda event, key: None)
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock:
+            # entries in LRU order as
+            #   {<key>: [<value>, <expires>, <size>, <keep until>, <tags>]}
+            self.entries = OrderedDict()
+            # keys for tags as {<tag>: {<key>}}
+            self.tag_index = {}
+            # heap of (<keep until>, <seq>, <key>) for proactive expiry
+            self.expiry_queue = []
+            self.seq = itertools.count()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set(self, key, value, duration=300, stale_duration=0, tags=()):
+        """Store value under key until expiry.
+
+        :param tuple key: Key for value
+        :param obj value: Value to store
+        :param int duration: Time in seconds until expiry (default: 300s)
+        :param int stale_duration: Additional time in seconds to keep an
+                                   expired value for stale lookups
+        :param frozenset tags: Tags as (<name>, <value>) tuples for
+                               invalidation
+        """
+        if self.frozen:
+            value = freeze(value)
+        else:
+            value = copy.deepcopy(value)
+        size = approximate_size(value)
+        expires = time.time() + duration
+        keep_until = expires + stale_duration
+
+        with self.lock:
+            self.remove(key)
+            if self.max_bytes and size > self.max_bytes:
+                # skip values larger than the whole cache
+                return
+
+            self.entries[key] = [value, expires, size, keep_until, tags]
+            self.total_bytes += size
+            for tag in tags:
+                self.tag_index.setdefault(tag, set()).add(key)
+            heapq.heappush(
+                self.expiry_queue, (keep_until, next(self.seq), key)
+            )
+
+            self.purge_expired()
+            self.evict()
+
+    def lookup(self, key, mutable=False, stale=False):
+        """Return dict with value or None if not present or expired.
+
+        :param tuple key: Key for value
+        :param bool mutable: Return a mutable copy of a frozen value
+        :param bool stale: Also return expired values within their stale
+                           duration, marked with 'stale': True
+
+        Returns {'value': <value>} or {'value': <value>, 'stale': True}
+        or None
+        """
+        with self.lock:
+            self.purge_expired()
+
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            now = time.time()
+            if now >= entry[3]:
+                # remove expired value
+                self.remove(key)
+                self.notify('expiration', key)
+                return None
+            is_stale = now >= entry[1]
+            if is_stale and not stale:
+                return None
+
+            # mark as most recently used
+            self.entries.move_to_end(key)
+            value = entry[0]
+
+        res = {'value': copy_value(value, self.frozen, mutable)}
+        if is_stale:
+            res['stale'] = True
         return res
 
+    def remove(self, key):
+        """Remove entry for key if present.
 
-class Cache():
-    """Nested dict for values where each key will expire after some time."""
+        :param tuple key: Key for value
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.removed(key, entry)
+
+    def removed(self, key, entry):
+        """Update size and tag index for a removed entry.
+
+        :param tuple key: Key of removed entry
+        :param list entry: Removed entry
+        """
+        self.total_bytes -= entry[2]
+        for tag in entry[4]:
+            keys = self.tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tag_index[tag]
+
+    def invalidate(self, tags):
+        """Remove all entries with all of the tags and return their number.
+
+        :param list tags: Tags as (<name>, <value>) tuples
+        """
+        with self.lock:
+            tag_keys = []
+            for tag in tags:
+                keys = self.tag_index.get(tag)
+                if not keys:
+                    return 0
+                tag_keys.append(keys)
+
+            # check candidates of the least used tag
+            tag_keys.sort(key=len)
+            keys = [
+                key for key in tag_keys[0]
+                if all(key in other_keys for other_keys in tag_keys[1:])
+            ]
+            for key in keys:
+                self.remove(key)
+
+        return len(keys)
+
+    def purge_expired(self):
+        """Remove all expired entries."""
+        now = time.time()
+        with self.lock:
+            queue = self.expiry_queue
+            while queue and queue[0][0] <= now:
+                keep_until, seq, key = heapq.heappop(queue)
+                entry = self.entries.get(key)
+                # NOTE: skip queue items of overwritten or removed entries
+                if entry is not None and entry[3] == keep_until:
+                    self.remove(key)
+                    self.notify('expiration', key)
+
+            if len(queue) > 2 * len(self.entries) + 64:
+                # compact queue with items of overwritten or removed entries
+                self.expiry_queue = [
+                    (entry[3], next(self.seq), key)
+                    for key, entry in self.entries.items()
+                ]
+                heapq.heapify(self.expiry_queue)
+
+    def evict(self):
+        """Remove least recently used entries until within budget."""
+        with self.lock:
+            while self.entries and (
+                (self.max_entries and len(self.entries) > self.max_entries)
+                or (self.max_bytes and self.total_bytes > self.max_bytes)
+            ):
+                self.evict_oldest()
+
+    def evict_oldest(self):
+        """Remove least recently used entry and return whether an entry was
+        removed."""
+        with self.lock:
+            if not self.entries:
+                return False
+            key, entry = self.entries.popitem(last=False)
+            self.removed(key, entry)
+            self.notify('eviction', key)
+            return True
+
+    def usage(self):
+        """Return number of entries and approximate size in bytes per
+        stats label (see CacheBackend.usage).
+        """
+        usage = {}
+        with self.lock:
+            for key, entry in self.entries.items():
+                label_usage = usage.setdefault(stats_label(key), [0, 0])
+                label_usage[0] += 1
+                label_usage[1] += entry[2]
+        return usage
+
+
+class LRUCache(CacheBackend):
+    """Thread-safe in-process LRU cache backend with lock striping.
+
+    Keys are distributed by hash over a number of LRUCacheSegments with
+    their own lock, so that concurrent requests for different keys do not
+    wait for a single global lock. The entry budget is split between the
+    segments, so that their budgets sum up to max_entries. The memory budget is shared, so that large values fit in
+    any segment, and entries of the segments using the most memory are
+    evicted first.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, frozen=False,
+                 stripes=16):
+        """Constructor
+
+        :param int max_entries: Max number of entries (0 for unlimited)
+        :param int max_bytes: Max approximate size of all values in bytes
+                              (0 for unlimited)
+        :param bool frozen: Store read-only values and return them without
+                            copying (see ExpiringDict)
+        :param int stripes: Number of segments with separate locks
+        """
+        if max_entries:
+            # use fewer segments for small budgets, as uneven key
+            # distribution would evict entries early
+            stripes = max(1, min(stripes, max_entries // 16))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.frozen = frozen
+        # NOTE: segments only skip values larger than the whole cache,
+        #       the total memory budget is enforced in set()
+        self.segments = [
+            LRUCacheSegment(
+                # spread remainder of entry budget over first segments
+                max_entries // stripes + (i < max_entries % stripes),
+                max_bytes, frozen, self.notify
+            )
+            for i in range(stripes)
+        ]
+        self.evict_lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    @property
+    def total_bytes(self):
+        """Approximate size of all values in bytes."""
+        return sum(segment.total_bytes for segment in self.segments)
+
+    def segment(self, key):
+        """Return segment for key.
+
+        :param tuple key: Key for value
+        """
+        return self.segments[hash(key) % len(self.segments)]
+
+    def set(self, key, value, duration=300, stale_duration=0, tags=()):
+        self.segment(key).set(key, value, duration, stale_duration, tags)
+        if self.max_bytes and self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def lookup(self, key, mutable=False, stale=False):
+        return self.segment(key).lookup(key, mutable, stale)
+
+    def evict(self):
+        """Remove least recently used entries of the segments using the most
+        memory until all values are within the memory budget."""
+        with self.evict_lock:
+            while self.total_bytes > self.max_bytes:
+                segment = max(
+                    self.segments, key=lambda segment: segment.total_bytes
+                )
+                if not segment.evict_oldest():
+                    break
+
+    def remove(self, key):
+        self.segment(key).remove(key)
+
+    def clear(self):
+        for segment in self.segments:
+            segment.clear()
+
+    def invalidate(self, tags):
+        return sum(segment.invalidate(tags) for segment in self.segments)
+
+    def purge_expired(self):
+        """Remove all expired entries."""
+        for segment in self.segments:
+            segment.purge_expired()
+
+    def usage(self):
+        usage = {}
+        for segment in self.segments:
+            for label, segment_usage in segment.usage().items():
+                label_usage = usage.setdefault(label, [0, 0])
+                label_usage[0] += segment_usage[0]
+                label_usage[1] += segment_usage[1]
+        return usage
+
+
+# classes allowed in pickled values of SQLiteCache as
+# {(<module>, <name>): <class>}
+SAFE_PICKLE_CLASSES = {
+    (cls.__module__, cls.__name__): cls
+    for cls in (
+        FrozenDict, FrozenList, set, frozenset, bytearray, complex,
+        collections.OrderedDict, decimal.Decimal, datetime.date,
+        datetime.datetime, datetime.time, datetime.timedelta,
+        datetime.timezone
+    )
+}
+
+
+def safe_dumps(value):
+    """Return value pickled with only SAFE_PICKLE_CLASSES allowed.
+
+    Raises a PicklingError for values containing other classes.
+
+    :param obj value: Value to pickle
+    """
+    fh = io.BytesIO()
+    RestrictedPickler(fh, SAFE_PICKLE_CLASSES).dump(value)
+    return fh.getvalue()
+
+
+def safe_loads(data):
+    """Return value unpickled with only SAFE_PICKLE_CLASSES allowed.
+
+    :param bytes data: Pickled value
+    """
+    return RestrictedUnpickler(io.BytesIO(data), SAFE_PICKLE_CLASSES).load()
+
+
+class SQLiteCache(CacheBackend):
+    """Cache backend in an SQLite database file shared by all processes.
+
+    The database is opened in WAL mode, so that the workers of a service
+    can read concurrently. New database files are only accessible by the
+    current user.
+
+    Values are serialized with pickle, but only plain data and
+    SAFE_PICKLE_CLASSES are loaded again. Values containing other classes
+    are not cached.
+
+    Expired entries are purged and the cache is trimmed to its budget
+    periodically. If over budget, the entries which expire first are
+    removed.
+    """
+
+    # interval in seconds between purges of expired entries
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path, max_entries=0, max_bytes=0, frozen=False):
+        """Constructor
+
+        :param str path: Path to SQLite database file
+        :param int max_entries: Max number of entries (0 for unlimited)
+        :param int max_bytes: Max size of all serialized values in bytes
+                              (0 for unlimited)
+        :param bool frozen: Store read-only values (see ExpiringDict)
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.frozen = frozen
+        # thread local connections
+        self.local = threading.local()
+        self.last_purge = 0
+
+        # create missing database file only accessible by the current user
+        # NOTE: SQLite creates its WAL files with the same permissions
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "  key TEXT PRIMARY KEY,"
+                "  value BLOB NOT NULL,"
+                "  expires REAL NOT NULL,"
+                "  keep_until REAL NOT NULL,"
+                "  size INTEGER NOT NULL"
+                ")"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_keep_until "
+                "ON cache (keep_until)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_tags ("
+                "  tag TEXT NOT NULL,"
+                "  key TEXT NOT NULL,"
+                "  PRIMARY KEY (tag, key)"
+                ") WITHOUT ROWID"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_tags_key ON cache_tags (key)"
+            )
+
+    def connection(self):
+        """Return SQLite connection for current thread and process."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            # NOTE: do not reuse connections across forks
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def db_key(self, key):
+        """Return text key for database.
+
+        :param tuple key: Key for value
+        """
+        return json.dumps(key, default=repr)
+
+    def set(self, key, value, duration=300, stale_duration=0, tags=()):
+        """Store value under key until expiry.
+
+        :param tuple key: Key for value
+        :param obj value: Value to store
+        :param int duration: Time in seconds until expiry (default: 300s)
+        :param int stale_duration: Additional time in seconds to keep an
+                                   expired value for stale lookups
+        :param frozenset tags: Tags as (<name>, <value>) tuples for
+                               invalidation
+        """
+        if self.frozen:
+            value = freeze(value)
+        try:
+            data = safe_dumps(value)
+        except pickle.PicklingError:
+            # skip values which could not be loaded again
+            self.remove(key)
+            return
+        if self.max_bytes and len(data) > self.max_bytes:
+            # skip values larger than the whole cache
+            self.remove(key)
+            return
+
+        expires = time.time() + duration
+        db_key = self.db_key(key)
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache "
+                "(key, value, expires, keep_until, size) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    db_key, data, expires,
+                    expires + stale_duration, len(data)
+                )
+            )
+            conn.execute("DELETE FROM cache_tags WHERE key = ?", (db_key,))
+            conn.executemany(
+                "INSERT INTO cache_tags (tag, key) VALUES (?, ?)",
+                [(self.db_key(tag), db_key) for tag in tags]
+            )
+
+        if time.time() - self.last_purge > self.PURGE_INTERVAL:
+            self.purge_expired()
+            self.evict()
+
+    def lookup(self, key, mutable=False, stale=False):
+        """Return dict with value or None if not present or expired.
+
+        :param tuple key: Key for value
+        :param bool mutable: Return a mutable copy of a frozen value
+        :param bool stale: Also return expired values within their stale
+                           duration, marked with 'stale': True
+
+        Returns {'value': <value>} or {'value': <value>, 'stale': True}
+        or None
+        """
+        now = time.time()
+        row = self.connection().execute(
+            "SELECT value, expires FROM cache "
+            "WHERE key = ? AND keep_until > ?",
+            (self.db_key(key), now)
+        ).fetchone()
+        if row is None:
+            return None
+        is_stale = now >= row[1]
+        if is_stale and not stale:
+            return None
+
+        # NOTE: unpickled value is a private copy
+        try:
+            value = safe_loads(row[0])
+        except Exception:
+            # invalid value, e.g. written by an older version
+            self.remove(key)
+            return None
+        if self.frozen and mutable:
+            value = thaw(value)
+        res = {'value': value}
+        if is_stale:
+            res['stale'] = True
+        return res
+
+    def remove(self, key):
+        """Remove entry for key if present.
+
+        :param tuple key: Key for value
+        """
+        conn = self.connection()
+        with conn:
+            self.delete_keys(conn, [self.db_key(key)])
+
+    def delete_keys(self, conn, db_keys):
+        """Delete entries and their tags in a transaction.
+
+        :param Connection conn: SQLite connection
+        :param list db_keys: Text keys of entries
+        """
+        params = [(db_key,) for db_key in db_keys]
+        conn.executemany("DELETE FROM cache WHERE key = ?", params)
+        conn.executemany("DELETE FROM cache_tags WHERE key = ?", params)
+
+    def clear(self):
+        """Remove all entries."""
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM cache")
+            conn.execute("DELETE FROM cache_tags")
+
+    def invalidate(self, tags):
+        """Remove all entries with all of the tags and return their number.
+
+        :param list tags: Tags as (<name>, <value>) tuples
+        """
+        if not tags:
+            return 0
+
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            db_keys = [row[0] for row in conn.execute(
+                " INTERSECT ".join(
+                    ["SELECT key FROM cache_tags WHERE tag = ?"] * len(tags)
+                ),
+                [self.db_key(tag) for tag in tags]
+            )]
+            self.delete_keys(conn, db_keys)
+
+        return len(db_keys)
+
+    def purge_expired(self):
+        """Remove all expired entries."""
+        self.last_purge = time.time()
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            keys = [row[0] for row in conn.execute(
+                "SELECT key FROM cache WHERE keep_until <= ?",
+                (self.last_purge,)
+            )]
+            self.delete_keys(conn, keys)
+        for key in keys:
+            self.notify('expiration', tuple(json.loads(key)))
+
+    def evict(self):
+        """Remove entries which expire first until within budget."""
+        if not self.max_entries and not self.max_bytes:
+            return
+
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT key, size FROM cache ORDER BY expires"
+            ).fetchall()
+            count = len(rows)
+            total_bytes = sum(row[1] for row in rows)
+
+            keys = []
+            for key, size in rows:
+                if not (
+                    (self.max_entries and count > self.max_entries)
+                    or (self.max_bytes and total_bytes > self.max_bytes)
+                ):
+                    break
+                keys.append(key)
+                count -= 1
+                total_bytes -= size
+
+            self.delete_keys(conn, keys)
+        for key in keys:
+            self.notify('eviction', tuple(json.loads(key)))
+
+    def usage(self):
+        """Return number of entries and size of serialized values in bytes
+        per stats label (see CacheBackend.usage).
+
+        NOTE: includes entries of all processes
+        """
+        usage = {}
+        rows = self.connection().execute(
+            "SELECT key, size FROM cache WHERE keep_until > ?", (time.time(),)
+        )
+        for key, size in rows:
+            label_usage = usage.setdefault(
+                stats_label(tuple(json.loads(key))), [0, 0]
+            )
+            label_usage[0] += 1
+            label_usage[1] += size
+        return usage
+
+
+class ThreadCounters:
+    """Counters of CacheStats recorded by a single thread."""
+
+    __slots__ = ('counters', '__weakref__')
 
     def __init__(self):
-        self.init()
+        # counters as {(<counter>, <label>): <count>}
+        self.counters = {}
+
+
+class CacheStats:
+    """Hit, miss, expiration and eviction counters of a Cache per service
+    and first key.
+
+    Counters are kept per thread to avoid a global lock on every cache
+    access, and summed up for a snapshot. Counters of finished threads are
+    folded into shared totals.
+    """
+
+    COUNTERS = ['hits', 'misses', 'expirations', 'evictions']
+    # counters for recorded events
+    EVENT_COUNTERS = {
+        'hit': 'hits',
+        'miss': 'misses',
+        'expiration': 'expirations',
+        'eviction': 'evictions'
+    }
+
+    def __init__(self):
+        self.local = threading.local()
+        # counters of running threads as
+        #   {<thread id>: {(<counter>, <label>): <count>}}
+        self.thread_counters = {}
+        # counters of finished threads as {(<counter>, <label>): <count>}
+        self.totals = {}
+        self.thread_ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def record(self, event, key):
+        """Increment counter of event for a cache key.
+
+        :param str event: 'hit', 'miss', 'expiration' or 'eviction'
+        :param tuple key: Cache key
+        """
+        local_counters = getattr(self.local, 'counters', None)
+        if local_counters is None:
+            local_counters = ThreadCounters()
+            self.local.counters = local_counters
+            with self.lock:
+                thread_id = next(self.thread_ids)
+                self.thread_counters[thread_id] = local_counters.counters
+            # NOTE: thread local values are released when the thread ends
+            weakref.finalize(local_counters, self.fold, thread_id)
+
+        counters = local_counters.counters
+        counter_key = (self.EVENT_COUNTERS[event], stats_label(key))
+        counters[counter_key] = counters.get(counter_key, 0) + 1
+
+    def fold(self, thread_id):
+        """Add counters of a finished thread to the totals.
+
+        :param int thread_id: Id of thread in thread_counters
+        """
+        with self.lock:
+            counters = self.thread_counters.pop(thread_id, {})
+            for counter_key, count in counters.items():
+                self.totals[counter_key] = (
+                    self.totals.get(counter_key, 0) + count
+                )
+
+    def reset(self):
+        """Reset all counters."""
+        with self.lock:
+            self.totals = {}
+            for counters in self.thread_counters.values():
+                counters.clear()
+
+    def snapshot(self, usage={}):
+        """Return counters and usage per service and first key as
+            {
+                <service>: {
+                    <first key>: {
+                        hits: <count>,
+                        misses: <count>,
+                        expirations: <count>,
+                        evictions: <count>,
+                        entries: <count>,
+                        bytes: <approximate size>
+                    }
+                }
+            }
+
+        :param obj usage: Backend usage (see CacheBackend.usage)
+        """
+        with self.lock:
+            totals = self.totals.copy()
+            thread_counters = [
+                counters.copy() for counters in self.thread_counters.values()
+            ]
+        for counters in thread_counters:
+            for counter_key, count in counters.items():
+                totals[counter_key] = totals.get(counter_key, 0) + count
+
+        labels = set(label for counter, label in totals)
+        labels.update(usage.keys())
+
+        snapshot = {}
+        for service, first_key in labels:
+            stats = {}
+            for counter in self.COUNTERS:
+                stats[counter] = totals.get((counter, (service, first_key)), 0)
+            entries, size = usage.get((service, first_key), [0, 0])
+            stats['entries'] = entries
+            stats['bytes'] = size
+            snapshot.setdefault(service, {})[first_key] = stats
+
+        return snapshot
+
+    @staticmethod
+    def prometheus_metrics(snapshot, prefix='qwc_cache'):
+        """Return stats snapshot in Prometheus text exposition format.
+
+        :param obj snapshot: Stats snapshot
+        :param str prefix: Metric name prefix
+        """
+        metrics = [
+            ('hits', 'counter', '_total', "Number of cache hits"),
+            ('misses', 'counter', '_total', "Number of cache misses"),
+            ('expirations', 'counter', '_total', "Number of expired entries"),
+            ('evictions', 'counter', '_total', "Number of evicted entries"),
+            ('entries', 'gauge', '', "Number of cache entries"),
+            ('bytes', 'gauge', '', "Approximate size of cache entries"),
+        ]
+
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n')
+
+        lines = []
+        for counter, metric_type, suffix, description in metrics:
+            name = '%s_%s%s' % (prefix, counter, suffix)
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for service, service_stats in snapshot.items():
+                for first_key, stats in service_stats.items():
+                    lines.append('%s{service="%s",key="%s"} %s' % (
+                        name, escape(service),
+                        escape(first_key if first_key is not None else ''),
+                        stats[counter]
+                    ))
+
+        return '\n'.join(lines) + '\n'
+
+
+class Cache():
+    """Cache for values where each key will expire after some time.
+
+    Values are stored in a cache backend under the flat key
+    (service, group, username, *keys).
+
+    The backend is a bounded in-process LRU cache by default, or an SQLite
+    database shared by all processes on a node if $CACHE_BACKEND is
+    'sqlite'.
+
+    Cache is thread-safe.
+    """
+
+    # number of lock stripes for pending computations
+    STRIPES = 16
+
+    def __init__(self, max_entries=None, max_bytes=None, frozen=None,
+                 backend=None):
+        """Constructor
+
+        :param int max_entries: Max number of entries
+                                (default: $CACHE_MAX_ENTRIES or 10000,
+                                0 for unlimited)
+        :param int max_bytes: Max approximate size of cached values in bytes
+                              (default: $CACHE_MAX_BYTES or 0 for unlimited)
+        :param bool frozen: Return shared read-only values instead of deep
+                            copies (default: $CACHE_FROZEN_VALUES or False)
+        :param CacheBackend backend: Custom cache backend
+                                     (default: backend from $CACHE_BACKEND)
+        """
+        if max_entries is None:
+            max_entries = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('CACHE_MAX_BYTES', 0))
+        if frozen is None:
+            frozen = env_flag('CACHE_FROZEN_VALUES')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.frozen = frozen
+        if backend is None:
+            # NOTE: empty backends are falsy
+            backend = self.create_backend()
+        self.cache = backend
+
+        self.stats = CacheStats()
+        self.cache.listener = self.stats.record
+
+        # pending computations of get_or_compute() as {<key>: <Flight>},
+        # striped by key hash
+        self.flights = [{} for i in range(self.STRIPES)]
+        self.flights_locks = [threading.Lock() for i in range(self.STRIPES)]
+
+    def create_backend(self):
+        """Create cache backend configured in $CACHE_BACKEND."""
+        backend = os.environ.get('CACHE_BACKEND', 'memory').lower()
+        if backend == 'sqlite':
+            path = os.environ.get('CACHE_PATH')
+            if not path:
+                path = os.path.join(private_cache_dir(), 'cache.db')
+            return SQLiteCache(
+                path, self.max_entries, self.max_bytes, self.frozen
+            )
+        elif backend == 'memory':
+            return LRUCache(self.max_entries, self.max_bytes, self.frozen)
+        else:
+            raise Exception("Unknown cache backend '%s'" % backend)
 
     def init(self):
-        self.cache = {}
+        """Remove all cached values."""
+        self.cache.clear()
+
+    def stats_snapshot(self):
+        """Return hit, miss, expiration and eviction counters, number of
+        entries and approximate size per service and first key
+        (see CacheStats.snapshot).
+        """
+        return self.stats.snapshot(self.cache.usage())
+
+    def prometheus_metrics(self):
+        """Return cache stats in Prometheus text exposition format."""
+        return CacheStats.prometheus_metrics(self.stats_snapshot())
 
     def identity_keys(self, identity):
         """Return [group, username] for identity.
@@ -70,41 +1182,172 @@ class Cache():
             # keys for empty user
             return [None, '_public_']
 
-    def cache_entry(self, service, identity, keys):
-        # cache is a nested dict with the following levels:
-        cache_keys = [service] + self.identity_keys(identity) + list(keys)
-        # print("cache_entry %s" % cache_keys)
-        cache = self.cache
+    def cache_key(self, service, identity, keys):
+        """Return flat cache key as (service, group, username, *keys).
 
-        # read or initialize cache level by level
-        for key in cache_keys[:-2]:
-            entry = cache.get(key)
-            if entry is None:
-                entry = {}
-                cache[key] = entry
-            cache = entry
-
-        # second last key points to ExpiringDict cache entry
-        key = cache_keys[-2]
-        entry = cache.get(key)
-        if entry is None:
-            entry = ExpiringDict()
-            cache[key] = entry
-
-        key = cache_keys[-1]
-        return (entry, key)
-
-    def read(self, service, identity, keys):
-        cache, key = self.cache_entry(service, identity, keys)
-        entry = cache.lookup(key)
+        :param str service: Service name
+        :param obj identity: User name or Identity dict
+        :param list keys: Additional keys
+        """
+        return tuple([service] + self.identity_keys(identity) + list(keys))
+
+    def read(self, service, identity, keys, mutable=False):
+        """Return cached value or None if not present or expired.
+
+        :param str service: Service name
+        :param obj identity: User name or Identity dict
+        :param list keys: Additional keys
+        :param bool mutable: Return a mutable copy if values are frozen
+        """
+        key = self.cache_key(service, identity, keys)
+        entry = self.cache.lookup(key, mutable)
         if entry:
-            # print("Reading data from cache with key '%s'" % key)
+            self.stats.record('hit', key)
             return entry['value']
         else:
+            self.stats.record('miss', key)
             return None
 
     def write(self, service, identity, keys, data,
-              cache_duration):
-        cache, key = self.cache_entry(service, identity, keys)
-        # print("Writing data into cache with key '%s'" % key)
-        cache.set(key, data, cache_duration)
+              cache_duration, stale_duration=0, tags={}):
+        """Store value until expiry.
+
+        :param str service: Service name
+        :param obj identity: User name or Identity dict
+        :param list keys: Additional keys
+        :param obj data: Value to store
+        :param int cache_duration: Time in seconds until expiry
+        :param int stale_duration: Additional time in seconds to keep an
+                                   expired value for get_or_compute()
+        :param obj tags: Additional tags for invalidate() as
+                         {<name>: <value>}, e.g. {'tenant': <tenant>}
+        """
+        key = self.cache_key(service, identity, keys)
+        self.cache.set(
+            key, data, cache_duration, stale_duration,
+            self.entry_tags(key, tags)
+        )
+
+    def entry_tags(self, key, tags):
+        """Return tags for a cache entry, including its service, group and
+        username.
+
+        :param tuple key: Cache key
+        :param obj tags: Additional tags as {<name>: <value>},
+                         e.g. {'tenant': <tenant>}
+        """
+        entry_tags = set(tags.items())
+        for name, value in zip(['service', 'group', 'username'], key):
+            if value is not None:
+                entry_tags.add((name, value))
+        return frozenset(entry_tags)
+
+    def invalidate(self, **tags):
+        """Remove all cached values with all of the tags and return their
+        number.
+
+        Examples:
+            invalidate(tenant='default')
+            invalidate(service='ogc', username='admin')
+
+        :param obj tags: Tags as <name>=<value>
+        """
+        if not tags:
+            return 0
+        return self.cache.invalidate(list(tags.items()))
+
+    def get_or_compute(self, service, identity, keys, fn, duration,
+                       stale_duration=0, mutable=False, tags={}):
+        """Return cached value or compute and cache it if missing or expired.
+
+        Concurrent calls for the same key are coalesced, so that only one
+        thread calls fn while the others wait for its result.
+        If stale_duration is set, expired values are kept for this long and
+        returned to other threads while a single thread refreshes the value.
+
+        NOTE: Calls are only coalesced within a process.
+
+        :param str service: Service name
+        :param obj identity: User name or Identity dict
+        :param list keys: Additional keys
+        :param func fn: Function without arguments returning the value
+        :param int duration: Time in seconds until expiry
+        :param int stale_duration: Additional time in seconds to serve an
+                                   expired value while it is refreshed
+        :param bool mutable: Return a mutable copy if values are frozen
+        :param obj tags: Additional tags as {<name>: <value>}
+        """
+        key = self.cache_key(service, identity, keys)
+        entry = self.cache.lookup(key, mutable, stale_duration > 0)
+        if entry and not entry.get('stale'):
+            self.stats.record('hit', key)
+            return entry['value']
+
+        stripe = hash(key) % self.STRIPES
+        flights = self.flights[stripe]
+        flights_lock = self.flights_locks[stripe]
+        with flights_lock:
+            flight = flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                flights[key] = flight
+
+        if not leader:
+            if entry:
+                # return stale value while another thread refreshes it
+                self.stats.record('hit', key)
+                return entry['value']
+            # NOTE: count waiting for a pending computation as hit
+            self.stats.record('hit', key)
+            return flight.result(self.frozen, mutable)
+
+        try:
+            # NOTE: check again, as a previous leader may have stored the
+            #       value after the lookup above
+            entry = self.cache.lookup(key)
+            if entry:
+                self.stats.record('hit', key)
+                value = entry['value']
+            else:
+                self.stats.record('miss', key)
+                value = fn()
+                if self.frozen:
+                    value = freeze(value)
+                self.cache.set(
+                    key, value, duration, stale_duration,
+                    self.entry_tags(key, tags)
+                )
+            flight.value = value
+        except BaseException as e:
+            # NOTE: also pass e.g. SystemExit on to waiting threads
+            flight.error = e
+            raise
+        finally:
+            with flights_lock:
+                del flights[key]
+            flight.done.set()
+
+        return copy_value(value, self.frozen, mutable)
+
+
+class Flight:
+    """Pending computation of a value in Cache.get_or_compute()."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def result(self, frozen, mutable):
+        """Wait for computed value and return a copy of it.
+
+        Raises the error of the computation if it failed.
+
+        :param bool frozen: Whether value is frozen
+        :param bool mutable: Return a mutable copy of a frozen value
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return copy_value(self.value, frozen, mutable)
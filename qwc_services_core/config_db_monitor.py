@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+
+from sqlalchemy import func, select
+
+
+class ConfigDBMonitor():
+    """ConfigDBMonitor class
+
+    Detect ConfigDB changes by polling the last_update table at most once
+    per interval, and provide a generation number, which is increased for
+    every detected change.
+    """
+
+    # shared monitors by ConfigDB URL
+    monitors = {}
+    monitors_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, config_models, logger):
+        """Return monitor for ConfigDB shared by all handlers in the process.
+
+        :param ConfigModels config_models: Helper for ORM models
+        :param Logger logger: Application logger
+        """
+        key = str(config_models.engine.url)
+        with cls.monitors_lock:
+            monitor = cls.monitors.get(key)
+            if monitor is None:
+                monitor = cls(config_models, logger)
+                cls.monitors[key] = monitor
+        return monitor
+
+    def __init__(self, config_models, logger, interval=None):
+        """Constructor
+
+        :param ConfigModels config_models: Helper for ORM models
+        :param Logger logger: Application logger
+        :param float interval: Min seconds between polls
+                               (default: $CONFIGDB_POLL_INTERVAL or 10)
+        """
+        self.config_models = config_models
+        self.logger = logger
+        if interval is None:
+            interval = float(os.environ.get('CONFIGDB_POLL_INTERVAL', 10))
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.current_generation = 0
+        # last polled update timestamp
+        self.last_update = None
+        self.polled = False
+        self.next_poll = 0
+
+    def generation(self):
+        """Return current generation of ConfigDB.
+
+        Polls the last_update table if the interval has passed since the
+        last poll. Concurrent callers do not wait for a running poll.
+        """
+        if time.monotonic() < self.next_poll:
+            return self.current_generation
+
+        if self.lock.acquire(blocking=False):
+            try:
+                if time.monotonic() >= self.next_poll:
+                    self.poll()
+                    self.next_poll = time.monotonic() + self.interval
+            finally:
+                self.lock.release()
+
+        return self.current_generation
+
+    def poll(self):
+        """Query last update timestamp and increase generation on change."""
+        last_update_table = self.config_models.table('last_update')
+        if last_update_table is None:
+            self.logger.warning("ConfigDB table 'last_update' not found")
+            return
+
+        session = self.config_models.session()
+        try:
+            last_update = session.execute(
+                select(func.max(last_update_table.c.updated_at))
+            ).scalar()
+        except Exception as e:
+            self.logger.warning(
+                "Could not query ConfigDB last update:\n%s" % e
+            )
+            return
+        finally:
+            session.close()
+
+        if self.polled and last_update != self.last_update:
+            self.current_generation += 1
+            self.logger.info(
+                "ConfigDB has changed (generation %d)" %
+                self.current_generation
+            )
+        self.last_update = last_update
+        self.polled = True
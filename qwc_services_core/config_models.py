@@ -43,6 +43,15 @@ class ConfigModels():
         else:
             return self.base.classes.get(name) or self.custom_models.get(name)
 
+    def table(self, name):
+        """Get SQLAlchemy table, e.g. for association tables without model.
+
+        :param str name: Table name
+        """
+        return self.base.metadata.tables.get(
+            '%s.%s' % (self.qwc_config_schema, name)
+        )
+
     def init_models(self, extra_tables):
         """Setup SQLAlchemy ORM models."""
 
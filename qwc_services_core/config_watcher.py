@@ -0,0 +1,320 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+import time
+
+from .json_utils import file_key
+from .permissions_reader import PermissionsReader
+from .runtime_config import RuntimeConfig
+
+
+# inotify constants (cf. <sys/inotify.h>)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# events in config dirs which may change a watched file
+IN_WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+# struct inotify_event header as (wd, mask, cookie, len)
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def load_inotify():
+    """Return libc with inotify functions, or None if not available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # check for inotify functions
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except Exception:
+        return None
+
+
+class ConfigWatcher():
+    """ConfigWatcher class
+
+    Detect changes of service config and permission files per tenant and
+    provide a generation number per tenant, which is increased for every
+    detected change.
+
+    Files are checked at most once per interval by either reading pending
+    inotify events of the config dirs, or polling the file stats.
+    """
+
+    # shared watcher of the process
+    watcher = None
+    watcher_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, logger):
+        """Return watcher shared by all tenant handlers in the process, or
+        None if disabled.
+
+        :param Logger logger: Application logger
+        """
+        mode = os.environ.get('CONFIG_WATCH_MODE', 'poll').lower()
+        if mode == 'off':
+            return None
+
+        with cls.watcher_lock:
+            if cls.watcher is None:
+                cls.watcher = cls(logger, mode)
+        return cls.watcher
+
+    def __init__(self, logger, mode='poll', interval=None):
+        """Constructor
+
+        :param Logger logger: Application logger
+        :param str mode: 'inotify' or 'poll'
+        :param float interval: Min seconds between checks
+                               (default: $CONFIG_WATCH_INTERVAL or 1)
+        """
+        self.logger = logger
+        if interval is None:
+            interval = float(os.environ.get('CONFIG_WATCH_INTERVAL', 1))
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.next_check = 0
+        # generation per tenant as {<tenant>: <generation>}
+        self.generations = {}
+        # watched services as {(<service>, <tenant>)}
+        self.watched = set()
+        # tenants of watched files as {<path>: {<tenant>}}
+        self.path_tenants = {}
+        # last stat keys of polled files as {<path>: <key>}
+        self.polled = {}
+
+        # inotify state
+        self.libc = None
+        if mode == 'inotify':
+            self.libc = load_inotify()
+            if self.libc is None:
+                self.logger.warning(
+                    "inotify not available, polling config files instead"
+                )
+        self.pid = None
+        self.fd = None
+        # watched dirs as {<wd>: <dir>} and {<dir>: <wd>}
+        self.wd_dirs = {}
+        self.dir_wds = {}
+        # watched file names as {<dir>: {<name>}}
+        self.dir_names = {}
+
+    def generation(self, service_name, tenant):
+        """Return current config generation of a tenant.
+
+        Starts watching the config files of the service on first call, and
+        checks for changes if the interval has passed since the last check.
+        Concurrent callers do not wait for a running check.
+
+        :param str service_name: Service name
+        :param str tenant: Tenant ID
+        """
+        if (service_name, tenant) not in self.watched:
+            with self.lock:
+                if (service_name, tenant) not in self.watched:
+                    self.watch(service_name, tenant)
+
+        if time.monotonic() >= self.next_check:
+            if self.lock.acquire(blocking=False):
+                try:
+                    if time.monotonic() >= self.next_check:
+                        self.check()
+                        self.next_check = time.monotonic() + self.interval
+                finally:
+                    self.lock.release()
+
+        return self.generations.get(tenant, 0)
+
+    def tenant_generation(self, tenant):
+        """Return last detected config generation of a tenant.
+
+        :param str tenant: Tenant ID
+        """
+        return self.generations.get(tenant, 0)
+
+    def watch(self, service_name, tenant):
+        """Start watching config and permission files of a service for a
+        tenant.
+
+        NOTE: Called with lock held.
+
+        :param str service_name: Service name
+        :param str tenant: Tenant ID
+        """
+        paths = [
+            RuntimeConfig.config_file_path(service_name, tenant),
+            PermissionsReader.permissions_file_path(tenant)
+        ]
+        for path in paths:
+            if path is None:
+                continue
+            self.path_tenants.setdefault(path, set()).add(tenant)
+            if not self.watch_inotify(path):
+                self.polled[path] = file_key(path)
+
+        self.generations.setdefault(tenant, 0)
+        self.watched.add((service_name, tenant))
+
+    def watch_inotify(self, path):
+        """Watch dir of a file with inotify, and return whether it is
+        watched.
+
+        :param str path: Path to file
+        """
+        if self.libc is None:
+            return False
+        if self.pid != os.getpid():
+            # NOTE: do not share inotify instance with forked processes
+            self.init_inotify()
+            if self.fd is None:
+                return False
+
+        dirname, name = os.path.split(path)
+        if dirname not in self.dir_wds:
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dirname), IN_WATCH_MASK
+            )
+            if wd < 0:
+                # e.g. missing dir
+                return False
+            self.wd_dirs[wd] = dirname
+            self.dir_wds[dirname] = wd
+        self.dir_names.setdefault(dirname, set()).add(name)
+        return True
+
+    def init_inotify(self):
+        """Create inotify instance for current process and watch all dirs
+        of watched files again.
+        """
+        if self.fd is not None and self.pid == os.getpid():
+            return
+
+        self.pid = os.getpid()
+        # NOTE: inherited inotify instance is not closed, as it is still
+        #       used by the parent process
+        self.fd = None
+        self.wd_dirs = {}
+        self.dir_wds = {}
+        previous_dir_names = self.dir_names
+        self.dir_names = {}
+
+        fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            self.logger.warning(
+                "Could not create inotify instance, polling config files "
+                "instead:\n%s" % os.strerror(ctypes.get_errno())
+            )
+            self.libc = None
+            for dirname, names in previous_dir_names.items():
+                for name in names:
+                    path = os.path.join(dirname, name)
+                    self.polled[path] = file_key(path)
+            return
+        self.fd = fd
+
+        for dirname, names in previous_dir_names.items():
+            for name in names:
+                path = os.path.join(dirname, name)
+                if not self.watch_inotify(path):
+                    self.polled[path] = file_key(path)
+
+    def check(self):
+        """Check watched files and increase generation of tenants with
+        changed files.
+
+        NOTE: Called with lock held.
+        """
+        changed = set()
+        if self.libc is not None:
+            if self.pid != os.getpid():
+                self.init_inotify()
+            if self.fd is not None:
+                changed |= self.read_events()
+
+        # poll files not watched by inotify
+        for path, key in self.polled.items():
+            current_key = file_key(path)
+            if current_key != key:
+                self.polled[path] = current_key
+                changed.add(path)
+
+        tenants = set()
+        for path in changed:
+            tenants |= self.path_tenants.get(path, set())
+        for tenant in tenants:
+            self.generations[tenant] = self.generations.get(tenant, 0) + 1
+            self.logger.info(
+                "Config files of tenant '%s' have changed (generation %d)" %
+                (tenant, self.generations[tenant])
+            )
+
+    def read_events(self):
+        """Read pending inotify events and return paths of possibly changed
+        watched files.
+        """
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(
+                    data, offset
+                )
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(
+                    data[offset:offset + length].rstrip(b'\0')
+                )
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    # events lost
+                    changed |= set(self.path_tenants)
+                    continue
+
+                dirname = self.wd_dirs.get(wd)
+                if dirname is None:
+                    continue
+                names = self.dir_names.get(dirname, set())
+                if not name or name.startswith('..'):
+                    # event of dir itself, or atomic update of a mounted
+                    # Kubernetes ConfigMap replacing the symlinked '..data'
+                    for watched_name in names:
+                        changed.add(os.path.join(dirname, watched_name))
+                elif name in names:
+                    changed.add(os.path.join(dirname, name))
+
+                if mask & IN_IGNORED:
+                    # dir was removed, poll its files instead
+                    del self.wd_dirs[wd]
+                    del self.dir_wds[dirname]
+                    for watched_name in self.dir_names.pop(dirname, set()):
+                        path = os.path.join(dirname, watched_name)
+                        self.polled[path] = file_key(path)
+                        changed.add(path)
+
+        return changed
+
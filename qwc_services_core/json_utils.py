@@ -0,0 +1,395 @@
+from contextlib import contextmanager
+from json import JSONDecoder
+import gc
+import hashlib
+import os
+import pickle
+import re
+import stat
+import tempfile
+import threading
+
+
+# JSON whitespace between values
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+@contextmanager
+def paused_gc():
+    """Pause cyclic garbage collection while parsing and transforming large
+    JSON documents, as the many allocated containers would otherwise trigger
+    repeated collections of the whole heap.
+
+    NOTE: gc.disable() affects all threads of the process, so collection is
+          only paused while the process is single-threaded, e.g. on startup.
+    """
+    if threading.active_count() > 1 or not gc.isenabled():
+        yield
+        return
+
+    gc.disable()
+    try:
+        yield
+    finally:
+        gc.enable()
+
+
+class JSONReader():
+    """Reader for the members of JSON objects in a JSON text, which decodes
+    member values one by one and keeps track of their offsets.
+
+    The JSON text is either given as a whole, or read incrementally from a
+    file, in which case only the part of the text which is currently being
+    decoded is kept in memory.
+    """
+
+    # number of chars read at once from a file
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, text='', fh=None):
+        """Constructor
+
+        :param str text: JSON text
+        :param file fh: Optional text file with JSON text, instead of text
+        """
+        self.text = text
+        # offset of next char in text
+        self.idx = 0
+        # offset of text in whole JSON text
+        self.offset = 0
+        self.fh = fh
+        self.decoder = JSONDecoder()
+
+    def fill(self, size):
+        """Drop consumed text and read up to size more chars from file.
+
+        Returns False at the end of the file.
+
+        :param int size: Number of chars to read
+        """
+        if self.fh is None:
+            return False
+        chunk = self.fh.read(size)
+        if not chunk:
+            self.fh = None
+            return False
+        self.offset += self.idx
+        self.text = self.text[self.idx:] + chunk
+        self.idx = 0
+        return True
+
+    def position(self):
+        """Return offset of next char."""
+        return self.offset + self.idx
+
+    def peek(self):
+        """Skip whitespace and return next char, or '' at the end."""
+        while True:
+            self.idx = WHITESPACE.match(self.text, self.idx).end()
+            if self.idx < len(self.text) or not self.fill(self.CHUNK_SIZE):
+                return self.text[self.idx:self.idx + 1]
+
+    def expect(self, char, name):
+        """Skip whitespace and expected char.
+
+        :param str char: Expected char
+        :param str name: Name of expected token for errors
+        """
+        if self.peek() != char:
+            raise ValueError(
+                "Expecting %s at char %d" % (name, self.position())
+            )
+        self.idx += 1
+
+    def expect_end(self):
+        """Raise an error if there is more than whitespace left."""
+        if self.peek() != '':
+            raise ValueError("Extra data at char %d" % self.position())
+
+    def decode(self):
+        """Return next decoded JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.idx)
+                # NOTE: numbers may continue in the next chunk
+                complete = (
+                    end < len(self.text) and self.text[end] not in '.eE'
+                )
+            except ValueError:
+                complete = False
+                end = None
+            # NOTE: read at least as much as is buffered, so that values
+            #       spanning many chunks are not decoded over and over
+            if complete or not self.fill(
+                max(self.CHUNK_SIZE, len(self.text) - self.idx)
+            ):
+                break
+
+        if end is None:
+            # raise decode error
+            self.decoder.raw_decode(self.text, self.idx)
+        self.idx = end
+        return value
+
+    def items(self):
+        """Yield decoded items of the JSON array at the current offset.
+
+        NOTE: Complete items in the buffered text are decoded at once where
+              possible, which is faster than decoding them one by one and
+              shares the keys of item objects as json.loads() does.
+        """
+        self.expect('[', "array")
+        if self.peek() == ']':
+            self.idx += 1
+            return
+
+        # end of last buffered text which could not be decoded at once
+        failed_end = -1
+        while True:
+            # NOTE: decoding fails if the last '}' does not end an item
+            end = self.text.rfind('}', self.idx) + 1
+            batch = None
+            if end > 0 and self.offset + end > failed_end:
+                try:
+                    batch = self.decoder.decode(
+                        '[%s]' % self.text[self.idx:end]
+                    )
+                    self.idx = end
+                except ValueError:
+                    failed_end = self.offset + end
+
+            if batch is not None:
+                yield from batch
+                batch = None
+            else:
+                yield self.decode()
+
+            delimiter = self.peek()
+            if delimiter == ']':
+                self.idx += 1
+                break
+            elif delimiter != ',':
+                raise ValueError(
+                    "Expecting ',' delimiter at char %d" % self.position()
+                )
+            self.idx += 1
+
+    def members(self):
+        """Yield (<key>, (<start of key>, <end of key>)) for each member of
+        the JSON object at the current offset.
+
+        After each key the reader is positioned at the start of its value,
+        which has to be read by the consumer before the next key.
+        """
+        self.expect('{', "object")
+        if self.peek() == '}':
+            self.idx += 1
+            return
+
+        while True:
+            self.peek()
+            key_start = self.position()
+            key = self.decode()
+            if not isinstance(key, str):
+                raise ValueError(
+                    "Expecting property name at char %d" % key_start
+                )
+            key_end = self.position()
+            self.expect(':', "':' delimiter")
+            self.peek()
+            yield key, (key_start, key_end)
+
+            delimiter = self.peek()
+            if delimiter == '}':
+                self.idx += 1
+                break
+            elif delimiter != ',':
+                raise ValueError(
+                    "Expecting ',' delimiter at char %d" % self.position()
+                )
+            self.idx += 1
+
+
+def env_flag(name, default=False):
+    """Return whether a boolean environment variable is set to 't' or
+    'true' (case insensitive), or default if it is not set.
+
+    :param str name: Name of environment variable
+    :param bool default: Value if not set
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('t', 'true')
+
+
+def private_cache_dir():
+    """Return dir for cache files of the current user in the temp dir,
+    which is created if missing.
+
+    Raises an exception if the dir is not private to the current user.
+    """
+    path = os.path.join(
+        tempfile.gettempdir(), 'qwc_services_cache-%d' % os.getuid()
+    )
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    # NOTE: do not follow symlinks planted by other users
+    st = os.lstat(path)
+    if (
+        not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+        or st.st_mode & 0o077
+    ):
+        raise Exception(
+            "Cache dir '%s' is not private to the current user" % path
+        )
+    return path
+
+
+def derived_file_path(source_path, suffix):
+    """Return path to a file derived from a source file in the private
+    cache dir, or None if the cache dir is not available.
+
+    NOTE: Config dirs are often read-only mounts, so derived files are
+          never written next to their source files.
+
+    :param str source_path: Path to source file
+    :param str suffix: Suffix of derived file
+    """
+    try:
+        cache_dir = private_cache_dir()
+    except Exception:
+        return None
+
+    source_path = os.path.abspath(source_path)
+    # unique name for source files with the same name in different dirs
+    digest = hashlib.sha1(os.fsencode(source_path)).hexdigest()[:16]
+    return os.path.join(cache_dir, '%s-%s%s' % (
+        os.path.basename(source_path), digest, suffix
+    ))
+
+
+def file_key(path):
+    """Return key of a file for detecting changes as
+    (<mtime in ns>, <size>, <inode>), or None if not found.
+
+    :param str path: Path to file
+    """
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class RestrictedUnpickler(pickle.Unpickler):
+    """Unpickler which only loads plain data and allowed classes, so that
+    loading a pickle never executes arbitrary code.
+    """
+
+    def __init__(self, fh, classes):
+        """Constructor
+
+        :param file fh: Binary file with pickled data
+        :param obj classes: Allowed classes as {(<module>, <name>): <class>}
+        """
+        super().__init__(fh)
+        self.classes = classes
+
+    def find_class(self, module, name):
+        cls = self.classes.get((module, name))
+        if cls is None:
+            raise pickle.UnpicklingError(
+                "Class '%s.%s' is not allowed" % (module, name)
+            )
+        return cls
+
+
+class RestrictedPickler(pickle.Pickler):
+    """Pickler which only dumps plain data and allowed classes, so that
+    values which RestrictedUnpickler would reject are detected while
+    dumping instead of by loading them again.
+    """
+
+    def __init__(self, fh, classes, protocol=pickle.HIGHEST_PROTOCOL):
+        """Constructor
+
+        :param file fh: Binary file for pickled data
+        :param obj classes: Allowed classes as {(<module>, <name>): <class>}
+        :param int protocol: Pickle protocol
+        """
+        super().__init__(fh, protocol)
+        self.allowed = set(classes.values())
+
+    def reducer_override(self, obj):
+        # NOTE: not called for plain data types
+        if type(obj) in self.allowed or (
+            isinstance(obj, type) and obj in self.allowed
+        ):
+            return NotImplemented
+        cls = obj if isinstance(obj, type) else type(obj)
+        raise pickle.PicklingError(
+            "Class '%s.%s' is not allowed" % (cls.__module__, cls.__name__)
+        )
+
+
+def read_pickle_file(path, header, classes={}):
+    """Return value of a pickle file written by write_pickle_file, or None
+    if the file is missing or its header does not match.
+
+    Only plain data and allowed classes are loaded (see
+    RestrictedUnpickler). Raises an exception if the file is invalid.
+
+    :param str path: Path to pickle file
+    :param obj header: Expected header, e.g. a version and the key of the
+                       source file
+    :param obj classes: Allowed classes as {(<module>, <name>): <class>}
+    """
+    if path is None:
+        return None
+    try:
+        fh = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+    with fh:
+        unpickler = RestrictedUnpickler(fh, classes)
+        if unpickler.load() != header:
+            return None
+        return unpickler.load()
+
+
+def write_pickle_file(path, header, value):
+    """Write header and value to a pickle file and return whether it was
+    written. Skips writing silently if the file could not be written.
+
+    NOTE: The file is replaced atomically, so that concurrent readers never
+          see a partial file.
+
+    :param str path: Path to pickle file
+    :param obj header: Header for validating the file on read
+    :param obj value: Value to write
+    """
+    if path is None:
+        return False
+
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='.%s.' % os.path.basename(path), suffix='.tmp',
+            dir=os.path.dirname(path)
+        )
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(header, fh, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(value, fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return True
+    except Exception:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
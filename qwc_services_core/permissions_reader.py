@@ -1,9 +1,20 @@
-from copy import deepcopy
+from collections import OrderedDict
+from collections.abc import Mapping
+from itertools import compress
 import os
+import threading
 
 from flask import json
 from werkzeug.utils import safe_join
 from .auth import get_username, get_groups
+from .cache import FrozenDict, FrozenList, SAFE_PICKLE_CLASSES
+from .json_utils import (
+    JSONReader, derived_file_path, env_flag, file_key, paused_gc,
+    read_pickle_file, write_pickle_file
+)
+
+# translation of binary digits to byte values 0 and 1
+BITS_TABLE = bytes.maketrans(b'01', b'\x00\x01')
 
 
 class PermissionsReader():
@@ -16,6 +27,9 @@ class PermissionsReader():
     # name of public role
     PUBLIC_ROLE_NAME = 'public'
 
+    # version of permissions snapshot format
+    SNAPSHOT_VERSION = 4
+
     @staticmethod
     def permissions_file_path(tenant):
         """Return path to permissions JSON file for a tenant.
@@ -25,14 +39,67 @@ class PermissionsReader():
         config_path = os.environ.get('CONFIG_PATH', 'config')
         return safe_join(config_path, tenant, 'permissions.json')
 
-    def __init__(self, tenant, logger):
+    @staticmethod
+    def snapshot_file_path(tenant):
+        """Return path to compiled permissions snapshot for a tenant in
+        the private cache dir, or None if not available.
+
+        :param str tenant: Tenant ID
+        """
+        permissions_path = PermissionsReader.permissions_file_path(tenant)
+        if permissions_path is None:
+            return None
+        return derived_file_path(permissions_path, '.snapshot')
+
+    def __init__(self, tenant, logger, lazy=None, streaming=None,
+                 snapshot=None, config_models=None, default_allow=False):
         """Constructor
 
         :param str tenant: Tenant ID
         :param Logger logger: Application logger
+        :param bool lazy: Expand unified role permissions on first use
+                          (default: $PERMISSIONS_LAZY_EXPANSION or False)
+        :param bool streaming: Decode permissions JSON section by section
+                               (default: $PERMISSIONS_JSON_STREAMING or False)
+        :param bool snapshot: Load compiled permissions from a snapshot in
+                              the private cache dir, and write it if stale
+                              or missing
+                              (default: $PERMISSIONS_SNAPSHOT or False)
+        :param ConfigModels config_models: Optional ConfigDB models for
+                                           reading permissions from ConfigDB
+                                           instead of the permissions JSON
+        :param bool default_allow: Value of permissions_default_allow for
+                                   permissions from ConfigDB
         """
         self.tenant = tenant
         self.logger = logger
+        if lazy is None:
+            lazy = env_flag('PERMISSIONS_LAZY_EXPANSION')
+        self.lazy = lazy
+        if streaming is None:
+            streaming = env_flag('PERMISSIONS_JSON_STREAMING')
+        self.streaming = streaming
+        if snapshot is None:
+            snapshot = env_flag('PERMISSIONS_SNAPSHOT')
+        self.config_models = config_models
+        self.default_allow = default_allow
+        # monitor and generation of ConfigDB for detecting changes
+        self.config_db_monitor = None
+        self.generation = None
+        if config_models is not None:
+            # NOTE: import SQLAlchemy only if ConfigDB is used, here and
+            #       in read_config_db_sections()
+            from .config_db_monitor import ConfigDBMonitor
+            self.config_db_monitor = ConfigDBMonitor.shared(
+                config_models, logger
+            )
+            # NOTE: snapshots are validated against the permissions JSON
+            snapshot = False
+        self.snapshot = snapshot
+        # max number of memoized results per permissions lookup
+        self.memo_size = int(os.environ.get('PERMISSIONS_MEMO_SIZE', 1000))
+        # NOTE: the permissions lookup and its memo are replaced at once on
+        #       reload, so queries read self.permissions only once
         self.permissions = self.load_permissions()
 
     def read_permissions(self):
@@ -54,6 +121,42 @@ class PermissionsReader():
 
         return permissions
 
+    def read_permissions_sections(self):
+        """Read permissions for a tenant from a JSON file section by section.
+
+        Yields (<key>, <value>) for each top-level key, decoding each section
+        only when it is consumed.
+
+        NOTE: The raw JSON text is read incrementally and array sections
+              are decoded item by item, so only one decoded section is
+              held at a time, if the consumer releases each section before
+              requesting the next one. Peak memory is about the largest
+              decoded section, instead of the raw text plus the whole
+              decoded document.
+        """
+        permissions_path = PermissionsReader.permissions_file_path(self.tenant)
+        self.logger.info(
+            "Reading permissions '%s' section by section" % permissions_path
+        )
+        try:
+            with open(permissions_path, encoding='utf-8') as fh:
+                reader = JSONReader(fh=fh)
+                for key, key_span in reader.members():
+                    if reader.peek() == '[':
+                        value = list(reader.items())
+                    else:
+                        value = reader.decode()
+                    yield key, value
+                    # release consumed section before decoding the next one
+                    value = None
+                reader.expect_end()
+        except Exception as e:
+            self.logger.error(
+                "Could not load permissions '%s':\n%s" %
+                (permissions_path, e)
+            )
+            raise e
+
     def load_permissions(self):
         """Load users, groups, roles and permissions.
 
@@ -67,74 +170,663 @@ class PermissionsReader():
                 },
                 roles: {
                     <role>: <permissions{}>
-                }
+                },
+                index: {
+                    <role>: {
+                        <resource_key>: {
+                            <name>: [<permission>]
+                        }
+                    }
+                },
+                bitmaps: {
+                    <role>: {
+                        <resource_key>: <bitmap of resource ids>
+                    }
+                },
+                resource_ids: <ResourceIds>,
+                raw_roles: {
+                    <role>: <raw permissions{}>
+                },
+                unified: <sources for unified permissions, or None>,
+                memo: <PermissionsMemo for results derived from the lookup>
             }
+
+        NOTE: The index of role permissions by resource name, the role
+              bitmaps and the sublayer closures of the resource hierarchy
+              are built on first use and stored without locking.
+              Concurrent threads may build the same entry, which is
+              harmless, as the results are equal.
         """
-        permissions = self.read_permissions()
+        with paused_gc():
+            if self.snapshot:
+                # NOTE: get source state before reading the permissions JSON,
+                #       so that concurrent changes invalidate the snapshot
+                source_key = file_key(
+                    PermissionsReader.permissions_file_path(self.tenant)
+                )
+                permissions = self.read_snapshot(source_key)
+                if permissions is not None:
+                    return permissions
 
-        # transform raw permissions to lookup dict
+            sources = self.collect_permissions(self.read_sections())
+            permissions = self.build_permissions(sources)
 
-        # detect permissions schema type
-        is_unified = (
-            'dataproducts' in permissions and 'common_resources' in permissions
+            if self.snapshot and source_key is not None:
+                permissions = self.compile_permissions(permissions)
+                self.write_snapshot(source_key, permissions)
+
+        return permissions
+
+    def reload(self):
+        """Reload permissions from JSON file.
+
+        Only roles affected by changed users, groups, roles or dataproducts
+        are rebuilt. Unchanged role permissions and their memoized results
+        are kept.
+
+        Returns names of changed roles, or None if all roles were rebuilt.
+        """
+        previous = self.permissions
+        with paused_gc():
+            if self.snapshot:
+                source_key = file_key(
+                    PermissionsReader.permissions_file_path(self.tenant)
+                )
+
+            sources = self.collect_permissions(self.read_sections())
+            diff = self.diff_permissions(previous, sources)
+            permissions = self.build_permissions(sources, previous, diff)
+
+            if self.snapshot and source_key is not None:
+                # NOTE: keep reused role bitmaps and their resource ids in
+                #       memory, as transferred memoized bitmaps depend on them
+                self.write_snapshot(
+                    source_key, self.compile_permissions(permissions)
+                )
+
+        if diff is not None:
+            def keep(key):
+                if key[0] == 'roles':
+                    # ('roles', <username>, <groups>)
+                    return (
+                        key[1] not in diff['users'] and
+                        diff['groups'].isdisjoint(key[2])
+                    )
+                elif key[0] in ['permissions', 'bitmap']:
+                    # ('permissions', <roles>, <resource_key>, <name>)
+                    # ('bitmap', <roles>, <resource_key>)
+                    return diff['roles'].isdisjoint(key[1])
+                else:
+                    # restrictions and subresources depend on all roles
+                    return not diff['roles']
+
+            # keep memoized results of unchanged users, groups and roles
+            permissions['memo'] = previous['memo'].transfer(keep)
+
+        # NOTE: publish permissions lookup and its memo at once
+        self.permissions = permissions
+
+        if diff is None:
+            self.logger.info("Reloaded permissions, rebuilt all roles")
+            return None
+        self.logger.info(
+            "Reloaded permissions, rebuilt %d changed roles" %
+            len(diff['roles'])
         )
+        return diff['roles']
 
-        resources_lookup = {}
-        if is_unified:
-            # create lookup for resources
-            for resource in permissions.get('dataproducts', []):
-                resources_lookup[resource.get('name')] = resource
+    def refresh(self):
+        """Reload permissions from ConfigDB if it has changed since the
+        permissions were read.
+
+        Returns whether the permissions were reloaded.
+        """
+        if self.config_db_monitor is None:
+            return False
+        if self.config_db_monitor.generation() == self.generation:
+            return False
+
+        self.reload()
+        return True
+
+    def read_sections(self):
+        """Return permissions for a tenant from JSON file or ConfigDB as
+        iterable of (<key>, <value>).
+        """
+        if self.config_models is not None:
+            return self.read_config_db_sections()
+        elif self.streaming:
+            return self.read_permissions_sections()
+        else:
+            return pop_sections(self.read_permissions())
+
+    def read_config_db_sections(self):
+        """Read permissions from ConfigDB in the format of the permissions
+        JSON as iterable of (<key>, <value>).
+
+        Users, groups, roles and permissions are loaded with a few bulk
+        queries instead of ORM relationships.
+
+        NOTE: Role permissions contain only the explicitly permitted
+              ConfigDB resources by resource type as
+                {
+                    <resource_type>: [{
+                        name: <resource name>,
+                        parent: <parent resource name or None>,
+                        writable: <write flag>,
+                        priority: <permission priority>
+                    }]
+                }
+              ordered by descending priority, so that the first permission
+              of a resource has the highest priority within a role.
+              Service specific permissions still require the
+              permissions JSON of the config generator.
+        """
+        from sqlalchemy import select
+        from sqlalchemy.orm import aliased
+
+        config_models = self.config_models
+        User = config_models.model('users')
+        Group = config_models.model('groups')
+        Role = config_models.model('roles')
+        Resource = config_models.model('resources')
+        Permission = config_models.model('permissions')
+        ParentResource = aliased(Resource)
+        groups_users = config_models.table('groups_users')
+        users_roles = config_models.table('users_roles')
+        groups_roles = config_models.table('groups_roles')
+
+        self.logger.info("Reading permissions from ConfigDB")
+        # NOTE: get generation before reading, so that concurrent changes
+        #       are detected on the next refresh
+        self.generation = self.config_db_monitor.generation()
+        session = config_models.session()
+        try:
+            user_names = dict(session.execute(
+                select(User.id, User.name)
+            ).all())
+            group_names = dict(session.execute(
+                select(Group.id, Group.name)
+            ).all())
+            role_names = dict(session.execute(
+                select(Role.id, Role.name)
+            ).all())
+
+            # collect group roles
+            group_roles = {}
+            for group_id, role_id in session.execute(
+                select(groups_roles.c.group_id, groups_roles.c.role_id)
+            ):
+                group_roles.setdefault(group_id, []).append(
+                    role_names[role_id]
+                )
+
+            # collect user groups and user roles
+            user_groups = {}
+            for group_id, user_id in session.execute(
+                select(groups_users.c.group_id, groups_users.c.user_id)
+            ):
+                user_groups.setdefault(user_id, []).append(
+                    group_names[group_id]
+                )
+            user_roles = {}
+            for user_id, role_id in session.execute(
+                select(users_roles.c.user_id, users_roles.c.role_id)
+            ):
+                user_roles.setdefault(user_id, []).append(
+                    role_names[role_id]
+                )
+
+            # collect role permissions
+            role_permissions = {}
+            for role_id in role_names:
+                role_permissions[role_id] = {}
+            query = select(
+                Permission.role_id, Resource.type, Resource.name,
+                ParentResource.name, Permission.write, Permission.priority
+            ).join(
+                Resource, Permission.resource_id == Resource.id
+            ).outerjoin(
+                ParentResource, Resource.parent_id == ParentResource.id
+            ).order_by(
+                Resource.type, Permission.priority.desc(), Resource.id,
+                Permission.id
+            )
+            for role_id, resource_type, name, parent, write, priority in (
+                session.execute(query)
+            ):
+                role_permissions[role_id].setdefault(
+                    resource_type, []
+                ).append({
+                    'name': name,
+                    'parent': parent,
+                    'writable': bool(write),
+                    'priority': priority or 0
+                })
+        finally:
+            session.close()
+
+        yield 'groups', [
+            {
+                'name': group_names[group_id],
+                'roles': sorted(group_roles.get(group_id, []))
+            }
+            for group_id in group_names
+        ]
+        yield 'users', [
+            {
+                'name': user_names[user_id],
+                'groups': sorted(user_groups.get(user_id, [])),
+                'roles': sorted(user_roles.get(user_id, []))
+            }
+            for user_id in user_names
+        ]
+        yield 'roles', [
+            {
+                'role': role_names[role_id],
+                'permissions': role_permissions[role_id]
+            }
+            for role_id in role_names
+        ]
+        yield 'permissions_default_allow', self.default_allow
+
+    def read_snapshot(self, source_key):
+        """Return compiled permissions from snapshot, or None if the snapshot
+        is stale, missing or invalid.
+
+        Only plain data and SNAPSHOT_CLASSES are loaded from the snapshot.
+
+        :param tuple source_key: Key of current permissions JSON
+        """
+        if source_key is None:
+            return None
 
-        # collect group roles
+        snapshot_path = PermissionsReader.snapshot_file_path(self.tenant)
+        try:
+            permissions = read_pickle_file(
+                snapshot_path,
+                (PermissionsReader.SNAPSHOT_VERSION, source_key),
+                SNAPSHOT_CLASSES
+            )
+        except Exception as e:
+            self.logger.warning(
+                "Could not load permissions snapshot '%s':\n%s" %
+                (snapshot_path, e)
+            )
+            return None
+
+        if permissions is not None:
+            self.logger.info(
+                "Read permissions snapshot '%s'" % snapshot_path
+            )
+            permissions['memo'] = PermissionsMemo(self.memo_size)
+        return permissions
+
+    def write_snapshot(self, source_key, permissions):
+        """Write compiled permissions to snapshot, if the private cache dir
+        is available.
+
+        :param tuple source_key: Key of permissions JSON
+        :param obj permissions: Compiled permissions lookup
+        """
+        snapshot_path = PermissionsReader.snapshot_file_path(self.tenant)
+        # NOTE: memoized results are not included
+        permissions = dict(permissions)
+        del permissions['memo']
+        if write_pickle_file(
+            snapshot_path, (PermissionsReader.SNAPSHOT_VERSION, source_key),
+            permissions
+        ):
+            self.logger.info(
+                "Wrote permissions snapshot '%s'" % snapshot_path
+            )
+
+    def compile_permissions(self, permissions):
+        """Return permissions lookup with fully expanded roles for writing
+        to a snapshot.
+
+        NOTE: The index of role permissions by resource name and the role
+              bitmaps are not included, as they are cheaper to build on first
+              use than to load.
+
+        :param obj permissions: Permissions lookup
+        """
+        compiled = dict(permissions)
+        compiled['roles'] = dict(permissions['roles'])
+        compiled['index'] = {}
+        compiled['bitmaps'] = {}
+        for role in compiled['roles']:
+            compiled['index'][role] = {}
+            compiled['bitmaps'][role] = {}
+        compiled['resource_ids'] = ResourceIds()
+        return compiled
+
+    def collect_permissions(self, sections):
+        """Collect users, groups and raw role permissions section by section,
+        so that processed raw sections can be released.
+
+        Returns sources for build_permissions as
+            {
+                users: {
+                    <user>: [<role>]
+                },
+                user_groups: {
+                    <user>: [<group>]
+                },
+                groups: {
+                    <group>: [<role>]
+                },
+                roles: {
+                    <role>: <raw permissions{}>
+                },
+                unified: {
+                    settings: <settings for expansion>,
+                    resources_lookup: {
+                        <name>: <dataproduct>
+                    }
+                },
+                permissions_default_allow: <bool>
+            }
+        with unified set to None for full permissions.
+
+        :param iterable sections: Permissions as (<key>, <value>)
+        """
         groups = {}
-        for group in permissions.get('groups', []):
-            groups[group['name']] = group['roles'] or []
+        user_roles = {}
+        user_groups = {}
+        roles = {}
+        resources_lookup = {}
+        resources_lookup_collected = False
+        settings = {}
+        for key, section in sections:
+            if key == 'groups':
+                # collect group roles
+                for group in section:
+                    groups[group['name']] = group['roles'] or []
+            elif key == 'users':
+                # collect direct user roles and user_groups
+                # NOTE: roles from groups are added once all groups are known
+                for user in section:
+                    user_roles[user['name']] = user.get('roles', []) or []
+                    user_groups[user['name']] = user['groups']
+            elif key == 'roles':
+                # collect role permissions
+                for role in section:
+                    roles[role['role']] = role['permissions']
+            elif key == 'dataproducts':
+                # create lookup for resources
+                for resource in section:
+                    resources_lookup[resource.get('name')] = resource
+                resources_lookup_collected = True
+            elif key in [
+                'common_resources', 'wms_name', 'wfs_name',
+                'permissions_default_allow'
+            ]:
+                settings[key] = section
+            # release processed raw section before decoding the next one
+            section = None
 
         # collect user roles
         users = {}
-        for user in permissions.get('users', []):
-            user_roles = []
-            # direct roles
-            for role in user.get('roles', []) or []:
-                user_roles.append(role)
+        for username, direct_roles in user_roles.items():
+            roles_list = list(direct_roles)
             # roles from groups
-            for group in user['groups'] or []:
-                user_roles.extend(groups.get(group, []))
+            for group in user_groups[username] or []:
+                roles_list.extend(groups.get(group, []))
             # assign unique sorted roles
-            users[user['name']] = sorted(list(set(user_roles)))
+            users[username] = sorted(list(set(roles_list)))
 
-        # collect user_groups
-        user_groups = {}
-        for user in permissions.get('users', []):
-            user_groups[user['name']] = user['groups']
+        # detect permissions schema type
+        is_unified = (
+            resources_lookup_collected and 'common_resources' in settings
+        )
 
-        # collect role permissions
-        roles = {}
-        for role in permissions.get('roles', []):
-            if not is_unified:
-                roles[role['role']] = role['permissions']
-            else:
-                roles[role['role']] = self.expand_unified_permissions(
-                    role['permissions'], deepcopy(resources_lookup), permissions
-                )
+        unified = None
+        if is_unified:
+            unified = {
+                # NOTE: keep only the settings required for expansion
+                'settings': {
+                    'wms_name': settings.get('wms_name', ''),
+                    'wfs_name': settings.get('wfs_name', ''),
+                    'common_resources': settings.get('common_resources', [])
+                },
+                'resources_lookup': resources_lookup
+            }
 
         return {
             'users': users,
             'user_groups': user_groups,
             'groups': groups,
             'roles': roles,
-            'permissions_default_allow': permissions.get('permissions_default_allow', False)
+            'unified': unified,
+            'permissions_default_allow': settings.get('permissions_default_allow', False)
+        }
+
+    def diff_permissions(self, previous, sources):
+        """Return names of changed entries between previous permissions and
+        collected sources as
+            {
+                users: {<user>},
+                groups: {<group>},
+                roles: {<role>},
+                resources: {<dataproduct>}
+            }
+        or None if no role permissions can be reused.
+
+        Changed roles include unified roles whose expansion reached a
+        changed dataproduct.
+
+        :param obj previous: Previous permissions lookup
+        :param obj sources: Collected sources (see collect_permissions)
+        """
+        previous_unified = previous['unified']
+        unified = sources['unified']
+        if (previous_unified is None) != (unified is None):
+            # permissions schema type changed
+            return None
+        if unified is not None and (
+            previous_unified['settings'] != unified['settings']
+        ):
+            # settings for expansion changed
+            return None
+
+        diff = {
+            'users': changed_keys(previous['users'], sources['users']),
+            'groups': changed_keys(previous['groups'], sources['groups']),
+            'roles': changed_keys(previous['raw_roles'], sources['roles']),
+            'resources': set()
+        }
+
+        if unified is not None:
+            previous_lookup = previous_unified['resources_lookup']
+            diff['resources'] = changed_keys(
+                previous_lookup, unified['resources_lookup']
+            )
+
+            if diff['resources']:
+                # collect resources whose previous expansion reached a
+                # changed resource via sublayers
+                hierarchy = previous_unified['hierarchy']
+                affected = set(diff['resources'])
+                for name in diff['resources']:
+                    affected.update(hierarchy.ancestors(name))
+
+                for role, role_permissions in sources['roles'].items():
+                    if not affected.isdisjoint(
+                        role_permissions.get('all_services', {})
+                    ):
+                        diff['roles'].add(role)
+
+        return diff
+
+    def build_permissions(self, sources, previous=None, diff=None):
+        """Return permissions lookup for collected sources.
+
+        Role permissions and resource records not changed according to diff
+        are reused from previous permissions.
+
+        :param obj sources: Collected sources (see collect_permissions)
+        :param obj previous: Optional previous permissions lookup
+        :param obj diff: Optional changes since previous permissions
+                         (see diff_permissions)
+        """
+        if diff is None:
+            previous = None
+
+        raw_roles = sources['roles']
+        unified = sources['unified']
+        if unified is not None:
+            # resource records shared by all roles
+            shared_records = {}
+            # expanded permissions of unchanged roles
+            reused = {}
+            if previous is not None:
+                # keep records of unchanged resources
+                # NOTE: group layers of WMS root and common resources are
+                #       keyed by ('group_layer', <name>) and always kept
+                for name, records in (
+                    previous['unified']['shared_records'].items()
+                ):
+                    if name not in diff['resources']:
+                        shared_records[name] = records
+
+                previous_roles = previous['roles']
+                if isinstance(previous_roles, LazyRolePermissions):
+                    # only already expanded roles
+                    previous_roles = previous_roles.expanded
+                for role in raw_roles:
+                    if role not in diff['roles'] and role in previous_roles:
+                        reused[role] = previous_roles[role]
+
+            # index over sublayer hierarchy shared by all roles
+            hierarchy = ResourceHierarchy(unified['resources_lookup'])
+            if hierarchy.cycles:
+                self.logger.warning(
+                    "Skipping cyclic sublayers of dataproducts: %s" %
+                    ", ".join([
+                        "%s -> %s" % cycle for cycle in hierarchy.cycles
+                    ])
+                )
+
+            unified = dict(
+                unified, shared_records=shared_records, hierarchy=hierarchy
+            )
+
+            def expand(role_permissions):
+                return self.expand_unified_permissions(
+                    role_permissions, unified['resources_lookup'],
+                    unified['settings'], shared_records, hierarchy
+                )
+
+            if self.lazy:
+                roles = LazyRolePermissions(raw_roles, expand, reused)
+            else:
+                roles = {}
+                for role, role_permissions in raw_roles.items():
+                    if role in reused:
+                        roles[role] = reused[role]
+                    else:
+                        roles[role] = expand(role_permissions)
+        else:
+            roles = {}
+            for role, role_permissions in raw_roles.items():
+                if previous is not None and role not in diff['roles']:
+                    # keep unchanged role object
+                    role_permissions = previous['roles'][role]
+                roles[role] = role_permissions
+            raw_roles = roles
+
+        # index role permissions by resource name and role bitmaps
+        # (built on first use)
+        index = {}
+        bitmaps = {}
+        for role in roles:
+            if previous is not None and role not in diff['roles']:
+                index[role] = previous['index'][role]
+                bitmaps[role] = previous['bitmaps'][role]
+            else:
+                index[role] = {}
+                bitmaps[role] = {}
+
+        if previous is not None:
+            # NOTE: keep resource ids of reused role bitmaps
+            resource_ids = previous['resource_ids']
+        else:
+            resource_ids = ResourceIds()
+
+        return {
+            'users': sources['users'],
+            'user_groups': sources['user_groups'],
+            'groups': sources['groups'],
+            'roles': roles,
+            'index': index,
+            'bitmaps': bitmaps,
+            'resource_ids': resource_ids,
+            'raw_roles': raw_roles,
+            'unified': unified,
+            'permissions_default_allow': sources['permissions_default_allow'],
+            'memo': PermissionsMemo(self.memo_size)
         }
 
+    def resource_name_index(self, lookup, role, resource_key):
+        """Return lookup for role permissions of a resource key by resource
+        name as {<name>: [<permission>]}, or None if the permissions can not
+        be indexed.
+
+        The lookup is built on first use.
+        Permissions keep their order for each name.
+
+        :param obj lookup: Permissions lookup
+        :param str role: Role name
+        :param str resource_key: Resource key in permissions data
+        """
+        role_index = lookup['index'].get(role)
+        if role_index is None:
+            # unknown role
+            return {}
+        if resource_key in role_index:
+            return role_index[resource_key]
+
+        resource_permissions = lookup['roles'][role].get(resource_key, [])
+        name_index = {}
+        if isinstance(resource_permissions, list):
+            try:
+                for permission in resource_permissions:
+                    if isinstance(permission, dict):
+                        name = permission.get('name')
+                    else:
+                        name = permission
+                    name_index.setdefault(name, []).append(permission)
+            except TypeError:
+                # unhashable names
+                name_index = None
+        else:
+            # non-list values
+            name_index = None
+
+        role_index[resource_key] = name_index
+        return name_index
+
     def expand_unified_permissions(self, role_permissions, resources_lookup,
-                                   permissions):
+                                   permissions, shared_records=None,
+                                   hierarchy=None):
         """Return full resource permissions expanded from unified permissions.
 
+        NOTE: Resource records in the expanded permissions are read-only and
+              shared between roles, if expanded with the same shared_records.
+
         :param obj role_permissions: Unified permissions for role
         :param obj resources_lookup: Lookup for resources with sublayers or
                                      attributes
         :param obj permissions: Permissions from JSON
+        :param obj shared_records: Optional cache for resource records
+                                   (see unified_resource_records)
+        :param ResourceHierarchy hierarchy: Optional index over sublayers of
+                                            resources_lookup
         """
+        if shared_records is None:
+            shared_records = {}
+
         full_permissions = {}
 
         wms_name = permissions.get('wms_name', '')
@@ -145,9 +837,9 @@ class PermissionsReader():
 
         wms_layers = []
         # add WMS root layer
-        wms_layers.append({
-            'name': wms_name
-        })
+        wms_layers.append(
+            self.unified_group_layer(wms_name, shared_records)
+        )
         wfs_layers = []
         data_datasets = []
         dataproducts = []
@@ -155,75 +847,63 @@ class PermissionsReader():
         document_templates = []
         solr_facets = []
 
-        # convert all_services dict to resources list
-        all_services = []
-        for name, resource in role_permissions.get('all_services', {}).items():
-            all_services.append({
-                'name': name
-            })
-            # copy writable flags from all_services to resources_lookup
-            if 'writable' in resource:
-                lookup = resources_lookup.get(name, {})
-                lookup['writable'] = resource['writable']
+        # collect writable flags from all_services
+        writable_overrides = {}
+        all_services = role_permissions.get('all_services', {})
+        for name, resource in all_services.items():
+            if 'writable' in resource and name in resources_lookup:
+                writable_overrides[name] = resource['writable']
 
         # collect permitted resources for role
-        role_resources = self.collect_resources(
-            all_services, resources_lookup
-        )
+        if hierarchy is not None:
+            role_resources = hierarchy.collect(all_services.keys())
+        else:
+            role_resources = self.collect_resources(
+                list(all_services.keys()), resources_lookup
+            )
 
         # expand to full QWC service permissions
         # NOTE: This generates more permissions than there are actual resources
         #       in a specific service. Any surplus permissions will be ignored.
-        for resource in role_resources:
-            if 'attributes' in resource:
-                # single layer
+        for name in role_resources:
+            records = self.unified_resource_records(
+                name, resources_lookup, shared_records
+            )
+            writable = writable_overrides.get(name, records['writable'])
 
-                # add default 'geometry' column to WMS/WFS attributes
-                ogc_attributes = resource['attributes'] + ['geometry']
+            if 'wms_layer' in records:
+                # single layer
 
                 # add potential WMS layer
-                wms_layers.append({
-                    'name': resource['name'],
-                    'attributes': ogc_attributes,
-                    # NOTE: dataproducts in unified permissions are queryable by default
-                    'queryable': resource.get('queryable', True),
-                    # NOTE: any info templates are always permitted
-                    'info_template': resource.get('info_template', True)
-                })
+                wms_layers.append(records['wms_layer'])
 
                 # add potential WFS layer
-                wfs_layers.append({
-                    'name': resource['name'],
-                    'attributes': ogc_attributes
-                })
+                wfs_layers.append(records['wfs_layer'])
 
                 # add potential Data service dataset
-                data_datasets.append({
-                    'name': resource['name'],
-                    # NOTE: attributes without geometry column
-                    'attributes': resource['attributes'],
-                    'writable': resource.get('writable', False),
-                    # NOTE: always readable
-                    'readable': True
-                })
+                if isinstance(writable, bool):
+                    data_datasets.append(records['data_dataset'][writable])
+                else:
+                    data_datasets.append(FrozenDict(
+                        records['data_dataset'][False], writable=writable
+                    ))
 
                 # add potential Solr facet
-                solr_facets.append(resource['name'])
+                solr_facets.append(name)
             else:
                 # add potential group layer to WMS
-                wms_layers.append({
-                    'name': resource['name']
-                })
+                wms_layers.append(records['group_layer'])
 
-            dataproducts.append(resource['name'])
+            dataproducts.append(name)
 
-            if list(resource.keys()) == ['name']:
+            if records['document_template'] and name not in writable_overrides:
                 # potential document template has no keys except 'name'
-                document_templates.append(resource['name'])
+                document_templates.append(name)
 
         # add potential internal print layers to WMS
         wms_layers += [
-            {'name': name} for name in common_resources
+            self.unified_group_layer(name, shared_records)
+            for name in common_resources
         ]
 
         # NOTE: assume single WMS service
@@ -251,59 +931,143 @@ class PermissionsReader():
 
         return full_permissions
 
-    def collect_resources(self, parent_resources, resources_lookup):
-        """Recursively collect resources from 'all_services' and return
-        flat list of permitted resources.
+    def unified_resource_records(self, name, resources_lookup,
+                                 shared_records):
+        """Return read-only permission records for a unified resource as
+            {
+                wms_layer: <WMS layer permissions>,
+                wfs_layer: <WFS layer permissions>,
+                data_dataset: {
+                    False: <read-only dataset permissions>,
+                    True: <writable dataset permissions>
+                },
+                group_layer: <WMS group layer permissions>,
+                writable: <default writable flag>,
+                document_template: <whether resource is a potential
+                                    document template>
+            }
 
-        :param list<obj> parent_resources: Parent resources
+        Records are created once and memoized in shared_records.
+
+        :param str name: Resource name
         :param obj resources_lookup: Lookup for resources with sublayers or
                                      attributes
+        :param obj shared_records: Cache for resource records
         """
-        resources = []
+        records = shared_records.get(name)
+        if records is not None:
+            return records
+
+        resource = resources_lookup.get(name, {'name': name})
+        records = {
+            'writable': resource.get('writable', False),
+            'document_template': list(resource.keys()) == ['name']
+        }
+        if 'attributes' in resource:
+            # add default 'geometry' column to WMS/WFS attributes
+            ogc_attributes = FrozenList(resource['attributes'] + ['geometry'])
+            # NOTE: attributes without geometry column
+            attributes = FrozenList(resource['attributes'])
+
+            records['wms_layer'] = FrozenDict({
+                'name': name,
+                'attributes': ogc_attributes,
+                # NOTE: dataproducts in unified permissions are queryable by default
+                'queryable': resource.get('queryable', True),
+                # NOTE: any info templates are always permitted
+                'info_template': resource.get('info_template', True)
+            })
+            records['wfs_layer'] = FrozenDict({
+                'name': name,
+                'attributes': ogc_attributes
+            })
+            records['data_dataset'] = {
+                writable: FrozenDict({
+                    'name': name,
+                    'attributes': attributes,
+                    'writable': writable,
+                    # NOTE: always readable
+                    'readable': True
+                })
+                for writable in (False, True)
+            }
+        else:
+            records['group_layer'] = FrozenDict({
+                'name': name
+            })
 
-        for resource in parent_resources:
-            # merge with any resource from lookup
-            lookup = resources_lookup.get(resource['name'], {})
-            resource.update(lookup)
+        shared_records[name] = records
+        return records
 
-            if 'processed' not in lookup:
-                # add resource
-                resources.append(resource)
-                # mark lookup as processed to skip duplicates
-                lookup['processed'] = True
-            else:
-                # skip duplicates
-                continue
+    def unified_group_layer(self, name, shared_records):
+        """Return read-only WMS group layer permissions for a resource
+        outside of the dataproducts, i.e. the WMS root layer or a common
+        resource.
 
-            if 'sublayers' in resource:
-                # recursively collect sublayers
-                sub_resources = [
-                    {'name': name} for name in resource['sublayers']
-                ]
-                resources += self.collect_resources(
-                    sub_resources, resources_lookup
-                )
+        NOTE: Memoized in shared_records separately from the records of any
+              dataproduct with the same name.
 
-        return resources
+        :param str name: Resource name
+        :param obj shared_records: Cache for resource records
+        """
+        key = ('group_layer', name)
+        group_layer = shared_records.get(key)
+        if group_layer is None:
+            group_layer = FrozenDict({'name': name})
+            shared_records[key] = group_layer
+        return group_layer
+
+    def collect_resources(self, parent_resources, resources_lookup,
+                          processed=None):
+        """Collect resources from 'all_services' including their sublayers
+        and return flat list of permitted resource names.
+
+        :param list<str> parent_resources: Parent resource names
+        :param obj resources_lookup: Lookup for resources with sublayers or
+                                     attributes
+        :param set processed: Names of already collected resources
+        """
+        if processed is None:
+            processed = set()
+
+        return walk_sublayers(parent_resources, resources_lookup, processed)
 
     # helpers
 
-    def identity_roles(self, identity):
+    def identity_roles(self, identity, lookup=None):
         """Return roles for identity.
 
         :param obj identity: User identity
+        :param obj lookup: Optional permissions lookup
+                           (default: current permissions)
         """
+        if lookup is None:
+            lookup = self.permissions
+
         # extract username and group
         username = get_username(identity)
         groups = get_groups(identity)
 
+        roles = lookup['memo'].get(
+            ('roles', username, tuple(groups)),
+            lambda: self.collect_identity_roles(lookup, username, groups)
+        )
+        return list(roles)
+
+    def collect_identity_roles(self, lookup, username, groups):
+        """Return unique sorted roles for username and groups.
+
+        :param obj lookup: Permissions lookup
+        :param str username: User name
+        :param list groups: Group names
+        """
         # add default public role
         roles = [self.PUBLIC_ROLE_NAME]
         # add any user roles
-        roles.extend(self.permissions['users'].get(username, []))
+        roles.extend(lookup['users'].get(username, []))
         # add any group roles
         for group in groups:
-            roles.extend(self.permissions['groups'].get(group, []))
+            roles.extend(lookup['groups'].get(group, []))
 
         # return unique sorted roles
         return sorted(list(set(roles)))
@@ -315,12 +1079,40 @@ class PermissionsReader():
         :param obj identity: User identity
         :param str name: Optional resource name filter
         """
+        lookup = self.permissions
+        roles = tuple(self.identity_roles(identity, lookup))
+        permissions = lookup['memo'].get(
+            ('permissions', roles, resource_key, resource_name),
+            lambda: self.collect_resource_permissions(
+                lookup, resource_key, roles, resource_name
+            )
+        )
+        # NOTE: return a copy of the memoized list
+        return list(permissions)
+
+    def collect_resource_permissions(self, lookup, resource_key, roles,
+                                     resource_name=None):
+        """Return collected list of resource permissions for roles.
+
+        :param obj lookup: Permissions lookup
+        :param str resource_key: Resource key in permissions data
+        :param list roles: Role names
+        :param str name: Optional resource name filter
+        """
         permissions = []
 
-        roles = self.identity_roles(identity)
         for role in roles:
+            if resource_name is not None:
+                # lookup permissions by resource name in index
+                name_index = self.resource_name_index(
+                    lookup, role, resource_key
+                )
+                if name_index is not None:
+                    permissions.extend(name_index.get(resource_name, []))
+                    continue
+
             # get role permissions
-            role_permissions = self.permissions['roles'].get(role, {})
+            role_permissions = lookup['roles'].get(role, {})
             # get permissions for resource key
             resource_permissions = role_permissions.get(resource_key, {})
             if resource_name is not None:
@@ -337,6 +1129,93 @@ class PermissionsReader():
 
         return permissions
 
+    def resource_permissions_by_name(self, resource_key, identity,
+                                     resource_names):
+        """Return collected resource permissions for identity roles for
+        multiple resource names as {<name>: [<permission>]}.
+
+        Identity roles and role indexes are resolved once for all names.
+
+        :param str resource_key: Resource key in permissions data
+        :param obj identity: User identity
+        :param list resource_names: Resource names
+        """
+        lookup = self.permissions
+        roles = tuple(self.identity_roles(identity, lookup))
+        return self.collect_resource_permissions_by_name(
+            lookup, resource_key, roles, resource_names
+        )
+
+    def collect_resource_permissions_by_name(self, lookup, resource_key,
+                                             roles, resource_names):
+        """Return collected resource permissions for roles for multiple
+        resource names as {<name>: [<permission>]}.
+
+        :param obj lookup: Permissions lookup
+        :param str resource_key: Resource key in permissions data
+        :param list roles: Role names
+        :param list resource_names: Resource names
+        """
+        permissions = {}
+        for resource_name in resource_names:
+            permissions[resource_name] = []
+
+        for role in roles:
+            # lookup permissions by resource name in index
+            name_index = self.resource_name_index(lookup, role, resource_key)
+            if name_index is not None:
+                for resource_name, name_permissions in permissions.items():
+                    name_permissions.extend(
+                        name_index.get(resource_name, [])
+                    )
+                continue
+
+            # get role permissions
+            role_permissions = lookup['roles'].get(role, {})
+            # get permissions for resource key
+            resource_permissions = role_permissions.get(resource_key, {})
+            # filter by resource names
+            for resource_name, name_permissions in permissions.items():
+                for permission in resource_permissions:
+                    if isinstance(permission, dict):
+                        if permission.get('name') == resource_name:
+                            name_permissions.append(permission)
+                    else:
+                        if permission == resource_name:
+                            name_permissions.append(permission)
+
+        return permissions
+
+    def resource_permissions_for_identities(self, resource_key, identities,
+                                            resource_name=None):
+        """Return collected lists of resource permissions for multiple
+        identities, in the order of the identities.
+
+        Permissions are collected once for identities with the same roles.
+
+        :param str resource_key: Resource key in permissions data
+        :param list identities: User identities
+        :param str resource_name: Optional resource name filter
+        """
+        lookup = self.permissions
+        results = []
+        collected = {}
+        for identity in identities:
+            roles = tuple(self.identity_roles(identity, lookup))
+            permissions = collected.get(roles)
+            if permissions is None:
+                permissions = lookup['memo'].get(
+                    ('permissions', roles, resource_key, resource_name),
+                    lambda: self.collect_resource_permissions(
+                        lookup, resource_key, roles, resource_name
+                    )
+                )
+                collected[roles] = permissions
+            # NOTE: return a copy of the shared list
+            results.append(list(permissions))
+
+        return results
+
     def resource_restrictions(self, resource_key, identity, subresource_filter=[]):
         """ Return list of resources which are restricted for identity roles.
 
@@ -353,36 +1232,645 @@ class PermissionsReader():
 
         # Return resources which are restricted for public and not permitted for role
 
-        identity_permissions = []
-        roles = self.identity_roles(identity)
+        lookup = self.permissions
+        roles = tuple(self.identity_roles(identity, lookup))
+        path = tuple(tuple(filter_entry) for filter_entry in subresource_filter)
+        restrictions = lookup['memo'].get(
+            ('restrictions', roles, resource_key, path),
+            lambda: self.collect_resource_restrictions(
+                lookup, resource_key, roles, path
+            )
+        )
+        # NOTE: return a copy of the memoized list
+        return list(restrictions)
+
+    def collect_resource_restrictions(self, lookup, resource_key, roles,
+                                      path):
+        """Return list of resources which are restricted for roles.
+
+        :param obj lookup: Permissions lookup
+        :param str resource_key: Resource key in permissions data
+        :param tuple roles: Role names
+        :param tuple path: (resource_name, resource_key) tuples for
+                           subresource selection
+        """
+        subresources = self.role_subresources(lookup, resource_key, path)
+
+        # collect permitted entries of roles
+        identity_permissions = set()
         for role in roles:
-            role_permissions = self.permissions['roles'].get(role, {}).get(resource_key, [])
-            for filter_entry in subresource_filter:
-                role_permissions = next(filter(
-                    lambda entry: entry.get('name') == filter_entry[0], role_permissions
-                ), {}).get(filter_entry[1], [])
-            identity_permissions.extend(role_permissions)
+            if role in subresources:
+                identity_permissions.update(subresources[role][1])
 
         if '*' in identity_permissions:
             # NOTE: No restrictions if wildcard in identity_permissions
             return []
 
         role_restrictions = []
-        for role in self.permissions['roles']:
+        for role, (role_permissions, keys) in subresources.items():
             if role == 'public':
                 continue
 
-            role_permissions = self.permissions['roles'][role].get(resource_key, [])
-            for filter_entry in subresource_filter:
-                role_permissions = next(filter(
-                    lambda entry: entry.get('name') == filter_entry[0], role_permissions
-                ), {}).get(filter_entry[1], [])
-
-            for entry in role_permissions:
-                if entry not in identity_permissions:
+            for entry, key in zip(role_permissions, keys):
+                if key not in identity_permissions:
                     role_restrictions.append(entry)
 
         return role_restrictions
 
+    def role_subresources(self, lookup, resource_key, path):
+        """Return subresource permissions of all roles as
+            {
+                <role>: ([<permission>], [<comparison key of permission>])
+            }
+
+        The result is memoized for the permissions lookup.
+
+        :param obj lookup: Permissions lookup
+        :param str resource_key: Resource key in permissions data
+        :param tuple path: (resource_name, resource_key) tuples for
+                           subresource selection
+        """
+        def collect():
+            subresources = OrderedDict()
+            for role, role_permissions in lookup['roles'].items():
+                role_permissions = role_permissions.get(resource_key, [])
+                for filter_entry in path:
+                    role_permissions = next(filter(
+                        lambda entry: entry.get('name') == filter_entry[0],
+                        role_permissions
+                    ), {}).get(filter_entry[1], [])
+                subresources[role] = (
+                    role_permissions,
+                    [comparison_key(entry) for entry in role_permissions]
+                )
+            return subresources
+
+        return lookup['memo'].get(
+            ('subresources', resource_key, path), collect
+        )
+
+    def role_bitmap(self, lookup, role, resource_key):
+        """Return bitmap of resource ids permitted for a role.
+
+        The bitmap is built on first use.
+        NOTE: Only permissions which can be indexed by name are included
+              (see resource_name_index).
+
+        :param obj lookup: Permissions lookup
+        :param str role: Role name
+        :param str resource_key: Resource key in permissions data
+        """
+        role_bitmaps = lookup['bitmaps'].get(role)
+        if role_bitmaps is None:
+            # unknown role
+            return 0
+        if resource_key in role_bitmaps:
+            return role_bitmaps[resource_key]
+
+        bitmap = 0
+        name_index = self.resource_name_index(lookup, role, resource_key)
+        if name_index is not None:
+            bitmap = lookup['resource_ids'].bitmap(
+                resource_key, name_index.keys()
+            )
+
+        role_bitmaps[resource_key] = bitmap
+        return bitmap
+
+    def roles_bitmap(self, lookup, resource_key, roles):
+        """Return union of bitmaps of resource ids permitted for roles.
+
+        The result is memoized for the permissions lookup.
+
+        :param obj lookup: Permissions lookup
+        :param str resource_key: Resource key in permissions data
+        :param tuple roles: Role names
+        """
+        def collect():
+            bitmap = 0
+            for role in roles:
+                bitmap |= self.role_bitmap(lookup, role, resource_key)
+            return bitmap
+
+        return lookup['memo'].get(('bitmap', roles, resource_key), collect)
+
+    def roles_permitted(self, lookup, resource_key, roles, resource_name):
+        """Return whether a resource is permitted for roles.
+
+        :param obj lookup: Permissions lookup
+        :param str resource_key: Resource key in permissions data
+        :param tuple roles: Role names
+        :param str resource_name: Resource name
+        """
+        # NOTE: build bitmap first, to register ids of permitted resources
+        bitmap = self.roles_bitmap(lookup, resource_key, roles)
+        resource_id = lookup['resource_ids'].id(resource_key, resource_name)
+        if resource_id is None:
+            # not permitted for any role
+            return False
+        return bool(bitmap >> resource_id & 1)
+
+    def resource_permitted(self, resource_key, identity, resource_name):
+        """Return whether a resource is permitted for identity roles.
+
+        :param str resource_key: Resource key in permissions data
+        :param obj identity: User identity
+        :param str resource_name: Resource name
+        """
+        lookup = self.permissions
+        roles = tuple(self.identity_roles(identity, lookup))
+        return self.roles_permitted(lookup, resource_key, roles, resource_name)
+
+    def permitted_resource_names(self, resource_key, identity):
+        """Return names of resources permitted for identity roles.
+
+        :param str resource_key: Resource key in permissions data
+        :param obj identity: User identity
+        """
+        lookup = self.permissions
+        roles = tuple(self.identity_roles(identity, lookup))
+        return lookup['resource_ids'].names(
+            resource_key, self.roles_bitmap(lookup, resource_key, roles)
+        )
+
+    def restricted_resource_names(self, resource_key, identity):
+        """Return names of resources which are permitted for any role except
+        public, but not for identity roles.
+
+        Note: this function is only relevant if permissions_default_allow = true
+
+        :param str resource_key: Resource key in permissions data
+        :param obj identity: User identity
+        """
+        lookup = self.permissions
+        roles = tuple(self.identity_roles(identity, lookup))
+        identity_bitmap = self.roles_bitmap(lookup, resource_key, roles)
+        if self.roles_permitted(lookup, resource_key, roles, '*'):
+            # NOTE: No restrictions if wildcard is permitted
+            return []
+
+        other_roles = tuple(
+            role for role in lookup['roles']
+            if role != self.PUBLIC_ROLE_NAME
+        )
+        others_bitmap = self.roles_bitmap(lookup, resource_key, other_roles)
+
+        return lookup['resource_ids'].names(
+            resource_key, others_bitmap & ~identity_bitmap
+        )
+
+    def resource_descendants(self, name):
+        """Return names of unified resources reachable from a resource via
+        sublayers in expansion order, or None for full permissions.
+
+        :param str name: Resource name
+        """
+        unified = self.permissions['unified']
+        if unified is None:
+            return None
+        return unified['hierarchy'].descendants(name)
+
+    def resource_ancestors(self, name):
+        """Return names of unified resources from which a resource is
+        reachable via sublayers, nearest first, or None for full permissions.
+
+        :param str name: Resource name
+        """
+        unified = self.permissions['unified']
+        if unified is None:
+            return None
+        return unified['hierarchy'].ancestors(name)
+
     def permissions_default_allow(self):
         return self.permissions['permissions_default_allow']
+
+
+def comparison_key(entry):
+    """Return hashable key of a permission entry, which is equal for
+    entries which compare equal.
+
+    :param obj entry: Permission entry
+    """
+    if isinstance(entry, dict):
+        return ('dict', frozenset(
+            (key, comparison_key(value)) for key, value in entry.items()
+        ))
+    elif isinstance(entry, list):
+        return ('list', tuple(comparison_key(value) for value in entry))
+    else:
+        return entry
+
+
+def changed_keys(previous, current):
+    """Return keys which were added, removed or changed between two dicts.
+
+    :param obj previous: Previous dict
+    :param obj current: Current dict
+    """
+    changed = set()
+    for key in previous.keys() | current.keys():
+        if key not in previous or key not in current:
+            changed.add(key)
+        elif previous[key] != current[key]:
+            changed.add(key)
+    return changed
+
+
+def pop_sections(permissions):
+    """Yield and remove (<key>, <value>) for each top-level key of
+    permissions.
+
+    :param obj permissions: Permissions from JSON
+    """
+    for key in list(permissions.keys()):
+        yield key, permissions.pop(key)
+
+
+class PermissionsMemo():
+    """Bounded LRU memo for results derived from a permissions lookup.
+
+    Each permissions lookup has its own memo, which is replaced together
+    with the lookup on reload.
+    """
+
+    def __init__(self, max_size):
+        """Constructor
+
+        :param int max_size: Max number of memoized results (0 to disable)
+        """
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, compute):
+        """Return memoized result for key or compute and memoize it.
+
+        :param tuple key: Key for result
+        :param func compute: Function without arguments returning the result
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        result = compute()
+
+        with self.lock:
+            if self.max_size:
+                self.entries[key] = result
+                if len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+
+        return result
+
+    def transfer(self, keep):
+        """Return new memo with the entries still valid for a new
+        permissions lookup.
+
+        :param func keep: Function returning whether to keep the result
+                          for a key
+        """
+        memo = PermissionsMemo(self.max_size)
+        with self.lock:
+            for key, result in self.entries.items():
+                if keep(key):
+                    memo.entries[key] = result
+        return memo
+
+
+class ResourceIds():
+    """Registry of dense integer ids for resource names of each resource key,
+    for representing sets of resources as bitmaps.
+    """
+
+    def __init__(self):
+        """Constructor"""
+        self.lock = threading.Lock()
+        # lookup for ids as {<resource_key>: {<name>: <id>}}
+        self.ids = {}
+        # resource names by id as {<resource_key>: [<name>]}
+        self.resource_names = {}
+
+    def id(self, resource_key, name):
+        """Return id of a resource, or None if not registered.
+
+        :param str resource_key: Resource key in permissions data
+        :param str name: Resource name
+        """
+        return self.ids.get(resource_key, {}).get(name)
+
+    def bitmap(self, resource_key, names):
+        """Return bitmap of resource ids for resource names, registering any
+        new names.
+
+        :param str resource_key: Resource key in permissions data
+        :param iterable names: Resource names
+        """
+        with self.lock:
+            ids = self.ids.setdefault(resource_key, {})
+            resource_names = self.resource_names.setdefault(resource_key, [])
+            bitmap = 0
+            for name in names:
+                resource_id = ids.get(name)
+                if resource_id is None:
+                    resource_id = len(resource_names)
+                    ids[name] = resource_id
+                    resource_names.append(name)
+                bitmap |= 1 << resource_id
+            return bitmap
+
+    def names(self, resource_key, bitmap):
+        """Return resource names for bitmap of resource ids, ordered by id.
+
+        :param str resource_key: Resource key in permissions data
+        :param int bitmap: Bitmap of resource ids
+        """
+        resource_names = self.resource_names.get(resource_key, [])
+        # bits ordered by id as b'\x00' or b'\x01'
+        bits = bin(bitmap)[:1:-1].encode().translate(BITS_TABLE)
+        return list(compress(resource_names, bits))
+
+    def __reduce__(self):
+        """Pickle as empty registry, as resource ids are only valid together
+        with the bitmaps built from them."""
+        return (ResourceIds, ())
+
+
+class LazyRolePermissions(Mapping):
+    """Read-only lookup for role permissions, which are expanded on first
+    access of each role.
+    """
+
+    def __init__(self, raw_roles, expand, expanded=None):
+        """Constructor
+
+        :param obj raw_roles: Raw role permissions as {<role>: <permissions>}
+        :param func expand: Function returning expanded role permissions
+                            for raw role permissions
+        :param obj expanded: Optional already expanded role permissions
+        """
+        self.raw_roles = raw_roles
+        self.expand = expand
+        self.expanded = dict(expanded or {})
+        self.lock = threading.Lock()
+
+    def __getitem__(self, role):
+        role_permissions = self.expanded.get(role)
+        if role_permissions is None:
+            raw_permissions = self.raw_roles[role]
+            with self.lock:
+                role_permissions = self.expanded.get(role)
+                if role_permissions is None:
+                    role_permissions = self.expand(raw_permissions)
+                    self.expanded[role] = role_permissions
+        return role_permissions
+
+    def __contains__(self, role):
+        return role in self.raw_roles
+
+    def __iter__(self):
+        return iter(self.raw_roles)
+
+    def __len__(self):
+        return len(self.raw_roles)
+
+
+def walk_sublayers(parent_resources, resources_lookup, processed):
+    """Return flat list of resource names in depth-first order of sublayers.
+
+    Resources in resources_lookup are collected only once, while unknown
+    resources are added for every occurrence. The walk is iterative, so that
+    deep hierarchies do not exceed the recursion limit.
+
+    :param list<str> parent_resources: Parent resource names
+    :param obj resources_lookup: Lookup for resources with sublayers or
+                                 attributes
+    :param set processed: Names of already collected resources
+    """
+    resources = []
+
+    # iterators over sublayers on current path
+    stack = [iter(parent_resources)]
+    while stack:
+        for name in stack[-1]:
+            resource = resources_lookup.get(name)
+            if resource is not None:
+                if name in processed:
+                    # skip duplicates
+                    continue
+                # mark as processed to skip duplicates
+                processed.add(name)
+
+            # add resource
+            resources.append(name)
+
+            if resource is not None and 'sublayers' in resource:
+                # continue with sublayers
+                stack.append(iter(resource['sublayers']))
+                break
+        else:
+            # all sublayers collected
+            stack.pop()
+
+    return resources
+
+
+class ResourceHierarchy():
+    """Index over the sublayer hierarchy of unified dataproducts.
+
+    The resources reachable from a resource are collected once on first use,
+    so that expanding roles only copies them instead of walking the
+    hierarchy again for every role.
+    """
+
+    def __init__(self, resources_lookup):
+        """Constructor
+
+        :param obj resources_lookup: Lookup for resources with sublayers or
+                                     attributes
+        """
+        self.resources_lookup = resources_lookup
+        # parent resources as {<name>: [<parent>]}
+        self.parents = {}
+        for name, resource in resources_lookup.items():
+            for sublayer in resource.get('sublayers') or []:
+                self.parents.setdefault(sublayer, []).append(name)
+        # sublayer references closing a cycle as [(<parent>, <sublayer>)]
+        self.cycles = self.find_cycles()
+        # resources reachable from a resource in depth-first order, with the
+        # end of the subtree of each entry as Euler tour intervals and the
+        # names of known resources
+        # as {<name>: ((<name>,), (<end index>,), {<name>})}
+        # (built on first use)
+        self.closures = {}
+
+    def find_cycles(self):
+        """Return sublayer references back to a resource on the current path
+        as [(<parent>, <sublayer>)].
+        """
+        cycles = []
+
+        # resources on current path or done
+        ON_PATH = 1
+        DONE = 2
+        state = {}
+        for root, resource in self.resources_lookup.items():
+            if root in state:
+                continue
+            state[root] = ON_PATH
+            stack = [(root, iter(resource.get('sublayers') or []))]
+            while stack:
+                name, sublayers = stack[-1]
+                for sublayer in sublayers:
+                    sublayer_resource = self.resources_lookup.get(sublayer)
+                    if sublayer_resource is None:
+                        continue
+                    sublayer_state = state.get(sublayer)
+                    if sublayer_state is None:
+                        state[sublayer] = ON_PATH
+                        stack.append((
+                            sublayer,
+                            iter(sublayer_resource.get('sublayers') or [])
+                        ))
+                        break
+                    elif sublayer_state == ON_PATH:
+                        cycles.append((name, sublayer))
+                else:
+                    state[name] = DONE
+                    stack.pop()
+
+        return cycles
+
+    def closure(self, name):
+        """Return names of resource and all resources reachable via sublayers
+        in depth-first order as in walk_sublayers, the index after the
+        subtree of each entry and the names of resources in resources_lookup,
+        as ((<name>,), (<end index>,), {<name>}).
+
+        :param str name: Resource name
+        """
+        closure = self.closures.get(name)
+        if closure is not None:
+            return closure
+
+        names = []
+        ends = []
+        processed = set()
+        # iterators over sublayers on current path with index of parent
+        stack = [(iter([name]), None)]
+        while stack:
+            sublayers, parent_index = stack[-1]
+            for sublayer in sublayers:
+                resource = self.resources_lookup.get(sublayer)
+                if resource is not None:
+                    if sublayer in processed:
+                        continue
+                    processed.add(sublayer)
+
+                names.append(sublayer)
+                ends.append(len(names))
+
+                if resource is not None and 'sublayers' in resource:
+                    stack.append(
+                        (iter(resource['sublayers']), len(names) - 1)
+                    )
+                    break
+            else:
+                stack.pop()
+                if parent_index is not None:
+                    ends[parent_index] = len(names)
+
+        closure = (tuple(names), tuple(ends), frozenset(processed))
+        self.closures[name] = closure
+        return closure
+
+    def collect(self, parent_resources):
+        """Return flat list of resource names reachable from parent resources,
+        in the same order as PermissionsReader.collect_resources.
+
+        :param list<str> parent_resources: Parent resource names
+        """
+        resources_lookup = self.resources_lookup
+        processed = set()
+        resources = []
+        for root in parent_resources:
+            resource = resources_lookup.get(root)
+            if resource is None:
+                # unknown resource without sublayers
+                resources.append(root)
+                continue
+            if root in processed:
+                continue
+            if 'sublayers' not in resource:
+                # single layer
+                processed.add(root)
+                resources.append(root)
+                continue
+
+            names, ends, known = self.closure(root)
+            if processed.isdisjoint(known):
+                resources.extend(names)
+                processed |= known
+                continue
+
+            # NOTE: all resources reachable from a processed resource are
+            #       already processed, so skipping the subtrees of processed
+            #       entries is equivalent to walking the sublayers
+            index = 0
+            count = len(names)
+            while index < count:
+                name = names[index]
+                if name in resources_lookup:
+                    if name in processed:
+                        index = ends[index]
+                        continue
+                    processed.add(name)
+                resources.append(name)
+                index += 1
+
+        return resources
+
+    def descendants(self, name):
+        """Return names of all resources reachable from a resource via
+        sublayers in depth-first order.
+
+        :param str name: Resource name
+        """
+        if name not in self.resources_lookup:
+            return []
+        # NOTE: unknown resources may occur multiple times in the closure
+        return list(dict.fromkeys(self.closure(name)[0][1:]))
+
+    def ancestors(self, name):
+        """Return names of all resources from which a resource is reachable
+        via sublayers, nearest first.
+
+        :param str name: Resource name
+        """
+        ancestors = []
+        visited = set([name])
+        pending = [name]
+        while pending:
+            next_pending = []
+            for child in pending:
+                for parent in self.parents.get(child, []):
+                    if parent not in visited:
+                        visited.add(parent)
+                        ancestors.append(parent)
+                        next_pending.append(parent)
+            pending = next_pending
+        return ancestors
+
+    def __getstate__(self):
+        """Pickle without closures, which are rebuilt on first use."""
+        state = dict(self.__dict__)
+        state['closures'] = {}
+        return state
+
+
+# classes allowed in permissions snapshots as {(<module>, <name>): <class>}
+SNAPSHOT_CLASSES = dict(SAFE_PICKLE_CLASSES)
+SNAPSHOT_CLASSES.update({
+    (cls.__module__, cls.__name__): cls
+    for cls in (ResourceIds, ResourceHierarchy)
+})
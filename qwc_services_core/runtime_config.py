@@ -1,13 +1,35 @@
+from collections.abc import Mapping
 import os
 import re
+import threading
 from flask import json
 from werkzeug.utils import safe_join
 
+from .cache import freeze
+from .json_utils import (
+    JSONReader, derived_file_path, env_flag, file_key, paused_gc,
+    read_pickle_file, write_pickle_file
+)
+
 
 class RuntimeConfig:
     '''Runtime configuration helper class
     '''
 
+    # parsed configs shared by all instances in the process
+    # as {
+    #   (<service>, <tenant>): (
+    #       <source key>, <config>, <settings>, <resource indexes>
+    #   )
+    # }
+    config_cache = {}
+    config_cache_lock = threading.Lock()
+    # counters for cached config reads
+    config_cache_counters = {'hits': 0, 'loads': 0, 'reloads': 0}
+
+    # version of config index format
+    CONFIG_INDEX_VERSION = 1
+
     @staticmethod
     def config_file_path(service, tenant):
         """Return path to permissions JSON file for a tenant.
@@ -19,47 +41,255 @@ class RuntimeConfig:
         filename = '%sConfig.json' % service
         return safe_join(config_path, tenant, filename)
 
-    def __init__(self, service, logger):
+    @staticmethod
+    def config_index_file_path(service, tenant):
+        """Return path to offset index of service config for a tenant in
+        the private cache dir, or None if not available.
+
+        :param str service: Service name
+        :param str tenant: Tenant ID
+        """
+        config_file_path = RuntimeConfig.config_file_path(service, tenant)
+        if config_file_path is None:
+            return None
+        return derived_file_path(config_file_path, '.index')
+
+    @classmethod
+    def config_cache_stats(cls):
+        """Return counters for cached config reads as
+            {
+                hits: <reads of unchanged cached configs>,
+                loads: <first reads of configs>,
+                reloads: <reads of changed configs>,
+                entries: <number of cached configs>
+            }
+        """
+        with cls.config_cache_lock:
+            stats = dict(cls.config_cache_counters)
+            stats['entries'] = len(cls.config_cache)
+        return stats
+
+    @classmethod
+    def clear_config_cache(cls):
+        """Remove all cached configs and reset counters."""
+        with cls.config_cache_lock:
+            cls.config_cache.clear()
+            for counter in cls.config_cache_counters:
+                cls.config_cache_counters[counter] = 0
+
+    def __init__(self, service, logger, cached=None, dynamic=None,
+                 lazy=None):
+        """Constructor
+
+        :param str service: Service name
+        :param Logger logger: Application logger
+        :param bool cached: Share parsed configs between all instances in
+                            the process until the config file changes.
+                            NOTE: Cached configs are read-only.
+                            (default: $RUNTIME_CONFIG_CACHE or False)
+        :param bool dynamic: Resolve env overrides of config settings on
+                             every get() instead of once on load
+                             (default: $RUNTIME_CONFIG_DYNAMIC or False)
+        :param bool lazy: Decode top-level sections and single resources of
+                          the config on first access, using an offset index
+                          stored in the private cache dir.
+                          NOTE: The config is a read-only Mapping.
+                          (default: $RUNTIME_CONFIG_LAZY_SECTIONS or False)
+        """
         self.service = service
         self.logger = logger
+        if cached is None:
+            cached = env_flag('RUNTIME_CONFIG_CACHE')
+        self.cached = cached
+        if dynamic is None:
+            dynamic = env_flag('RUNTIME_CONFIG_DYNAMIC')
+        self.dynamic = dynamic
+        if lazy is None:
+            lazy = env_flag('RUNTIME_CONFIG_LAZY_SECTIONS')
+        self.lazy = lazy
         self.config = None
+        # config settings with resolved env overrides as {<name>: <value>},
+        # or None if dynamic (read-only if cached)
+        self.settings = None
+        # resource indexes for current config (built on first use)
+        # as {(<resource>, (<field>,), <key>): <index>}
+        self.indexes = {}
 
     def set_config(self, config):
         """ Directly sets the internal config object. """
         self.config = config
+        self.settings = self.resolve_settings()
+        self.indexes = {}
         return self
 
     def read_config(self, tenant):
         """Read service config for a tenant from a JSON file.
 
+        If cached, the config is only parsed again if the file has changed.
+
         :param str tenant: Tenant ID
         """
         runtime_config_path = RuntimeConfig.config_file_path(
             self.service, tenant
         )
+
+        source_key = None
+        if self.cached or self.lazy:
+            # NOTE: get source key before reading, so that a change while
+            #       reading is detected on the next read
+            source_key = file_key(runtime_config_path)
+
+        if self.cached:
+            cache_key = (self.service, tenant)
+            with RuntimeConfig.config_cache_lock:
+                entry = RuntimeConfig.config_cache.get(cache_key)
+                if (
+                    entry is not None and source_key is not None
+                    and entry[0] == source_key
+                ):
+                    RuntimeConfig.config_cache_counters['hits'] += 1
+                    self.config = entry[1]
+                    if not self.dynamic:
+                        self.settings = entry[2]
+                    self.indexes = entry[3]
+                    return self
+
         self.logger.info(
             "Reading runtime config '%s'" % runtime_config_path
         )
         try:
             with open(runtime_config_path, encoding='utf-8') as fh:
                 data = fh.read()
+            config = None
+            if self.lazy and source_key is not None:
+                config = self.lazy_config(tenant, data, source_key)
+                if config is not None and 'config' in config:
+                    # NOTE: decode config settings on load, so that invalid
+                    #       settings fall back to an empty config as if
+                    #       not lazy
+                    config.decode('config')
+            if config is None:
                 # Replace env variables
                 dataout = ENVVAR_PATTERN.sub(envrepl, data)
-                self.config = json.loads(dataout)
+                with paused_gc():
+                    config = json.loads(dataout)
+            self.config = config
         except Exception as e:
             self.logger.error(
                 "Could not load runtime config '%s':\n%s" %
                 (runtime_config_path, e)
             )
             self.config = {}
+            self.settings = self.resolve_settings()
+            self.indexes = {}
+            return self
+
+        # NOTE: resource indexes are rebuilt on first use after a reload
+        self.indexes = {}
+        if self.cached and source_key is not None:
+            # share read-only config
+            if not isinstance(self.config, LazyJSONObject):
+                with paused_gc():
+                    self.config = freeze(self.config)
+            # NOTE: settings are always resolved for cached configs, as they
+            #       are shared with non-dynamic instances
+            settings = self.resolve_settings(force=True)
+            with RuntimeConfig.config_cache_lock:
+                if entry is None:
+                    RuntimeConfig.config_cache_counters['loads'] += 1
+                else:
+                    RuntimeConfig.config_cache_counters['reloads'] += 1
+                RuntimeConfig.config_cache[cache_key] = (
+                    source_key, self.config, settings, self.indexes
+                )
+            if not self.dynamic:
+                self.settings = settings
+        else:
+            self.settings = self.resolve_settings()
+
         return self
 
+    def lazy_config(self, tenant, data, source_key):
+        """Return config with top-level sections and resources decoded on
+        first access, or None if the config could not be indexed.
+
+        :param str tenant: Tenant ID
+        :param str data: Raw config JSON
+        :param tuple source_key: Key of config file
+        """
+        index_path = RuntimeConfig.config_index_file_path(
+            self.service, tenant
+        )
+        index_key = (RuntimeConfig.CONFIG_INDEX_VERSION, source_key)
+
+        try:
+            index = read_pickle_file(index_path, index_key)
+        except Exception as e:
+            self.logger.warning(
+                "Could not load runtime config index '%s':\n%s" %
+                (index_path, e)
+            )
+            index = None
+        if index is None:
+            try:
+                index = build_config_index(data)
+            except Exception as e:
+                self.logger.warning(
+                    "Could not index runtime config, reading it as a "
+                    "whole:\n%s" % e
+                )
+                return None
+            # NOTE: index is rebuilt on every load if it can not be written
+            if write_pickle_file(index_path, index_key, index):
+                self.logger.info(
+                    "Wrote runtime config index '%s'" % index_path
+                )
+
+        nested = {}
+        if index['resources'] is not None:
+            nested['resources'] = index['resources']
+        return LazyJSONObject(
+            data, index['sections'], frozen=self.cached, nested=nested,
+            logger=self.logger
+        )
+
     def tenant_config(self, tenant):
         return self.read_config(tenant)
 
-    def get(self, name, default=None):
-        val = self.config.get('config', {}).get(name, default)
-        # Optional override from env var
+    def resolve_settings(self, force=False):
+        """Return config settings with env overrides resolved and converted
+        once, or None if dynamic.
+
+        Conversion errors are logged on load instead of on every get().
+
+        NOTE: Settings are read-only if cached, as they are shared between
+              instances.
+
+        :param bool force: Resolve settings even if dynamic
+        """
+        if self.dynamic and not force:
+            return None
+
+        config = None
+        if isinstance(self.config, Mapping):
+            config = self.config.get('config', {})
+        if not isinstance(config, Mapping):
+            # NOTE: fall back to dynamic lookups for invalid configs
+            return None
+
+        settings = {}
+        for name, val in config.items():
+            settings[name] = self.resolve_setting(name, val)
+        if self.cached:
+            return freeze(settings)
+        return settings
+
+    def resolve_setting(self, name, val):
+        """Return config setting with optional override from env var.
+
+        :param str name: Setting name
+        :param obj val: Setting value from config or default value
+        """
         envval = os.environ.get(name.upper())
         if envval is not None:
             # Convert from string
@@ -67,7 +297,7 @@ class RuntimeConfig:
                 if val is None:
                     # unkown type --> no conversion
                     val = envval
-                elif type(val) in (list, dict):
+                elif isinstance(val, (list, dict)):
                     val = json.loads(envval)
                 elif type(val) is bool:
                     # convert string to boolean
@@ -99,12 +329,91 @@ class RuntimeConfig:
 
         return val
 
+    def get(self, name, default=None):
+        if self.settings is not None:
+            if name in self.settings:
+                return self.settings[name]
+            # NOTE: settings missing in config are resolved from their
+            #       default value
+            return self.resolve_setting(name, default)
+
+        val = self.config.get('config', {}).get(name, default)
+        # Optional override from env var
+        return self.resolve_setting(name, val)
+
     def resources(self):
         return self.config.get('resources')
 
     def resource(self, name):
         return self.config.get('resources', {}).get(name)
 
+    def resource_index(self, name, fields=(), key='name', sublayers=None):
+        """Return lookup for items of a resource by the names of the items
+        along a path of nested fields, as {(<name>,): <item>}.
+
+        Items are taken from lists of items, or from single items if a field
+        contains a dict with a name. Fields may be tuples of keys of nested
+        dicts, as may be the resource name for dict-valued resources.
+
+        The index is built on first use and shared until the config is
+        reloaded. If names are not unique, the first item in document order
+        wins.
+
+        E.g.
+            resource_index('wms_services', ['layers']) returns
+                {(<service name>, <layer name>): <layer>}
+            resource_index('wms_services', ['root_layer'], sublayers='layers')
+            returns all layers of group layers as
+                {(<service name>, <layer name>): <layer>}
+            resource_index(('qwc2_themes', 'themes', 'items')) returns
+                {(<theme name>,): <theme>}
+
+        :param str|tuple name: Resource name, or resource name followed by
+                               keys of nested dicts
+        :param list fields: Nested fields of items, as keys or tuples of
+                            keys of nested dicts
+        :param str key: Field with item names
+        :param str sublayers: Optional field with sublayers of the items of
+                              the last field, which are indexed recursively
+                              with the same parent names
+        """
+        index_key = (name, tuple(fields), key, sublayers)
+        index = self.indexes.get(index_key)
+        if index is None:
+            # NOTE: concurrent threads may build the same index
+            if isinstance(name, tuple):
+                value = field_value(self.resource(name[0]), name[1:])
+            else:
+                value = self.resource(name)
+            index = build_resource_index(value, fields, key, sublayers)
+            self.indexes[index_key] = index
+        return index
+
+    def resource_item(self, name, *path, sublayers=None):
+        """Return item of a resource by its path of item names and nested
+        fields, or None if not found.
+
+        E.g.
+            resource_item('wms_services', 'qwc_demo', 'layers', 'countries')
+            returns the layer 'countries' of the WMS 'qwc_demo', and
+            resource_item(
+                'wms_services', 'qwc_demo', 'root_layer', 'countries',
+                sublayers='layers'
+            )
+            returns it from any group layer of the WMS.
+
+        :param str|tuple name: Resource name, or resource name followed by
+                               keys of nested dicts
+        :param list path: Item names alternating with fields
+        :param str sublayers: Optional field with sublayers of the items of
+                              the last field (see resource_index)
+        """
+        if len(path) % 2 == 0:
+            raise ValueError("Expecting item name after each field")
+        return self.resource_index(
+            name, path[1::2], sublayers=sublayers
+        ).get(path[0::2])
+
 
 ENVVAR_PATTERN = re.compile(r'\$\$(\w+)\$\$')
 
@@ -113,3 +422,235 @@ def envrepl(match):
     name = match.group(1)
     val = os.environ.get(name, '')
     return val
+
+
+def field_value(value, field):
+    """Return value of a field of a dict, or None if not found.
+
+    :param obj value: Dict
+    :param str|tuple field: Field name, or keys of nested dicts
+    """
+    if not isinstance(field, tuple):
+        field = (field,)
+    for key in field:
+        if not isinstance(value, Mapping):
+            return None
+        value = value.get(key)
+    return value
+
+
+def named_items(value, key):
+    """Return list of items in a list, or a single item in a dict with a
+    name.
+
+    :param obj value: List of items or single item
+    :param str key: Field with item names
+    """
+    if isinstance(value, list):
+        return value
+    elif isinstance(value, Mapping) and key in value:
+        return [value]
+    return []
+
+
+def build_resource_index(value, fields, key, sublayers=None):
+    """Return lookup for items by the names of the items along a path of
+    nested fields, as {(<name>,): <item>}.
+
+    :param obj value: Resource items as list, or single resource item
+    :param list fields: Nested fields of items, as keys or tuples of keys
+                        of nested dicts
+    :param str key: Field with item names
+    :param str sublayers: Optional field with sublayers of the items of the
+                          last field, which are indexed recursively with the
+                          same parent names
+    """
+    index = {}
+
+    # iterators over items on current path in document order
+    # as [(<names of parents>, <depth>, <items>)]
+    stack = [((), 0, iter(named_items(value, key)))]
+    while stack:
+        names, depth, items = stack[-1]
+        for item in items:
+            if not isinstance(item, Mapping):
+                continue
+            item_name = item.get(key)
+            if not isinstance(item_name, str):
+                continue
+            if depth < len(fields):
+                # continue with nested items
+                stack.append((
+                    names + (item_name,), depth + 1,
+                    iter(named_items(field_value(item, fields[depth]), key))
+                ))
+                break
+
+            index.setdefault(names + (item_name,), item)
+            if sublayers is not None and sublayers in item:
+                # continue with sublayers
+                stack.append((
+                    names, depth, iter(named_items(item[sublayers], key))
+                ))
+                break
+        else:
+            # all items collected
+            stack.pop()
+
+    return index
+
+
+def placeholder_repl(match):
+    """Return JSON number of the same length as an env placeholder."""
+    return '1' + '0' * (len(match.group(0)) - 1)
+
+
+def member_key(data, key, key_span):
+    """Return key of a JSON object member with replaced env placeholders.
+
+    :param str data: Raw config JSON
+    :param str key: Decoded key
+    :param tuple key_span: Offsets of raw key as (<start>, <end>)
+    """
+    raw_key = data[key_span[0]:key_span[1]]
+    if '$$' in raw_key:
+        # Replace env variables in key
+        key = json.loads(ENVVAR_PATTERN.sub(envrepl, raw_key))
+    return key
+
+
+def json_object_offsets(data, reader):
+    """Return offsets of the member values of the JSON object at the
+    current position of a reader as {<key>: (<start>, <end>)}.
+
+    :param str data: Raw config JSON
+    :param JSONReader reader: Reader for raw config JSON with replaced env
+                              placeholders
+    """
+    members = {}
+    for key, key_span in reader.members():
+        start = reader.position()
+        reader.decode()
+        members[member_key(data, key, key_span)] = (start, reader.position())
+    return members
+
+
+def build_config_index(data):
+    """Return offsets of top-level sections and of resources in raw config
+    JSON as
+        {
+            sections: {<key>: (<start>, <end>)},
+            resources: {<name>: (<start>, <end>)}
+        }
+    with resources set to None if they are not an object.
+
+    NOTE: Env placeholders are replaced by JSON numbers of the same length
+          for indexing, so that offsets are valid for the raw data.
+
+    :param str data: Raw config JSON
+    """
+    reader = JSONReader(ENVVAR_PATTERN.sub(placeholder_repl, data))
+    sections = {}
+    resources = None
+
+    for key, key_span in reader.members():
+        key = member_key(data, key, key_span)
+        start = reader.position()
+        if key == 'resources':
+            # NOTE: last duplicate key wins as in json.loads
+            resources = None
+            if reader.peek() == '{':
+                resources = json_object_offsets(data, reader)
+            else:
+                reader.decode()
+        else:
+            reader.decode()
+        sections[key] = (start, reader.position())
+    reader.expect_end()
+
+    return {
+        'sections': sections,
+        'resources': resources
+    }
+
+
+class LazyJSONObject(Mapping):
+    """Read-only lookup for the members of a JSON object in raw config JSON,
+    which are env-substituted and decoded on first access.
+
+    Members which can not be decoded are logged and treated as missing.
+    """
+
+    def __init__(self, data, offsets, frozen=False, nested=None,
+                 logger=None):
+        """Constructor
+
+        :param str data: Raw config JSON
+        :param obj offsets: Offsets of member values as
+                            {<key>: (<start>, <end>)}
+        :param bool frozen: Return read-only values
+        :param obj nested: Offsets of members of nested objects, which are
+                           decoded lazily as well, as {<key>: <offsets>}
+        :param Logger logger: Optional logger for decoding errors
+        """
+        self.data = data
+        self.offsets = offsets
+        self.frozen = frozen
+        self.nested = nested or {}
+        self.logger = logger
+        self.values = {}
+        # keys of members which could not be decoded
+        self.invalid = set()
+        self.lock = threading.Lock()
+
+    def decode(self, key):
+        """Return decoded value of a member, raising any decoding errors.
+
+        :param str key: Member key
+        """
+        if key in self.values:
+            return self.values[key]
+
+        start, end = self.offsets[key]
+        with self.lock:
+            if key not in self.values:
+                if key in self.nested:
+                    value = LazyJSONObject(
+                        self.data, self.nested[key], self.frozen,
+                        logger=self.logger
+                    )
+                else:
+                    # Replace env variables
+                    value = json.loads(
+                        ENVVAR_PATTERN.sub(envrepl, self.data[start:end])
+                    )
+                    if self.frozen:
+                        value = freeze(value)
+                self.values[key] = value
+        return self.values[key]
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+        if key in self.invalid or key not in self.offsets:
+            raise KeyError(key)
+
+        try:
+            return self.decode(key)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error(
+                    "Could not load runtime config section '%s':\n%s" %
+                    (key, e)
+                )
+            self.invalid.add(key)
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.offsets and key not in self.invalid
+
+    def __iter__(self):
+        return (key for key in self.offsets if key not in self.invalid)
+
+    def __len__(self):
+        return len(self.offsets) - len(self.invalid)
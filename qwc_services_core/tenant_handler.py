@@ -4,6 +4,7 @@ import re
 from flask import request
 from flask.sessions import SecureCookieSessionInterface
 
+from .config_watcher import ConfigWatcher
 from .permissions_reader import PermissionsReader
 from .runtime_config import RuntimeConfig
 
@@ -72,19 +73,36 @@ class TenantHandlerBase:
 class TenantHandler(TenantHandlerBase):
     """Tenant handler with configuraton cache"""
 
-    def __init__(self, logger):
+    def __init__(self, logger, config_db_monitor=None, config_watcher=None):
         """Constructor
 
         :param Logger logger: Application logger
+        :param ConfigDBMonitor config_db_monitor: Optional monitor for
+                                                  detecting ConfigDB changes
+        :param ConfigWatcher config_watcher: Optional watcher for detecting
+                                             config file changes
+                                             (default: shared watcher unless
+                                             $CONFIG_WATCH_MODE is 'off')
         """
         TenantHandlerBase.__init__(self)
         self.logger = logger
+        self.config_db_monitor = config_db_monitor
+        if config_watcher is None:
+            config_watcher = ConfigWatcher.shared(logger)
+        self.config_watcher = config_watcher
         self.handler_cache = {}  # handler_cache[handler_name][tenant]
+        # config file and ConfigDB generations before creating handlers
+        # as {(<handler_name>, <tenant>): (<config generation>, <generation>)}
+        self.pending_generations = {}
 
     def handler(self, service_name, handler_name, tenant):
         """Get service handler for tenant.
 
-        Return None if not yet registered or if config files have changed.
+        Return None if not yet registered or if config files or ConfigDB
+        have changed.
+
+        Config file changes are detected by the config watcher, or by
+        checking the file timestamps on every call if disabled.
 
         :param str service_name: Service name
                                  (used for detecting config changes)
@@ -96,8 +114,23 @@ class TenantHandler(TenantHandlerBase):
             handler = handlers.get(tenant)
             if handler:
                 # check for config updates
-                last_update = self.last_config_update(service_name, tenant)
-                if last_update and last_update < handler.get('last_update'):
+                if self.config_watcher is not None:
+                    up_to_date = self.config_watcher.generation(
+                        service_name, tenant
+                    ) == handler.get('config_generation')
+                else:
+                    last_update = self.last_config_update(
+                        service_name, tenant
+                    )
+                    up_to_date = (
+                        last_update is not None
+                        and last_update < handler.get('last_update')
+                    )
+                if (
+                    up_to_date and self.config_db_generation() == handler.get(
+                        'generation'
+                    )
+                ):
                     # cache is up-to-date
                     return handler.get('handler')
                 else:
@@ -105,6 +138,17 @@ class TenantHandler(TenantHandlerBase):
                     if tenant in handlers:
                         del handlers[tenant]
 
+        # NOTE: keep generations before the handler reads its config,
+        #       so that changes while reading are detected
+        config_generation = None
+        if self.config_watcher is not None:
+            config_generation = self.config_watcher.generation(
+                service_name, tenant
+            )
+        self.pending_generations[(handler_name, tenant)] = (
+            config_generation, self.config_db_generation()
+        )
+
         return None
 
     def register_handler(self, handler_name, tenant, handler):
@@ -118,12 +162,31 @@ class TenantHandler(TenantHandlerBase):
         except:
             # Python < 3.11 fallback
             now = datetime.datetime.utcnow()
+        pending = self.pending_generations.pop((handler_name, tenant), None)
+        if pending is not None:
+            config_generation, generation = pending
+        else:
+            # handler registered without prior lookup
+            config_generation = None
+            if self.config_watcher is not None:
+                config_generation = self.config_watcher.tenant_generation(
+                    tenant
+                )
+            generation = self.config_db_generation()
         handlers[tenant] = {
             'handler': handler,
-            'last_update': now
+            'last_update': now,
+            'generation': generation,
+            'config_generation': config_generation
         }
         return handler
 
+    def config_db_generation(self):
+        """Return current ConfigDB generation, or None if not monitored."""
+        if self.config_db_monitor is None:
+            return None
+        return self.config_db_monitor.generation()
+
     def last_config_update(self, service_name, tenant):
         """Return latest timestamp of config and permission files for a tenant.
 
@@ -0,0 +1,117 @@
+"""Benchmark of PermissionsReader.resource_restrictions against the previous
+linear algorithm on synthetic permissions.
+
+Usage:
+    PYTHONPATH=. python tests/benchmark_resource_restrictions.py [--roles 500]
+        [--layers 20000] [--layers-per-role 100] [--identities 5]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+from qwc_services_core.permissions_reader import PermissionsReader
+from test_permissions_parity import linear_resource_restrictions
+
+
+def synthetic_permissions(n_roles, n_layers, layers_per_role, seed=0):
+    """Return default allow permissions with random layers per role."""
+    rnd = random.Random(seed)
+    layers = ['layer%d' % i for i in range(n_layers)]
+    roles = ['public'] + ['role%d' % i for i in range(1, n_roles)]
+    return {
+        'users': [
+            {'name': 'u%d' % i, 'groups': [], 'roles': rnd.sample(roles[1:], 3)}
+            for i in range(100)
+        ],
+        'groups': [],
+        'roles': [
+            {'role': role, 'permissions': {
+                'wms_services': [{'name': 'wms', 'layers': [
+                    {'name': layer, 'attributes': ['a', 'b', 'geometry']}
+                    for layer in rnd.sample(layers, layers_per_role)
+                ]}],
+                'viewer_tasks': rnd.sample(
+                    ['task%d' % i for i in range(50)], 10
+                )
+            }}
+            for role in roles
+        ],
+        'permissions_default_allow': True
+    }
+
+
+def timed(fn, *args):
+    """Return result and duration in seconds of fn(*args)."""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--roles', type=int, default=500)
+    parser.add_argument('--layers', type=int, default=20000)
+    parser.add_argument('--layers-per-role', type=int, default=100)
+    parser.add_argument('--identities', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as config_path:
+        os.environ['CONFIG_PATH'] = config_path
+        os.mkdir(os.path.join(config_path, 'default'))
+        with open(
+            os.path.join(config_path, 'default', 'permissions.json'), 'w'
+        ) as fh:
+            json.dump(synthetic_permissions(
+                args.roles, args.layers, args.layers_per_role
+            ), fh)
+
+        reader, duration = timed(
+            PermissionsReader, 'default', logging.getLogger(__name__)
+        )
+        print("Loaded %d roles with %d layers in %.3fs" % (
+            args.roles, args.layers, duration
+        ))
+
+    calls = [
+        ('viewer_tasks', []),
+        ('wms_services', [('wms', 'layers')])
+    ]
+    for resource_key, subresource_filter in calls:
+        linear_total = 0
+        first_total = 0
+        memo_total = 0
+        for i in range(args.identities):
+            identity = {'username': 'u%d' % i}
+            expected, duration = timed(
+                linear_resource_restrictions, reader, resource_key, identity,
+                subresource_filter
+            )
+            linear_total += duration
+            # first call builds per-role sets, repeated call is memoized
+            for attr in ('first', 'memo'):
+                result, duration = timed(
+                    reader.resource_restrictions, resource_key, identity,
+                    subresource_filter
+                )
+                assert result == expected
+                if attr == 'first':
+                    first_total += duration
+                else:
+                    memo_total += duration
+
+        n = args.identities
+        print(
+            "%s %s: linear %.4fs, sets %.4fs (%.0fx), memoized %.6fs" % (
+                resource_key, subresource_filter, linear_total / n,
+                first_total / n, linear_total / max(first_total, 1e-9),
+                memo_total / n
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,480 @@
+import copy
+import datetime
+import os
+import pickle
+import stat
+import sys
+import threading
+import time
+
+import pytest
+
+from qwc_services_core.cache import (
+    Cache, FrozenDict, LRUCache, SQLiteCache, freeze, private_cache_dir,
+    safe_dumps, thaw
+)
+
+
+class Exploit:
+    """Value executing code when unpickled."""
+
+    def __reduce__(self):
+        return (os.system, ('true',))
+
+
+@pytest.fixture
+def tmpdir_env(tmp_path, monkeypatch):
+    monkeypatch.setenv('TMPDIR', str(tmp_path))
+    monkeypatch.setattr('tempfile.tempdir', None)
+    return tmp_path
+
+
+def test_default_sqlite_path_is_private(tmpdir_env, monkeypatch):
+    monkeypatch.setenv('CACHE_BACKEND', 'sqlite')
+    monkeypatch.delenv('CACHE_PATH', raising=False)
+
+    cache = Cache()
+    cache.write('svc', None, ['a'], {'b': 1}, 60)
+    assert cache.read('svc', None, ['a']) == {'b': 1}
+
+    cache_dir = tmpdir_env / ('qwc_services_cache-%d' % os.getuid())
+    assert stat.S_IMODE(os.stat(cache_dir).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(cache_dir / 'cache.db').st_mode) == 0o600
+
+
+def test_shared_cache_dir_is_rejected(tmpdir_env):
+    cache_dir = tmpdir_env / ('qwc_services_cache-%d' % os.getuid())
+    cache_dir.mkdir()
+    os.chmod(cache_dir, 0o777)
+
+    with pytest.raises(Exception, match='not private'):
+        private_cache_dir()
+
+
+def test_sqlite_loads_plain_data_only(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.db'))
+
+    value = {
+        'list': [1, 2.5, None], 'tuple': (1, 'a'), 'set': {1, 2},
+        'frozen': FrozenDict({'a': [1]}),
+        'date': datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)
+    }
+    cache.set(('svc', 'a'), value)
+    assert cache.lookup(('svc', 'a')) == {'value': value}
+
+    # values of other classes are not cached
+    cache.set(('svc', 'b'), Exploit())
+    assert cache.lookup(('svc', 'b')) is None
+    cache.set(('svc', 'b'), {'nested': [Exploit]})
+    assert cache.lookup(('svc', 'b')) is None
+
+    # planted value is not loaded
+    conn = cache.connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO cache (key, value, expires, keep_until, size) "
+            "VALUES (?, ?, 1e12, 1e12, 0)",
+            (cache.db_key(('svc', 'c')), pickle.dumps(Exploit()))
+        )
+    assert cache.lookup(('svc', 'c')) is None
+    assert conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] == 1
+
+
+def test_memory_budget_is_shared_by_segments():
+    cache = LRUCache(max_entries=0, max_bytes=10000000)
+    assert len(cache.segments) == 16
+
+    # value larger than a 16th of the budget
+    cache.set(('svc', 'large'), 'x' * 1400000)
+    assert cache.lookup(('svc', 'large')) is not None
+
+    for i in range(100):
+        cache.set(('svc', i), 'y' * 200000)
+        assert cache.total_bytes <= cache.max_bytes
+    # least recently used entries are evicted first
+    assert cache.lookup(('svc', 'large')) is None
+    assert cache.lookup(('svc', 0)) is None
+    assert cache.lookup(('svc', 99)) is not None
+    assert len(cache) >= 40
+
+    # value larger than the whole cache is skipped
+    cache.set(('svc', 'huge'), 'z' * 10000001)
+    assert cache.lookup(('svc', 'huge')) is None
+
+
+class MissOnceBackend(LRUCache):
+    """LRU cache backend which misses on the first lookup of a key."""
+
+    def __init__(self):
+        super().__init__()
+        self.looked_up = set()
+
+    def lookup(self, key, mutable=False, stale=False):
+        if key not in self.looked_up:
+            self.looked_up.add(key)
+            return None
+        return super().lookup(key, mutable, stale)
+
+
+def test_get_or_compute_checks_cache_as_leader():
+    # value stored by a previous leader after the first lookup
+    cache = Cache(backend=MissOnceBackend())
+    cache.write('svc', None, ['a'], 'cached', 60)
+
+    def compute():
+        raise AssertionError("computed again")
+
+    assert cache.get_or_compute('svc', None, ['a'], compute, 60) == 'cached'
+
+
+def test_get_or_compute_passes_base_exceptions_to_waiters():
+    cache = Cache()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def compute():
+        started.set()
+        release.wait()
+        raise SystemExit(1)
+
+    def call():
+        try:
+            cache.get_or_compute('svc', None, ['a'], compute, 60)
+        except BaseException as e:
+            errors.append(type(e))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    waiter = threading.Thread(target=call)
+    waiter.start()
+    # let waiter wait for the pending computation
+    time.sleep(0.1)
+    release.set()
+    leader.join()
+    waiter.join()
+
+    assert errors == [SystemExit, SystemExit]
+
+
+@pytest.mark.parametrize('frozen', [False, True])
+def test_concurrent_access(frozen):
+    cache = Cache(max_entries=0, max_bytes=0, frozen=frozen)
+    n_threads = 16
+    n_ops = 500
+    barrier = threading.Barrier(n_threads)
+    computed = {}
+    computed_lock = threading.Lock()
+    errors = []
+
+    def compute(key):
+        with computed_lock:
+            computed[key] = computed.get(key, 0) + 1
+        time.sleep(0.001)
+        return {'key': key}
+
+    def run(i):
+        try:
+            barrier.wait()
+            for j in range(n_ops):
+                # own keys are never lost
+                cache.write('own', 'u%d' % i, [j], [i, j], 60)
+                assert cache.read('own', 'u%d' % i, [j]) == [i, j]
+
+                # shared keys only contain written values
+                k = j % 10
+                cache.write('shared', None, [k], {'k': k, 'i': i}, 60)
+                value = cache.read('shared', None, [k])
+                assert value is None or value['k'] == k
+
+                # shared computations are coalesced
+                k = j % 50
+                assert cache.get_or_compute(
+                    'computed', None, [k], lambda: compute(k), 60
+                ) == {'key': k}
+
+                if j % 100 == 0:
+                    cache.invalidate(service='shared')
+        except Exception as e:
+            errors.append(e)
+
+    old_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [
+            threading.Thread(target=run, args=(i,)) for i in range(n_threads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(old_interval)
+
+    assert errors == []
+    assert computed == {k: 1 for k in range(50)}
+    for i in range(n_threads):
+        for j in range(n_ops):
+            assert cache.read('own', 'u%d' % i, [j]) == [i, j]
+
+    # consistent accounting of segments
+    for segment in cache.cache.segments:
+        assert segment.total_bytes == sum(
+            entry[2] for entry in segment.entries.values()
+        )
+        for tag, keys in segment.tag_index.items():
+            assert keys <= set(segment.entries)
+
+
+def test_stats_of_finished_threads_are_folded():
+    cache = Cache()
+
+    def run():
+        cache.read('svc', None, ['a'])
+
+    for i in range(50):
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+    assert len(cache.stats.thread_counters) == 0
+    assert cache.stats_snapshot()['svc']['a']['misses'] == 50
+
+    cache.stats.reset()
+    assert cache.stats_snapshot() == {}
+
+
+@pytest.mark.parametrize('max_entries', [1, 15, 100, 20000])
+def test_entry_budget_is_not_exceeded(max_entries):
+    cache = LRUCache(max_entries=max_entries)
+    assert sum(
+        segment.max_entries for segment in cache.segments
+    ) == max_entries
+
+    for i in range(max_entries * 3):
+        cache.set(('svc', i), i)
+        assert len(cache) <= max_entries
+    # most recently set entry is kept
+    assert cache.lookup(('svc', max_entries * 3 - 1)) == {
+        'value': max_entries * 3 - 1
+    }
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(max_entries=3)
+    for key in 'abc':
+        cache.set(('svc', key), key)
+    cache.lookup(('svc', 'a'))
+    cache.set(('svc', 'd'), 'd')
+
+    assert cache.lookup(('svc', 'b')) is None
+    for key in 'acd':
+        assert cache.lookup(('svc', key)) == {'value': key}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Manually advanced clock of the cache."""
+    now = [1000.0]
+    monkeypatch.setattr('qwc_services_core.cache.time.time', lambda: now[0])
+    return now
+
+
+def test_expired_entries_are_removed_proactively(clock):
+    cache = LRUCache(stripes=1)
+    for i in range(10):
+        cache.set(('svc', i), i, duration=10 + i)
+    cache.set(('svc', 'stale'), 'x', duration=10, stale_duration=10)
+    assert len(cache) == 11
+
+    clock[0] += 15
+    # expired entries of all keys in a segment are removed on access of
+    # any key
+    assert cache.lookup(('svc', 9)) == {'value': 9}
+    assert len(cache) == 5
+    assert cache.lookup(('svc', 5)) is None
+    assert cache.lookup(('svc', 6)) == {'value': 6}
+
+    # expired entry is kept for stale lookups
+    assert cache.lookup(('svc', 'stale')) is None
+    assert cache.lookup(('svc', 'stale'), stale=True) == {
+        'value': 'x', 'stale': True
+    }
+    clock[0] += 5
+    cache.purge_expired()
+    assert cache.lookup(('svc', 'stale'), stale=True) is None
+    assert len(cache) == 0
+
+
+def test_overwritten_entry_keeps_new_expiry(clock):
+    cache = LRUCache(stripes=1)
+    cache.set(('svc', 'a'), 1, duration=10)
+    cache.set(('svc', 'a'), 2, duration=100)
+
+    clock[0] += 50
+    # queue item of the overwritten entry is skipped
+    cache.purge_expired()
+    assert cache.lookup(('svc', 'a')) == {'value': 2}
+
+    # queue is compacted
+    for i in range(200):
+        cache.set(('svc', 'a'), i, duration=100)
+    segment = cache.segments[0]
+    assert len(segment.expiry_queue) <= 2 * len(segment.entries) + 64
+
+
+FROZEN_VALUE = {
+    'list': [1, {'a': [2, 3]}], 'tuple': (1, [2]), 'set': {1, 2},
+    'date': datetime.date(2020, 1, 2)
+}
+
+
+def test_frozen_values_are_read_only():
+    value = freeze(FROZEN_VALUE)
+    assert value == FROZEN_VALUE
+    assert isinstance(value, dict) and isinstance(value['list'], list)
+
+    for modify in [
+        lambda: value.__setitem__('b', 1),
+        lambda: value.__delitem__('list'),
+        lambda: value.update({'b': 1}),
+        lambda: value.setdefault('b', 1),
+        lambda: value.pop('list'),
+        lambda: value.clear(),
+        lambda: value['list'].append(4),
+        lambda: value['list'].__setitem__(0, 4),
+        lambda: value['list'].sort(),
+        lambda: value['list'][1]['a'].extend([4]),
+        lambda: value['tuple'][1].append(4)
+    ]:
+        with pytest.raises(TypeError, match='read-only'):
+            modify()
+    with pytest.raises(TypeError):
+        value['list'] += [4]
+    assert isinstance(value['set'], frozenset)
+    assert value == FROZEN_VALUE
+
+    # already frozen values are not copied
+    assert freeze(value) is value
+
+
+def test_thawed_values_are_mutable_copies():
+    value = freeze(FROZEN_VALUE)
+    for copy_ in [thaw(value), copy.deepcopy(value)]:
+        assert copy_ == FROZEN_VALUE
+        assert type(copy_) is dict and type(copy_['list']) is list
+        assert type(copy_['list'][1]) is dict
+        assert type(copy_['set']) is set
+        copy_['list'][1]['a'].append(4)
+        copy_['tuple'][1].append(3)
+    assert value == FROZEN_VALUE
+
+    # shallow copies are mutable
+    assert type(copy.copy(value)) is dict
+    assert type(copy.copy(value['list'])) is list
+
+
+def test_frozen_values_of_memory_cache_can_be_pickled():
+    cache = Cache(frozen=True)
+    assert isinstance(cache.cache, LRUCache)
+    cache.write('svc', None, ['a'], FROZEN_VALUE, 60)
+
+    value = cache.read('svc', None, ['a'])
+    assert value == FROZEN_VALUE
+    # shared read-only value
+    assert cache.read('svc', None, ['a']) is value
+    assert type(cache.read('svc', None, ['a'], mutable=True)) is dict
+
+    for data in [pickle.dumps(value), safe_dumps(value)]:
+        loaded = pickle.loads(data)
+        assert loaded == FROZEN_VALUE
+        assert type(loaded) is FrozenDict
+        assert type(loaded['list'][1]) is FrozenDict
+        with pytest.raises(TypeError, match='read-only'):
+            loaded['list'].append(4)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    """Factory for cache backends of each type."""
+    def create(**kwargs):
+        if request.param == 'sqlite':
+            return SQLiteCache(str(tmp_path / 'cache.db'), **kwargs)
+        return LRUCache(stripes=1, **kwargs)
+    return create
+
+
+def backend_tags(backend):
+    """Return tags indexed by a cache backend as {<tag>: <number of keys>}.
+    """
+    if isinstance(backend, SQLiteCache):
+        return dict(backend.connection().execute(
+            "SELECT tag, COUNT(*) FROM cache_tags GROUP BY tag"
+        ).fetchall())
+    return {
+        tag: len(keys)
+        for segment in backend.segments
+        for tag, keys in segment.tag_index.items()
+    }
+
+
+def test_invalidate_by_tags(backend):
+    cache = Cache(backend=backend())
+    for tenant in ['t1', 't2']:
+        cache.write('ogc', 'admin', [tenant], 1, 60, tags={'tenant': tenant})
+        cache.write('ogc', 'demo', [tenant], 2, 60, tags={'tenant': tenant})
+        cache.write('data', 'admin', [tenant], 3, 60, tags={'tenant': tenant})
+
+    assert cache.invalidate(tenant='t1') == 3
+    assert cache.read('ogc', 'admin', ['t1']) is None
+    assert cache.read('data', 'admin', ['t1']) is None
+    assert cache.read('ogc', 'admin', ['t2']) == 1
+
+    # entries with all of the tags
+    assert cache.invalidate(service='ogc', username='admin') == 1
+    assert cache.read('ogc', 'admin', ['t2']) is None
+    assert cache.read('ogc', 'demo', ['t2']) == 2
+    assert cache.read('data', 'admin', ['t2']) == 3
+
+    assert cache.invalidate(tenant='t1') == 0
+    assert cache.invalidate(tenant='unknown') == 0
+    assert cache.invalidate() == 0
+    assert cache.read('ogc', 'demo', ['t2']) == 2
+
+
+def test_tags_of_evicted_entries_are_removed(backend):
+    cache = backend(max_entries=2)
+    cache.set(('svc', None, 'u', 'a'), 1, 10, tags={('tenant', 't1')})
+    cache.set(('svc', None, 'u', 'b'), 2, 20, tags={('tenant', 't1')})
+    cache.set(('svc', None, 'u', 'c'), 3, 30, tags={('tenant', 't2')})
+    if isinstance(cache, SQLiteCache):
+        # NOTE: SQLite cache is trimmed to its budget periodically
+        cache.evict()
+
+    assert cache.lookup(('svc', None, 'u', 'a')) is None
+    tags = backend_tags(cache)
+    assert len(tags) == 2
+    assert sorted(tags.values()) == [1, 1]
+
+    assert cache.invalidate([('tenant', 't1')]) == 1
+    assert cache.invalidate([('tenant', 't2')]) == 1
+    assert backend_tags(cache) == {}
+
+
+def test_tags_of_expired_entries_are_removed(backend, clock):
+    cache = backend()
+    cache.set(('svc', 'a'), 1, duration=10, tags={('tenant', 't1')})
+    cache.set(('svc', 'b'), 2, duration=100, tags={('tenant', 't1')})
+    cache.set(('svc', 'c'), 3, duration=10, tags={('tenant', 't2')})
+
+    clock[0] += 50
+    cache.purge_expired()
+    assert cache.lookup(('svc', 'a')) is None
+    assert len(backend_tags(cache)) == 1
+    assert list(backend_tags(cache).values()) == [1]
+
+    clock[0] += 100
+    cache.purge_expired()
+    assert backend_tags(cache) == {}
+    assert cache.invalidate([('tenant', 't1')]) == 0
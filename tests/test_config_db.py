@@ -0,0 +1,393 @@
+import json
+import logging
+import random
+
+import pytest
+from sqlalchemy import create_engine, event
+
+from qwc_services_core.config_db_monitor import ConfigDBMonitor
+from qwc_services_core.config_models import ConfigModels
+from qwc_services_core.permissions_reader import PermissionsReader
+from qwc_services_core.tenant_handler import TenantHandler
+from test_tenant_handler import Watcher
+
+
+logger = logging.getLogger(__name__)
+
+
+# minimal ConfigDB schema for SQLite
+SCHEMA = [
+    "CREATE TABLE qwc_config.users ("
+    "  id INTEGER PRIMARY KEY, name TEXT NOT NULL, password_hash TEXT)",
+    "CREATE TABLE qwc_config.user_infos ("
+    "  id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users (id))",
+    "CREATE TABLE qwc_config.groups ("
+    "  id INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+    "CREATE TABLE qwc_config.roles ("
+    "  id INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+    "CREATE TABLE qwc_config.groups_users ("
+    "  group_id INTEGER REFERENCES groups (id),"
+    "  user_id INTEGER REFERENCES users (id),"
+    "  PRIMARY KEY (group_id, user_id))",
+    "CREATE TABLE qwc_config.users_roles ("
+    "  user_id INTEGER REFERENCES users (id),"
+    "  role_id INTEGER REFERENCES roles (id),"
+    "  PRIMARY KEY (user_id, role_id))",
+    "CREATE TABLE qwc_config.groups_roles ("
+    "  group_id INTEGER REFERENCES groups (id),"
+    "  role_id INTEGER REFERENCES roles (id),"
+    "  PRIMARY KEY (group_id, role_id))",
+    "CREATE TABLE qwc_config.resource_types ("
+    "  name TEXT PRIMARY KEY, description TEXT)",
+    "CREATE TABLE qwc_config.resources ("
+    "  id INTEGER PRIMARY KEY, parent_id INTEGER REFERENCES resources (id),"
+    "  type TEXT REFERENCES resource_types (name), name TEXT NOT NULL)",
+    "CREATE TABLE qwc_config.permissions ("
+    "  id INTEGER PRIMARY KEY, role_id INTEGER REFERENCES roles (id),"
+    "  resource_id INTEGER REFERENCES resources (id),"
+    "  priority INTEGER NOT NULL DEFAULT 0,"
+    "  write BOOLEAN NOT NULL DEFAULT 0)",
+    "CREATE TABLE qwc_config.registrable_groups ("
+    "  id INTEGER PRIMARY KEY, group_id INTEGER REFERENCES groups (id),"
+    "  title TEXT)",
+    "CREATE TABLE qwc_config.registration_requests ("
+    "  id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users (id),"
+    "  registrable_group_id INTEGER REFERENCES registrable_groups (id))",
+    "CREATE TABLE qwc_config.last_update (updated_at TIMESTAMP)"
+]
+
+
+class SQLiteDatabaseEngine():
+    """Database engine for ConfigModels with the ConfigDB schema attached
+    as SQLite database."""
+
+    def __init__(self, schema_path):
+        self.schema_path = schema_path
+
+    def db_engine(self, conn_str):
+        engine = create_engine(conn_str)
+
+        @event.listens_for(engine, 'connect')
+        def attach(dbapi_conn, record):
+            dbapi_conn.execute(
+                "ATTACH DATABASE ? AS qwc_config", (self.schema_path,)
+            )
+
+        return engine
+
+
+@pytest.fixture
+def config_models(tmp_path):
+    db_engine = SQLiteDatabaseEngine(str(tmp_path / 'qwc_config.db'))
+    conn_str = 'sqlite:///%s' % (tmp_path / 'main.db')
+    with db_engine.db_engine(conn_str).begin() as conn:
+        for statement in SCHEMA:
+            conn.exec_driver_sql(statement)
+    yield ConfigModels(db_engine, conn_str)
+    ConfigDBMonitor.monitors.clear()
+
+
+def execute(config_models, sql, params=()):
+    """Execute SQL statement on ConfigDB."""
+    with config_models.engine.begin() as conn:
+        conn.exec_driver_sql(sql, params)
+
+
+def random_config_db(rnd):
+    """Return random ConfigDB contents as {<table>: [<row>]}."""
+    users = [(i, 'u%d' % i) for i in range(1, 16)]
+    groups = [(i, 'g%d' % i) for i in range(1, 6)]
+    roles = [(1, 'public')] + [(i, 'role%d' % i) for i in range(2, 10)]
+    resource_types = [('map',), ('layer',), ('attribute',), ('viewer_task',)]
+    resources = []
+    for i in range(1, 6):
+        resources.append((i, None, 'map', 'map%d' % i))
+    for i in range(6, 40):
+        resources.append((i, rnd.randint(1, 5), 'layer', 'layer%d' % i))
+    for i in range(40, 60):
+        resources.append((i, rnd.randint(6, 39), 'attribute', 'a%d' % i))
+    for i in range(60, 65):
+        resources.append((i, None, 'viewer_task', 'task%d' % i))
+    permissions = []
+    for role_id, role in roles:
+        for resource in rnd.sample(resources, rnd.randint(0, 20)):
+            permissions.append((
+                len(permissions) + 1, role_id, resource[0],
+                rnd.randint(0, 3), rnd.random() < 0.3
+            ))
+    return {
+        'users': users,
+        'groups': groups,
+        'roles': roles,
+        'groups_users': [
+            (group_id, user_id) for user_id, user in users
+            for group_id, group in rnd.sample(groups, rnd.randint(0, 2))
+        ],
+        'users_roles': [
+            (user_id, role_id) for user_id, user in users
+            for role_id, role in rnd.sample(roles[1:], rnd.randint(0, 2))
+        ],
+        'groups_roles': [
+            (group_id, role_id) for group_id, group in groups
+            for role_id, role in rnd.sample(roles[1:], rnd.randint(0, 3))
+        ],
+        'resource_types': resource_types,
+        'resources': resources,
+        'permissions': permissions
+    }
+
+
+def insert_config_db(config_models, contents):
+    """Insert ConfigDB contents."""
+    columns = {
+        'users': '(id, name)',
+        'groups': '(id, name)',
+        'roles': '(id, name)',
+        'groups_users': '(group_id, user_id)',
+        'users_roles': '(user_id, role_id)',
+        'groups_roles': '(group_id, role_id)',
+        'resource_types': '(name)',
+        'resources': '(id, parent_id, type, name)',
+        'permissions': '(id, role_id, resource_id, priority, write)'
+    }
+    with config_models.engine.begin() as conn:
+        for table, rows in contents.items():
+            for row in rows:
+                conn.exec_driver_sql(
+                    "INSERT INTO qwc_config.%s %s VALUES (%s)" % (
+                        table, columns[table], ', '.join(['?'] * len(row))
+                    ),
+                    tuple(row)
+                )
+
+
+def permissions_json(contents):
+    """Return permissions JSON for ConfigDB contents, as written by the
+    config generator, with role permissions by resource type ordered by
+    descending priority."""
+    user_names = dict(contents['users'])
+    group_names = dict(contents['groups'])
+    role_names = dict(contents['roles'])
+    resources = {row[0]: row for row in contents['resources']}
+
+    def names(rows, key_index, value_index, lookup, key):
+        return sorted(
+            lookup[row[value_index]] for row in rows
+            if row[key_index] == key
+        )
+
+    roles = []
+    for role_id, role in contents['roles']:
+        role_permissions = {}
+        for permission in sorted(
+            [p for p in contents['permissions'] if p[1] == role_id],
+            key=lambda p: (-p[3], p[2], p[0])
+        ):
+            resource = resources[permission[2]]
+            parent = resources.get(resource[1])
+            role_permissions.setdefault(resource[2], []).append({
+                'name': resource[3],
+                'parent': parent[3] if parent else None,
+                'writable': permission[4],
+                'priority': permission[3]
+            })
+        roles.append({'role': role, 'permissions': role_permissions})
+
+    return {
+        'users': [
+            {
+                'name': user,
+                'groups': names(
+                    contents['groups_users'], 1, 0, group_names, user_id
+                ),
+                'roles': names(
+                    contents['users_roles'], 0, 1, role_names, user_id
+                )
+            }
+            for user_id, user in contents['users']
+        ],
+        'groups': [
+            {
+                'name': group,
+                'roles': names(
+                    contents['groups_roles'], 0, 1, role_names, group_id
+                )
+            }
+            for group_id, group in contents['groups']
+        ],
+        'roles': roles,
+        'permissions_default_allow': False
+    }
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_config_db_permissions_match_json(tmp_path, monkeypatch,
+                                          config_models, seed):
+    rnd = random.Random(seed)
+    contents = random_config_db(rnd)
+    insert_config_db(config_models, contents)
+
+    monkeypatch.setenv('CONFIG_PATH', str(tmp_path))
+    (tmp_path / 'default').mkdir()
+    with open(tmp_path / 'default' / 'permissions.json', 'w') as fh:
+        json.dump(permissions_json(contents), fh)
+
+    db_reader = PermissionsReader(
+        'default', logger, config_models=config_models
+    )
+    json_reader = PermissionsReader('default', logger)
+
+    for key in ('users', 'user_groups', 'groups', 'roles'):
+        assert db_reader.permissions[key] == json_reader.permissions[key]
+
+    identities = [None, {'username': 'nobody'}] + [
+        {'username': 'u%d' % i, 'groups': ['g%d' % rnd.randint(1, 5)]}
+        for i in range(1, 16)
+    ]
+    for identity in identities:
+        assert db_reader.identity_roles(identity) == \
+            json_reader.identity_roles(identity)
+        for resource_key in ('map', 'layer', 'attribute', 'viewer_task'):
+            assert db_reader.resource_permissions(
+                resource_key, identity
+            ) == json_reader.resource_permissions(resource_key, identity)
+            for name in ('map1', 'layer7', 'a45', 'task60'):
+                assert db_reader.resource_permissions(
+                    resource_key, identity, name
+                ) == json_reader.resource_permissions(
+                    resource_key, identity, name
+                )
+                assert db_reader.resource_permitted(
+                    resource_key, identity, name
+                ) == json_reader.resource_permitted(
+                    resource_key, identity, name
+                )
+
+
+def test_config_db_permissions_are_ordered_by_priority(config_models):
+    insert_config_db(config_models, {
+        'users': [(1, 'u')],
+        'roles': [(1, 'public'), (2, 'r')],
+        'users_roles': [(1, 2)],
+        'resource_types': [('map',)],
+        'resources': [(1, None, 'map', 'a'), (2, None, 'map', 'b')],
+        'permissions': [
+            (1, 2, 1, 0, False), (2, 2, 2, 5, False), (3, 2, 1, 10, True)
+        ]
+    })
+
+    reader = PermissionsReader('default', logger, config_models=config_models)
+    assert reader.resource_permissions('map', {'username': 'u'}) == [
+        {'name': 'a', 'parent': None, 'writable': True, 'priority': 10},
+        {'name': 'b', 'parent': None, 'writable': False, 'priority': 5},
+        {'name': 'a', 'parent': None, 'writable': False, 'priority': 0}
+    ]
+    # highest priority permission of a resource comes first
+    assert reader.resource_permissions(
+        'map', {'username': 'u'}, 'a'
+    )[0]['writable'] is True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Manually advanced monotonic clock of ConfigDBMonitor."""
+    now = [1000.0]
+    monkeypatch.setattr(
+        'qwc_services_core.config_db_monitor.time.monotonic', lambda: now[0]
+    )
+    return now
+
+
+def bump_last_update(config_models, timestamp):
+    execute(
+        config_models, "INSERT INTO qwc_config.last_update VALUES (?)",
+        (timestamp,)
+    )
+
+
+def test_monitor_polls_once_per_interval(config_models, clock):
+    monitor = ConfigDBMonitor(config_models, logger, interval=10)
+    polls = []
+    poll = monitor.poll
+    monitor.poll = lambda: polls.append(1) or poll()
+
+    assert monitor.generation() == 0
+    assert monitor.generation() == 0
+    assert len(polls) == 1
+
+    # change is not detected before the interval has passed
+    bump_last_update(config_models, '2024-01-01 00:00:00')
+    clock[0] += 5
+    assert monitor.generation() == 0
+    assert len(polls) == 1
+
+    clock[0] += 5
+    assert monitor.generation() == 1
+    assert len(polls) == 2
+
+    # unchanged last update
+    clock[0] += 10
+    assert monitor.generation() == 1
+    assert len(polls) == 3
+
+
+def test_monitor_is_shared_per_engine_url(config_models, tmp_path):
+    monitor = ConfigDBMonitor.shared(config_models, logger)
+    assert ConfigDBMonitor.shared(config_models, logger) is monitor
+
+    # same ConfigDB URL with other models
+    other_models = ConfigModels(
+        SQLiteDatabaseEngine(str(tmp_path / 'qwc_config.db')),
+        'sqlite:///%s' % (tmp_path / 'main.db')
+    )
+    assert ConfigDBMonitor.shared(other_models, logger) is monitor
+
+    # other ConfigDB URL
+    with other_models.engine.begin() as conn:
+        conn.exec_driver_sql("VACUUM INTO ?", (str(tmp_path / 'copy.db'),))
+    copy_models = ConfigModels(
+        SQLiteDatabaseEngine(str(tmp_path / 'qwc_config.db')),
+        'sqlite:///%s' % (tmp_path / 'copy.db')
+    )
+    assert ConfigDBMonitor.shared(copy_models, logger) is not monitor
+
+
+def test_last_update_bump_invalidates_handlers(config_models, clock):
+    insert_config_db(config_models, {
+        'users': [(1, 'u')],
+        'roles': [(1, 'public'), (2, 'r')],
+        'users_roles': [(1, 2)],
+        'resource_types': [('map',)],
+        'resources': [(1, None, 'map', 'a')],
+        'permissions': []
+    })
+    monitor = ConfigDBMonitor.shared(config_models, logger)
+    tenant_handler = TenantHandler(
+        logger, config_db_monitor=monitor, config_watcher=Watcher()
+    )
+
+    assert tenant_handler.handler('svc', 'svc', 'default') is None
+    reader = tenant_handler.register_handler(
+        'svc', 'default',
+        PermissionsReader('default', logger, config_models=config_models)
+    )
+    assert tenant_handler.handler('svc', 'svc', 'default') is reader
+    assert reader.resource_permissions('map', {'username': 'u'}) == []
+    assert not reader.refresh()
+
+    # permission added and last update bumped
+    execute(
+        config_models,
+        "INSERT INTO qwc_config.permissions "
+        "(id, role_id, resource_id, priority, write) VALUES (1, 2, 1, 0, 1)"
+    )
+    bump_last_update(config_models, '2024-01-01 00:00:00')
+    # cached until the poll interval has passed
+    assert tenant_handler.handler('svc', 'svc', 'default') is reader
+
+    clock[0] += monitor.interval
+    assert tenant_handler.handler('svc', 'svc', 'default') is None
+    assert reader.refresh()
+    assert reader.resource_permissions('map', {'username': 'u'}) == [
+        {'name': 'a', 'parent': None, 'writable': True, 'priority': 0}
+    ]
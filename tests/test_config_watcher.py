@@ -0,0 +1,131 @@
+import logging
+import os
+
+import pytest
+
+from qwc_services_core.config_watcher import ConfigWatcher, load_inotify
+
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def config_path(tmp_path, monkeypatch):
+    monkeypatch.setenv('CONFIG_PATH', str(tmp_path))
+    (tmp_path / 'default').mkdir()
+    write_config(tmp_path / 'default' / 'svcConfig.json', '{}')
+    return tmp_path
+
+
+def write_config(path, text):
+    with open(path, 'w') as fh:
+        fh.write(text)
+
+
+def configmap(config_path, version, text):
+    """Update tenant dir like a mounted Kubernetes ConfigMap, by writing a
+    new versioned dir and replacing the '..data' symlink to it."""
+    tenant_dir = config_path / 'default'
+    os.mkdir(tenant_dir / version)
+    write_config(tenant_dir / version / 'svcConfig.json', text)
+    os.symlink(version, tenant_dir / '..data_tmp')
+    os.rename(tenant_dir / '..data_tmp', tenant_dir / '..data')
+
+
+inotify = pytest.mark.skipif(
+    load_inotify() is None, reason="inotify not available"
+)
+
+
+def test_poll_detects_changes(config_path):
+    watcher = ConfigWatcher(logger, 'poll', interval=0)
+    assert watcher.generation('svc', 'default') == 0
+    assert watcher.generation('svc', 'default') == 0
+
+    write_config(config_path / 'default' / 'svcConfig.json', '{"a": 1}')
+    assert watcher.generation('svc', 'default') == 1
+    assert watcher.generation('svc', 'default') == 1
+
+    # new permissions file
+    write_config(config_path / 'default' / 'permissions.json', '{}')
+    assert watcher.generation('svc', 'default') == 2
+    # other tenants are not affected
+    assert watcher.tenant_generation('other') == 0
+
+
+def test_poll_obeys_interval(config_path):
+    watcher = ConfigWatcher(logger, 'poll', interval=3600)
+    assert watcher.generation('svc', 'default') == 0
+
+    write_config(config_path / 'default' / 'svcConfig.json', '{"a": 1}')
+    assert watcher.generation('svc', 'default') == 0
+
+    watcher.next_check = 0
+    assert watcher.generation('svc', 'default') == 1
+
+
+@inotify
+def test_inotify_detects_changes(config_path):
+    watcher = ConfigWatcher(logger, 'inotify', interval=0)
+    assert watcher.generation('svc', 'default') == 0
+    assert watcher.fd is not None
+    assert not watcher.polled
+
+    write_config(config_path / 'default' / 'svcConfig.json', '{"a": 1}')
+    assert watcher.generation('svc', 'default') == 1
+    assert watcher.generation('svc', 'default') == 1
+
+    # unrelated file in config dir
+    write_config(config_path / 'default' / 'otherConfig.json', '{}')
+    assert watcher.generation('svc', 'default') == 1
+
+
+@inotify
+def test_inotify_detects_configmap_update(config_path):
+    os.remove(config_path / 'default' / 'svcConfig.json')
+    configmap(config_path, '..v1', '{}')
+    os.symlink(
+        os.path.join('..data', 'svcConfig.json'),
+        config_path / 'default' / 'svcConfig.json'
+    )
+
+    watcher = ConfigWatcher(logger, 'inotify', interval=0)
+    assert watcher.generation('svc', 'default') == 0
+
+    configmap(config_path, '..v2', '{"a": 1}')
+    assert watcher.generation('svc', 'default') == 1
+    assert watcher.generation('svc', 'default') == 1
+
+
+@inotify
+def test_inotify_is_reinitialized_after_fork(config_path):
+    watcher = ConfigWatcher(logger, 'inotify', interval=0)
+    assert watcher.generation('svc', 'default') == 0
+    parent_fd = watcher.fd
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # child process
+        result = b'0'
+        try:
+            watcher.generation('svc', 'default')
+            if watcher.pid == os.getpid() and watcher.fd != parent_fd:
+                write_config(
+                    config_path / 'default' / 'svcConfig.json', '{"a": 1}'
+                )
+                if watcher.generation('svc', 'default') == 1:
+                    result = b'1'
+        finally:
+            os.write(write_fd, result)
+            os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 1)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    assert result == b'1'
+
+    # parent keeps its own inotify instance and sees the change as well
+    assert watcher.generation('svc', 'default') == 1
+    assert watcher.fd == parent_fd
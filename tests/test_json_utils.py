@@ -0,0 +1,102 @@
+import gc
+import io
+import json
+import threading
+
+import pytest
+
+from qwc_services_core.json_utils import JSONReader, env_flag, paused_gc
+
+
+DOCUMENT = {
+    'users': [
+        {'name': 'u%d' % i, 'groups': ['g}%d' % i], 'roles': []}
+        for i in range(50)
+    ],
+    'roles': [
+        {'role': 'r%d' % i, 'permissions': {'layers': [{'name': 'a"}'}]}}
+        for i in range(5)
+    ],
+    'numbers': [1, -2.5e-3, 12345678901234567890, 1.0],
+    'default': 1.25e10,
+    'empty': [],
+    'flag': True
+}
+
+
+def read_sections(text='', fh=None):
+    reader = JSONReader(text, fh)
+    sections = {}
+    for key, key_span in reader.members():
+        if reader.peek() == '[':
+            sections[key] = list(reader.items())
+        else:
+            sections[key] = reader.decode()
+    reader.expect_end()
+    return sections
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 64, 1024 * 1024])
+@pytest.mark.parametrize('indent', [None, 2])
+def test_reader_reads_file_incrementally(monkeypatch, chunk_size, indent):
+    monkeypatch.setattr(JSONReader, 'CHUNK_SIZE', chunk_size)
+    text = json.dumps(DOCUMENT, indent=indent)
+
+    assert read_sections(fh=io.StringIO(text)) == DOCUMENT
+    assert read_sections(text) == DOCUMENT
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 1024 * 1024])
+@pytest.mark.parametrize('text', [
+    '{"a": [1, 2,]}', '{"a": [{"b": 1}, ]}', '{"a": [{"b": 1}}', '{"a": 1.}',
+    '{"a": [1] "b": 2}', '{"a": tru}', '{"a": 1} x', '{"a": [{"b": "}]}'
+])
+def test_reader_rejects_invalid_json(monkeypatch, chunk_size, text):
+    monkeypatch.setattr(JSONReader, 'CHUNK_SIZE', chunk_size)
+
+    with pytest.raises(ValueError):
+        read_sections(fh=io.StringIO(text))
+
+
+def test_reader_keeps_offsets_of_keys(monkeypatch):
+    monkeypatch.setattr(JSONReader, 'CHUNK_SIZE', 3)
+    text = '{"a": [1, {"b": 2}], "cd": "}"}'
+
+    reader = JSONReader(fh=io.StringIO(text))
+    spans = {}
+    for key, key_span in reader.members():
+        spans[key] = key_span
+        reader.decode()
+    for key, (start, end) in spans.items():
+        assert text[start:end] == '"%s"' % key
+
+
+def test_paused_gc_only_in_single_thread():
+    assert gc.isenabled()
+    with paused_gc():
+        assert not gc.isenabled()
+    assert gc.isenabled()
+
+    release = threading.Event()
+    thread = threading.Thread(target=release.wait)
+    thread.start()
+    try:
+        with paused_gc():
+            # NOTE: gc.disable() would affect the other thread
+            assert gc.isenabled()
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_env_flag(monkeypatch):
+    monkeypatch.delenv('TEST_FLAG', raising=False)
+    assert env_flag('TEST_FLAG') is False
+    assert env_flag('TEST_FLAG', True) is True
+
+    for value, expected in [
+        ('true', True), ('True', True), ('T', True), ('t', True),
+        ('false', False), ('1', False), ('yes', False), ('', False)
+    ]:
+        monkeypatch.setenv('TEST_FLAG', value)
+        assert env_flag('TEST_FLAG', True) is expected
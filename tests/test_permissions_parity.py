@@ -0,0 +1,286 @@
+import json
+import logging
+import os
+import random
+
+import pytest
+
+from qwc_services_core.permissions_reader import PermissionsReader
+
+
+logger = logging.getLogger(__name__)
+
+
+def linear_resource_permissions(reader, resource_key, identity,
+                                resource_name=None):
+    """Reference implementation of resource_permissions scanning all
+    permissions of the identity roles."""
+    permissions = []
+    for role in reader.identity_roles(identity):
+        role_permissions = reader.permissions['roles'].get(role, {})
+        resource_permissions = role_permissions.get(resource_key, {})
+        if resource_name is not None:
+            for permission in resource_permissions:
+                if isinstance(permission, dict):
+                    if permission.get('name') == resource_name:
+                        permissions.append(permission)
+                else:
+                    if permission == resource_name:
+                        permissions.append(permission)
+        else:
+            permissions.extend(resource_permissions)
+    return permissions
+
+
+def linear_resource_restrictions(reader, resource_key, identity,
+                                 subresource_filter=[]):
+    """Reference implementation of resource_restrictions comparing all
+    permissions of all roles."""
+    def subresources(role_permissions):
+        for filter_entry in subresource_filter:
+            role_permissions = next(filter(
+                lambda entry: entry.get('name') == filter_entry[0],
+                role_permissions
+            ), {}).get(filter_entry[1], [])
+        return role_permissions
+
+    identity_permissions = []
+    for role in reader.identity_roles(identity):
+        identity_permissions.extend(subresources(
+            reader.permissions['roles'].get(role, {}).get(resource_key, [])
+        ))
+    if '*' in identity_permissions:
+        return []
+
+    role_restrictions = []
+    for role in reader.permissions['roles']:
+        if role == 'public':
+            continue
+        role_permissions = subresources(
+            reader.permissions['roles'][role].get(resource_key, [])
+        )
+        for entry in role_permissions:
+            if entry not in identity_permissions:
+                role_restrictions.append(entry)
+    return role_restrictions
+
+
+def random_roles(rnd, n_roles):
+    """Return random role and group assignments for users."""
+    roles = ['public'] + ['role%d' % i for i in range(1, n_roles)]
+    groups = [
+        {'name': 'g%d' % i, 'roles': rnd.sample(roles[1:], rnd.randint(0, 3))}
+        for i in range(5)
+    ]
+    users = [
+        {
+            'name': 'u%d' % i,
+            'groups': rnd.sample([g['name'] for g in groups], rnd.randint(0, 2)),
+            'roles': rnd.sample(roles[1:], rnd.randint(0, 2))
+        }
+        for i in range(20)
+    ]
+    return roles, groups, users
+
+
+def full_permissions(rnd, n_roles=12, n_layers=60):
+    """Return random full permissions."""
+    roles, groups, users = random_roles(rnd, n_roles)
+    layers = ['layer%d' % i for i in range(n_layers)]
+    role_permissions = []
+    for role in roles:
+        wms_layers = [
+            {
+                'name': layer,
+                'attributes': rnd.sample(['a', 'b', 'geometry'], 2)
+            } if rnd.random() < 0.7 else {'name': layer}
+            for layer in rnd.sample(layers, rnd.randint(0, n_layers // 2))
+        ]
+        if rnd.random() < 0.3:
+            # duplicate entry
+            wms_layers.append({'name': 'layer1'})
+        viewer_tasks = rnd.sample(
+            ['task%d' % i for i in range(10)], rnd.randint(0, 5)
+        )
+        if rnd.random() < 0.1:
+            viewer_tasks.append('*')
+        role_permissions.append({'role': role, 'permissions': {
+            'wms_services': [{'name': 'wms', 'layers': wms_layers}],
+            'viewer_tasks': viewer_tasks,
+            'data_datasets': [
+                {'name': layer, 'writable': rnd.random() < 0.5}
+                for layer in rnd.sample(layers, rnd.randint(0, 10))
+            ]
+        }})
+    return {
+        'users': users, 'groups': groups, 'roles': role_permissions,
+        'permissions_default_allow': True
+    }
+
+
+def unified_permissions(rnd, n_roles=12, n_layers=60):
+    """Return random unified permissions with nested group layers."""
+    roles, groups, users = random_roles(rnd, n_roles)
+    names = ['dp%d' % i for i in range(n_layers)]
+    dataproducts = []
+    for i, name in enumerate(names):
+        if rnd.random() < 0.25 and i + 1 < n_layers:
+            dataproducts.append({'name': name, 'sublayers': rnd.sample(
+                names[i + 1:], min(n_layers - i - 1, rnd.randint(1, 4))
+            )})
+        else:
+            dataproducts.append({
+                'name': name,
+                'attributes': rnd.sample(['a', 'b', 'c'], rnd.randint(0, 3)),
+                'writable': rnd.random() < 0.2
+            })
+    role_permissions = [
+        {'role': role, 'permissions': {'all_services': {
+            name: {'writable': True} if rnd.random() < 0.2 else {}
+            for name in rnd.sample(names, rnd.randint(0, n_layers // 4))
+        }}}
+        for role in roles
+    ]
+    return {
+        'users': users, 'groups': groups, 'roles': role_permissions,
+        'wms_name': 'wms', 'wfs_name': 'wfs', 'dataproducts': dataproducts,
+        'common_resources': ['bg'], 'permissions_default_allow': True
+    }
+
+
+RESOURCE_KEYS = [
+    'wms_services', 'wfs_services', 'viewer_tasks', 'data_datasets',
+    'dataproducts', 'background_layers', 'missing'
+]
+RESOURCE_NAMES = [
+    None, 'wms', 'wfs', 'task1', 'layer1', 'layer7', 'dp1', 'dp5', 'bg',
+    'missing'
+]
+SUBRESOURCE_FILTERS = [
+    [('wms', 'layers')], [('wfs', 'layers')], [('missing', 'layers')],
+    [('wms', 'layers'), ('layer1', 'attributes')],
+    [('wms', 'layers'), ('dp3', 'attributes')]
+]
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('generate', [full_permissions, unified_permissions])
+@pytest.mark.parametrize('options', [
+    {}, {'lazy': True}, {'streaming': True}, {'snapshot': True}
+])
+def test_indexed_lookups_match_linear_scan(tmp_path, monkeypatch, seed,
+                                           generate, options):
+    monkeypatch.setenv('CONFIG_PATH', str(tmp_path))
+    monkeypatch.setenv('TMPDIR', str(tmp_path))
+    monkeypatch.setattr('tempfile.tempdir', None)
+    rnd = random.Random(seed)
+    (tmp_path / 'default').mkdir()
+    with open(tmp_path / 'default' / 'permissions.json', 'w') as fh:
+        json.dump(generate(rnd), fh)
+
+    reader = PermissionsReader('default', logger, **options)
+    if options.get('snapshot'):
+        # read written snapshot
+        reader = PermissionsReader('default', logger, **options)
+
+    identities = [None, 'u0', {'username': 'nobody'}] + [
+        {'username': 'u%d' % rnd.randint(0, 19), 'groups': ['g%d' % i]}
+        for i in range(5)
+    ]
+    for identity in identities:
+        for resource_key in RESOURCE_KEYS:
+            for resource_name in RESOURCE_NAMES:
+                assert reader.resource_permissions(
+                    resource_key, identity, resource_name
+                ) == linear_resource_permissions(
+                    reader, resource_key, identity, resource_name
+                )
+            assert reader.resource_restrictions(
+                resource_key, identity
+            ) == linear_resource_restrictions(
+                reader, resource_key, identity
+            )
+
+        for subresource_filter in SUBRESOURCE_FILTERS:
+            assert reader.resource_restrictions(
+                'wms_services', identity, subresource_filter
+            ) == linear_resource_restrictions(
+                reader, 'wms_services', identity, subresource_filter
+            )
+
+
+# lookups of random permissions with outputs of the PermissionsReader before
+# lookups were indexed and unified permissions were expanded via an index of
+# the sublayer hierarchy, including cyclic and unknown sublayers, as
+# [{permissions: <permissions JSON>, results: [[<method>, <args>, <output>]]}]
+BASELINE_PATH = os.path.join(
+    os.path.dirname(__file__), 'data', 'permissions_baseline.json'
+)
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'lazy': True}, {'streaming': True}, {'snapshot': True}
+])
+def test_lookups_match_baseline(tmp_path, monkeypatch, options):
+    monkeypatch.setenv('CONFIG_PATH', str(tmp_path))
+    monkeypatch.setenv('TMPDIR', str(tmp_path))
+    monkeypatch.setattr('tempfile.tempdir', None)
+    with open(BASELINE_PATH) as fh:
+        cases = json.load(fh)
+
+    for i, case in enumerate(cases):
+        tenant = 'tenant%d' % i
+        (tmp_path / tenant).mkdir()
+        with open(tmp_path / tenant / 'permissions.json', 'w') as fh:
+            json.dump(case['permissions'], fh)
+
+        reader = PermissionsReader(tenant, logger, **options)
+        if options.get('snapshot'):
+            # read written snapshot
+            reader = PermissionsReader(tenant, logger, **options)
+
+        for method, args, output in case['results']:
+            assert getattr(reader, method)(*args) == output, (method, args)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('generate', [full_permissions, unified_permissions])
+@pytest.mark.parametrize('lazy', [False, True])
+def test_batch_lookups_match_single_lookups(tmp_path, monkeypatch, seed,
+                                            generate, lazy):
+    monkeypatch.setenv('CONFIG_PATH', str(tmp_path))
+    rnd = random.Random(seed)
+    (tmp_path / 'default').mkdir()
+    with open(tmp_path / 'default' / 'permissions.json', 'w') as fh:
+        json.dump(generate(rnd), fh)
+
+    reader = PermissionsReader('default', logger, lazy=lazy)
+    # NOTE: separate reader without memoized single lookups
+    batch_reader = PermissionsReader('default', logger, lazy=lazy)
+
+    identities = [None, 'u0', {'username': 'nobody'}] + [
+        {'username': 'u%d' % rnd.randint(0, 19), 'groups': ['g%d' % i]}
+        for i in range(5)
+    ]
+    # NOTE: including a duplicate name
+    resource_names = RESOURCE_NAMES[1:] + ['layer1']
+    for resource_key in RESOURCE_KEYS:
+        for identity in identities:
+            assert batch_reader.resource_permissions_by_name(
+                resource_key, identity, resource_names
+            ) == {
+                resource_name: reader.resource_permissions(
+                    resource_key, identity, resource_name
+                )
+                for resource_name in resource_names
+            }
+
+        for resource_name in RESOURCE_NAMES:
+            assert batch_reader.resource_permissions_for_identities(
+                resource_key, identities, resource_name
+            ) == [
+                reader.resource_permissions(
+                    resource_key, identity, resource_name
+                )
+                for identity in identities
+            ]
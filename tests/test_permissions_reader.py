@@ -0,0 +1,524 @@
+import json
+import logging
+import os
+import pickle
+import sys
+import threading
+import time
+
+import pytest
+
+from qwc_services_core.permissions_reader import (
+    LazyRolePermissions, PermissionsMemo, PermissionsReader,
+    ResourceHierarchy, walk_sublayers
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def config_path(tmp_path, monkeypatch):
+    monkeypatch.setenv('CONFIG_PATH', str(tmp_path))
+    # private cache dir for snapshots
+    (tmp_path / 'tmp').mkdir()
+    monkeypatch.setenv('TMPDIR', str(tmp_path / 'tmp'))
+    monkeypatch.setattr('tempfile.tempdir', None)
+    return tmp_path
+
+
+def write_permissions(config_path, tenant, permissions):
+    """Write permissions.json for a tenant."""
+    tenant_dir = config_path / tenant
+    tenant_dir.mkdir(exist_ok=True)
+    with open(tenant_dir / 'permissions.json', 'w') as fh:
+        json.dump(permissions, fh)
+
+
+def unified_permissions(roles, common_resources=[]):
+    """Return unified permissions with a dataproduct 'bg' with the same name
+    as a common resource."""
+    return {
+        'wms_name': 'wms',
+        'wfs_name': 'wfs',
+        'common_resources': common_resources,
+        'dataproducts': [
+            {'name': 'bg', 'attributes': ['a'], 'writable': True},
+            {'name': 'x', 'attributes': ['b']}
+        ],
+        'users': [{'name': 'u', 'groups': [], 'roles': ['a']}],
+        'groups': [],
+        'roles': roles
+    }
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_common_resource_expanded_after_dataproduct(config_path, lazy):
+    # dataproduct record of 'bg' is built before the common resource 'bg'
+    write_permissions(config_path, 'default', unified_permissions([
+        {'role': 'a', 'permissions': {'all_services': {'bg': {}}}}
+    ], common_resources=['bg']))
+
+    reader = PermissionsReader('default', logger, lazy=lazy)
+    identity = {'username': 'u'}
+
+    assert reader.resource_permissions('data_datasets', identity) == [
+        {'name': 'bg', 'attributes': ['a'], 'writable': True, 'readable': True}
+    ]
+    wms_layers = reader.resource_permissions('wms_services', identity)[0][
+        'layers'
+    ]
+    assert {'name': 'bg'} in wms_layers
+    assert reader.resource_permissions('background_layers', identity) == [
+        'bg'
+    ]
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_dataproduct_expanded_after_common_resource(config_path, lazy):
+    # group layer of common resource 'bg' is built before the dataproduct
+    write_permissions(config_path, 'default', unified_permissions([
+        {'role': 'a', 'permissions': {}},
+        {'role': 'public', 'permissions': {'all_services': {'bg': {}}}}
+    ], common_resources=['bg']))
+
+    reader = PermissionsReader('default', logger, lazy=lazy)
+    identity = {'username': 'u'}
+
+    assert reader.resource_permissions('data_datasets', identity) == [
+        {'name': 'bg', 'attributes': ['a'], 'writable': True, 'readable': True}
+    ]
+    assert reader.resource_permissions('wfs_services', identity) == [
+        {'name': 'wfs', 'layers': []},
+        {'name': 'wfs', 'layers': [
+            {'name': 'bg', 'attributes': ['a', 'geometry']}
+        ]}
+    ]
+
+
+def test_wms_root_named_like_dataproduct(config_path):
+    permissions = unified_permissions([
+        {'role': 'a', 'permissions': {'all_services': {'bg': {}}}}
+    ])
+    permissions['wms_name'] = 'bg'
+    write_permissions(config_path, 'default', permissions)
+
+    reader = PermissionsReader('default', logger)
+    identity = {'username': 'u'}
+
+    wms_layers = reader.resource_permissions('wms_services', identity)[0][
+        'layers'
+    ]
+    assert wms_layers[0] == {'name': 'bg'}
+    assert reader.resource_permissions('data_datasets', identity) == [
+        {'name': 'bg', 'attributes': ['a'], 'writable': True, 'readable': True}
+    ]
+
+
+def test_reload_with_snapshot_keeps_bitmaps(config_path):
+    permissions = {
+        'users': [{'name': 'u', 'groups': [], 'roles': ['r1']}],
+        'groups': [],
+        'roles': [
+            {'role': 'r1', 'permissions': {
+                'wms_services': [{'name': 'wms', 'layers': []}],
+                'data_datasets': [{'name': 'ds1'}, {'name': 'ds2'}]
+            }},
+            {'role': 'r2', 'permissions': {
+                'data_datasets': [{'name': 'ds3'}]
+            }}
+        ]
+    }
+    write_permissions(config_path, 'default', permissions)
+
+    reader = PermissionsReader('default', logger, snapshot=True)
+    # snapshot is written to the private cache dir
+    snapshot_path = PermissionsReader.snapshot_file_path('default')
+    assert snapshot_path.startswith(str(config_path / 'tmp'))
+    assert os.path.exists(snapshot_path)
+    assert not (config_path / 'default' / 'permissions.snapshot').exists()
+    identity = {'username': 'u'}
+    assert reader.resource_permitted('data_datasets', identity, 'ds1')
+    assert reader.permitted_resource_names('data_datasets', identity) == [
+        'ds1', 'ds2'
+    ]
+
+    # change unrelated role
+    permissions['roles'][1]['permissions']['data_datasets'].append(
+        {'name': 'ds4'}
+    )
+    write_permissions(config_path, 'default', permissions)
+    assert reader.reload() == {'r2'}
+
+    assert reader.resource_permitted('data_datasets', identity, 'ds1')
+    assert reader.permitted_resource_names('data_datasets', identity) == [
+        'ds1', 'ds2'
+    ]
+
+    # snapshot of reloaded permissions
+    reader = PermissionsReader('default', logger, snapshot=True)
+    assert reader.permitted_resource_names('data_datasets', identity) == [
+        'ds1', 'ds2'
+    ]
+
+
+def test_reload_replaces_memo_with_permissions(config_path):
+    permissions = {
+        'users': [
+            {'name': 'u', 'groups': [], 'roles': ['r1']},
+            {'name': 'v', 'groups': [], 'roles': ['r2']}
+        ],
+        'groups': [],
+        'roles': [
+            {'role': 'r1', 'permissions': {'data_datasets': ['ds1']}},
+            {'role': 'r2', 'permissions': {'data_datasets': ['ds2']}}
+        ]
+    }
+    write_permissions(config_path, 'default', permissions)
+    reader = PermissionsReader('default', logger)
+    assert reader.resource_permitted('data_datasets', {'username': 'u'}, 'ds1')
+    assert reader.resource_permitted('data_datasets', {'username': 'v'}, 'ds2')
+    previous = reader.permissions
+
+    permissions['roles'][1]['permissions']['data_datasets'] = ['ds3']
+    write_permissions(config_path, 'default', permissions)
+    assert reader.reload() == {'r2'}
+
+    # memoized results of unchanged roles are transferred to the new memo
+    memo = reader.permissions['memo']
+    assert memo is not previous['memo']
+    assert ('bitmap', ('public', 'r1'), 'data_datasets') in memo.entries
+    assert ('bitmap', ('public', 'r2'), 'data_datasets') not in memo.entries
+
+    # queries on the previous permissions do not affect the new memo
+    previous['memo'].get(('roles', 'w', ()), lambda: ['public'])
+    assert ('bitmap', ('public', 'r1'), 'data_datasets') in memo.entries
+    assert ('roles', 'w', ()) not in memo.entries
+
+    assert reader.resource_permitted('data_datasets', {'username': 'u'}, 'ds1')
+    assert not reader.resource_permitted(
+        'data_datasets', {'username': 'v'}, 'ds2'
+    )
+    assert reader.resource_permitted('data_datasets', {'username': 'v'}, 'ds3')
+
+
+def test_queries_during_reload(config_path):
+    versions = []
+    for i in range(2):
+        versions.append({
+            'users': [{'name': 'u', 'groups': [], 'roles': ['r1', 'r2']}],
+            'groups': [],
+            'roles': [
+                {'role': 'r1', 'permissions': {'data_datasets': ['ds']}},
+                {'role': 'r2', 'permissions': {
+                    'data_datasets': ['v%d-%d' % (i, j) for j in range(20)]
+                }}
+            ]
+        })
+    write_permissions(config_path, 'default', versions[0])
+    reader = PermissionsReader('default', logger)
+    identity = {'username': 'u'}
+    done = threading.Event()
+    errors = []
+
+    def query():
+        try:
+            while not done.is_set():
+                assert reader.resource_permitted(
+                    'data_datasets', identity, 'ds'
+                )
+                names = reader.permitted_resource_names(
+                    'data_datasets', identity
+                )
+                assert 'ds' in names and len(names) == 21
+                assert len({name[:2] for name in names}) == 2
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=query) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(20):
+            write_permissions(config_path, 'default', versions[i % 2 - 1])
+            reader.reload()
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+
+
+class Exploit:
+    """Value executing code when unpickled."""
+
+    def __reduce__(self):
+        return (os.system, ('touch exploited',))
+
+
+def test_snapshot_loads_permissions_classes_only(config_path, monkeypatch):
+    write_permissions(config_path, 'default', {
+        'users': [{'name': 'u', 'groups': [], 'roles': ['r1']}],
+        'groups': [],
+        'roles': [{'role': 'r1', 'permissions': {'viewer_tasks': ['t1']}}]
+    })
+    PermissionsReader('default', logger, snapshot=True)
+    snapshot_path = PermissionsReader.snapshot_file_path('default')
+    with open(snapshot_path, 'rb') as fh:
+        header = pickle.load(fh)
+
+    # planted snapshot with valid header is not loaded
+    with open(snapshot_path, 'wb') as fh:
+        pickle.dump(header, fh)
+        pickle.dump(Exploit(), fh)
+    monkeypatch.chdir(config_path)
+    reader = PermissionsReader('default', logger, snapshot=True)
+    assert not (config_path / 'exploited').exists()
+    assert reader.resource_permissions(
+        'viewer_tasks', {'username': 'u'}
+    ) == ['t1']
+
+
+HIERARCHY = {
+    'root': {'name': 'root', 'sublayers': ['g1', 'g2', 'unknown']},
+    'g1': {'name': 'g1', 'sublayers': ['a', 'shared']},
+    'g2': {'name': 'g2', 'sublayers': ['shared', 'b', 'unknown']},
+    'shared': {'name': 'shared', 'sublayers': ['c']},
+    'a': {'name': 'a', 'attributes': []},
+    'b': {'name': 'b', 'attributes': []},
+    'c': {'name': 'c', 'attributes': []},
+    # cycles
+    'x': {'name': 'x', 'sublayers': ['y', 'a']},
+    'y': {'name': 'y', 'sublayers': ['x']},
+    'z': {'name': 'z', 'sublayers': ['z']}
+}
+
+
+def test_resource_hierarchy_finds_cycles():
+    hierarchy = ResourceHierarchy(HIERARCHY)
+    assert sorted(hierarchy.cycles) == [('y', 'x'), ('z', 'z')]
+    assert ResourceHierarchy({
+        name: resource for name, resource in HIERARCHY.items()
+        if name not in ('x', 'y', 'z')
+    }).cycles == []
+
+
+def test_resource_hierarchy_descendants_and_ancestors():
+    hierarchy = ResourceHierarchy(HIERARCHY)
+    assert hierarchy.descendants('root') == [
+        'g1', 'a', 'shared', 'c', 'g2', 'b', 'unknown'
+    ]
+    assert hierarchy.descendants('g2') == ['shared', 'c', 'b', 'unknown']
+    assert hierarchy.descendants('a') == []
+    assert hierarchy.descendants('missing') == []
+    # cyclic sublayers are collected once
+    assert hierarchy.descendants('x') == ['y', 'a']
+    assert hierarchy.descendants('z') == []
+
+    # nearest first
+    assert hierarchy.ancestors('c') == ['shared', 'g1', 'g2', 'root']
+    assert hierarchy.ancestors('a') == ['g1', 'x', 'root', 'y']
+    assert hierarchy.ancestors('unknown') == ['root', 'g2']
+    assert hierarchy.ancestors('root') == []
+    assert hierarchy.ancestors('x') == ['y']
+    assert hierarchy.ancestors('z') == []
+
+
+def test_resource_hierarchy_collects_like_walk():
+    hierarchy = ResourceHierarchy(HIERARCHY)
+    for roots in [
+        ['root'], ['g2', 'root'], ['shared', 'g1', 'root', 'x'],
+        ['unknown', 'g2', 'unknown'], ['y', 'z', 'x', 'a'], []
+    ]:
+        assert hierarchy.collect(roots) == walk_sublayers(
+            roots, HIERARCHY, set()
+        )
+    assert hierarchy.collect(['g2', 'root']) == [
+        'g2', 'shared', 'c', 'b', 'unknown', 'root', 'g1', 'a', 'unknown'
+    ]
+
+
+def test_resource_hierarchy_without_recursion_limit():
+    depth = sys.getrecursionlimit() * 2
+    lookup = {
+        'g%d' % i: {'name': 'g%d' % i, 'sublayers': ['g%d' % (i + 1)]}
+        for i in range(depth)
+    }
+    hierarchy = ResourceHierarchy(lookup)
+    assert hierarchy.cycles == []
+    assert len(hierarchy.descendants('g0')) == depth
+    assert hierarchy.ancestors('g%d' % depth)[:2] == [
+        'g%d' % (depth - 1), 'g%d' % (depth - 2)
+    ]
+
+
+def test_reader_resource_descendants_and_ancestors(config_path):
+    write_permissions(config_path, 'default', {
+        'wms_name': 'wms',
+        'wfs_name': 'wfs',
+        'common_resources': [],
+        'dataproducts': list(HIERARCHY.values()),
+        'users': [],
+        'groups': [],
+        'roles': [{'role': 'public', 'permissions': {
+            'all_services': {'g2': {}}
+        }}]
+    })
+    reader = PermissionsReader('default', logger)
+    assert reader.resource_descendants('g2') == [
+        'shared', 'c', 'b', 'unknown'
+    ]
+    assert reader.resource_ancestors('c') == ['shared', 'g1', 'g2', 'root']
+    assert reader.resource_permissions('dataproducts', None) == [
+        'wms', 'g2', 'shared', 'c', 'b', 'unknown'
+    ]
+
+    # no hierarchy for full permissions
+    write_permissions(config_path, 'default', {
+        'users': [], 'groups': [], 'roles': []
+    })
+    reader = PermissionsReader('default', logger)
+    assert reader.resource_descendants('g2') is None
+    assert reader.resource_ancestors('c') is None
+
+
+def test_permissions_memo_is_bounded():
+    memo = PermissionsMemo(3)
+    computed = []
+
+    def get(key):
+        return memo.get(key, lambda: computed.append(key) or key.upper())
+
+    for key in 'abc':
+        assert get(key) == key.upper()
+    # least recently used entry is evicted
+    assert get('a') == 'A'
+    assert get('d') == 'D'
+    assert list(memo.entries) == ['c', 'a', 'd']
+    assert get('b') == 'B'
+    assert computed == ['a', 'b', 'c', 'd', 'b']
+
+    # only kept entries are transferred
+    transferred = memo.transfer(lambda key: key != 'd')
+    assert list(transferred.entries) == ['a', 'b']
+    assert transferred.max_size == 3
+    assert list(memo.entries) == ['a', 'd', 'b']
+
+    # disabled memo
+    memo = PermissionsMemo(0)
+    computed = []
+    assert get('a') == 'A' and get('a') == 'A'
+    assert computed == ['a', 'a']
+    assert len(memo.entries) == 0
+
+
+def test_identities_with_same_roles_share_memoized_results(config_path,
+                                                           monkeypatch):
+    monkeypatch.setenv('PERMISSIONS_MEMO_SIZE', '4')
+    write_permissions(config_path, 'default', {
+        'users': [
+            {'name': 'u1', 'groups': [], 'roles': ['r1']},
+            {'name': 'u2', 'groups': ['g'], 'roles': []}
+        ],
+        'groups': [{'name': 'g', 'roles': ['r1']}],
+        'roles': [
+            {'role': 'public', 'permissions': {'viewer_tasks': ['t0']}},
+            {'role': 'r1', 'permissions': {'viewer_tasks': ['t1', 't2']}}
+        ]
+    })
+    reader = PermissionsReader('default', logger)
+    memo = reader.permissions['memo']
+
+    permissions = reader.resource_permissions('viewer_tasks', 'u1')
+    assert permissions == ['t0', 't1', 't2']
+    assert reader.resource_permissions(
+        'viewer_tasks', {'username': 'u2', 'groups': ['g']}
+    ) == permissions
+    assert [key for key in memo.entries if key[0] == 'permissions'] == [
+        ('permissions', ('public', 'r1'), 'viewer_tasks', None)
+    ]
+
+    # memoized results are returned as copies
+    permissions.append('t3')
+    assert reader.resource_permissions('viewer_tasks', 'u1') == [
+        't0', 't1', 't2'
+    ]
+
+    # bounded by $PERMISSIONS_MEMO_SIZE
+    for i in range(10):
+        reader.resource_permissions('viewer_tasks', 'u1', 't%d' % i)
+    assert len(memo.entries) == 4
+
+
+def test_lazy_role_permissions_expand_roles_once():
+    expanded = []
+
+    def expand(raw_permissions):
+        expanded.append(raw_permissions)
+        time.sleep(0.01)
+        return {'expanded': raw_permissions}
+
+    roles = LazyRolePermissions(
+        {'r1': 1, 'r2': 2, 'r3': 3}, expand, {'r3': {'expanded': 3}}
+    )
+    assert len(roles) == 3
+    assert list(roles) == ['r1', 'r2', 'r3']
+    assert 'r1' in roles and 'r4' not in roles
+    assert roles.get('r4') is None
+    assert expanded == []
+
+    # concurrent first access expands a role only once
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(roles['r1']))
+        for i in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [{'expanded': 1}] * 8
+    assert all(result is results[0] for result in results)
+    assert expanded == [1]
+
+    # already expanded roles are reused
+    assert roles['r3'] == {'expanded': 3}
+    assert dict(roles.items()) == {
+        'r1': {'expanded': 1}, 'r2': {'expanded': 2}, 'r3': {'expanded': 3}
+    }
+    assert expanded == [1, 2]
+    with pytest.raises(KeyError):
+        roles['r4']
+
+
+def test_lazy_expansion_expands_used_roles_only(config_path):
+    write_permissions(config_path, 'default', unified_permissions([
+        {'role': 'public', 'permissions': {'all_services': {'x': {}}}},
+        {'role': 'a', 'permissions': {'all_services': {'bg': {}}}},
+        {'role': 'b', 'permissions': {'all_services': {'x': {}}}}
+    ], ['bg']))
+    eager = PermissionsReader('default', logger, lazy=False)
+    reader = PermissionsReader('default', logger, lazy=True)
+
+    roles = reader.permissions['roles']
+    assert isinstance(roles, LazyRolePermissions)
+    assert list(roles) == ['public', 'a', 'b']
+    assert roles.expanded == {}
+
+    identity = {'username': 'u'}
+    assert reader.resource_permissions(
+        'data_datasets', identity
+    ) == eager.resource_permissions('data_datasets', identity)
+    assert sorted(roles.expanded) == ['a', 'public']
+
+    # reload keeps expanded unchanged roles
+    permissions = unified_permissions([
+        {'role': 'public', 'permissions': {'all_services': {'x': {}}}},
+        {'role': 'a', 'permissions': {'all_services': {'bg': {}}}},
+        {'role': 'b', 'permissions': {'all_services': {'bg': {}}}}
+    ], ['bg'])
+    write_permissions(config_path, 'default', permissions)
+    assert reader.reload() == {'b'}
+    assert sorted(reader.permissions['roles'].expanded) == ['a', 'public']
+    assert reader.permissions['roles']['a'] is roles['a']
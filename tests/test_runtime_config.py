@@ -0,0 +1,285 @@
+import json
+import logging
+import os
+
+import pytest
+
+from qwc_services_core.runtime_config import RuntimeConfig
+
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def config_path(tmp_path, monkeypatch):
+    monkeypatch.setenv('CONFIG_PATH', str(tmp_path))
+    # private cache dir for config indexes
+    (tmp_path / 'tmp').mkdir()
+    monkeypatch.setenv('TMPDIR', str(tmp_path / 'tmp'))
+    monkeypatch.setattr('tempfile.tempdir', None)
+    (tmp_path / 'default').mkdir()
+    with open(tmp_path / 'default' / 'testConfig.json', 'w') as fh:
+        json.dump({
+            'config': {'list': [1, 2], 'dict': {'a': 1}, 'flag': False},
+            'resources': {}
+        }, fh)
+    yield tmp_path
+    RuntimeConfig.clear_config_cache()
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_uncached_settings_are_mutable(config_path, monkeypatch, lazy):
+    monkeypatch.setenv('DICT', '{"b": 2}')
+    config = RuntimeConfig('test', logger, cached=False, lazy=lazy)
+    config.read_config('default')
+
+    settings_list = config.get('list')
+    settings_list.append(3)
+    assert settings_list == [1, 2, 3]
+    settings_dict = config.get('dict')
+    settings_dict['c'] = 3
+    assert settings_dict == {'b': 2, 'c': 3}
+    assert config.get('flag') is False
+
+
+def test_cached_settings_are_read_only(config_path):
+    config = RuntimeConfig('test', logger, cached=True)
+    config.read_config('default')
+
+    assert config.get('list') == [1, 2]
+    with pytest.raises(TypeError):
+        config.get('list').append(3)
+    with pytest.raises(TypeError):
+        config.get('dict')['c'] = 3
+
+
+def write_config(config_path, text):
+    with open(config_path / 'default' / 'testConfig.json', 'w') as fh:
+        fh.write(text)
+
+
+def read_results(config_path, lazy):
+    config = RuntimeConfig('test', logger, cached=False, lazy=lazy)
+    config.read_config('default')
+    return {
+        'num': config.get('num', 'default'),
+        'name': config.get('name', 'default'),
+        'a': config.resource('a'),
+        'b': config.resource('b'),
+        'sections': sorted(config.config.keys())
+    }
+
+
+def test_lazy_config_matches_eager(config_path, monkeypatch):
+    monkeypatch.setenv('NUM', '42')
+    monkeypatch.setenv('NAME', 'env')
+    write_config(config_path, '''{
+        "config": {"num": $$NUM$$, "name": "$$NAME$$"},
+        "resources": {"a": [{"name": "$$NAME$$"}], "b": {"n": $$NUM$$}}
+    }''')
+
+    eager = read_results(config_path, lazy=False)
+    assert eager['num'] == 42
+    assert eager['a'] == [{'name': 'env'}]
+    assert read_results(config_path, lazy=True) == eager
+
+
+def test_lazy_invalid_settings_fall_back_like_eager(config_path, caplog):
+    # unset placeholder results in invalid JSON
+    write_config(config_path, '''{
+        "config": {"num": $$UNSET_NUM$$},
+        "resources": {"a": [1]}
+    }''')
+
+    eager = read_results(config_path, lazy=False)
+    assert eager == {
+        'num': 'default', 'name': 'default', 'a': None, 'b': None,
+        'sections': []
+    }
+    caplog.clear()
+    assert read_results(config_path, lazy=True) == eager
+    assert 'Could not load runtime config' in caplog.text
+
+
+def test_lazy_invalid_resource_is_logged_and_missing(config_path, caplog):
+    write_config(config_path, '''{
+        "config": {"name": "x"},
+        "resources": {"a": {"n": $$UNSET_NUM$$}, "b": {"n": 1}}
+    }''')
+
+    # whole config is invalid if not lazy
+    assert read_results(config_path, lazy=False)['a'] is None
+    caplog.clear()
+    results = read_results(config_path, lazy=True)
+    assert results['a'] is None
+    assert results['b'] == {'n': 1}
+    assert results['name'] == 'x'
+    assert "Could not load runtime config section 'a'" in caplog.text
+
+
+def test_lazy_config_index_is_written_to_cache_dir(config_path, caplog):
+    caplog.set_level(logging.INFO)
+    read_results(config_path, lazy=True)
+    index_path = RuntimeConfig.config_index_file_path('test', 'default')
+    assert index_path.startswith(str(config_path / 'tmp'))
+    assert os.path.exists(index_path)
+    assert os.listdir(config_path / 'default') == ['testConfig.json']
+    assert 'Wrote runtime config index' in caplog.text
+
+    # index is reused
+    caplog.clear()
+    assert read_results(config_path, lazy=True) == read_results(
+        config_path, lazy=False
+    )
+    assert 'Wrote runtime config index' not in caplog.text
+
+
+def resources_config(config_path):
+    write_config(config_path, json.dumps({
+        'config': {},
+        'resources': {
+            'wms_services': [
+                {'name': 's', 'root_layer': {'name': 'r', 'layers': [
+                    {'name': 'g', 'layers': [
+                        {'name': 'l1'},
+                        {'name': 'g2', 'layers': [{'name': 'l2'}]}
+                    ]},
+                    {'name': 'l3'},
+                    # duplicate name in another group
+                    {'name': 'g3', 'layers': [{'name': 'l1', 'dup': True}]}
+                ]}},
+                {'name': 't', 'root_layer': {'name': 'r', 'layers': []}}
+            ],
+            'qwc2_themes': {'themes': {
+                'items': [{'name': 'theme1'}, {'name': 'theme2'}]
+            }},
+            'print_templates': [{'name': 'A4'}, 'invalid', {'name': 1}]
+        }
+    }))
+    config = RuntimeConfig('test', logger, cached=False)
+    return config.read_config('default')
+
+
+def test_resource_item_in_lists(config_path):
+    config = resources_config(config_path)
+    assert config.resource_item('print_templates', 'A4') == {'name': 'A4'}
+    assert config.resource_item('print_templates', 'A3') is None
+    assert config.resource_item('wms_services', 's')['name'] == 's'
+    # nested group layers by explicit path
+    assert config.resource_item(
+        'wms_services', 's', 'root_layer', 'r', 'layers', 'g', 'layers', 'g2',
+        'layers', 'l2'
+    ) == {'name': 'l2'}
+    with pytest.raises(ValueError):
+        config.resource_item('wms_services', 's', 'root_layer')
+
+
+def test_resource_item_in_dict_fields(config_path):
+    config = resources_config(config_path)
+    # single item in dict field
+    root_layer = config.resource_item('wms_services', 's', 'root_layer', 'r')
+    assert root_layer['layers'][1] == {'name': 'l3'}
+    assert config.resource_item(
+        'wms_services', 't', 'root_layer', 'r'
+    ) == {'name': 'r', 'layers': []}
+    assert config.resource_item('wms_services', 's', 'root_layer', 'x') is None
+
+    # dict-valued resource
+    assert config.resource_index('qwc2_themes') == {}
+    assert config.resource_index(('qwc2_themes', 'themes', 'items')) == {
+        ('theme1',): {'name': 'theme1'}, ('theme2',): {'name': 'theme2'}
+    }
+    assert config.resource_item(
+        ('qwc2_themes', 'themes', 'items'), 'theme2'
+    ) == {'name': 'theme2'}
+    assert config.resource_index(('qwc2_themes', 'missing', 'items')) == {}
+
+
+def test_resource_index_of_sublayers(config_path):
+    config = resources_config(config_path)
+    index = config.resource_index(
+        'wms_services', ['root_layer'], sublayers='layers'
+    )
+    # all layers in document order, first duplicate wins
+    assert list(index) == [
+        ('s', 'r'), ('s', 'g'), ('s', 'l1'), ('s', 'g2'), ('s', 'l2'),
+        ('s', 'l3'), ('s', 'g3'), ('t', 'r')
+    ]
+    assert index[('s', 'l1')] == {'name': 'l1'}
+    assert config.resource_item(
+        'wms_services', 's', 'root_layer', 'l2', sublayers='layers'
+    ) == {'name': 'l2'}
+    # without sublayers only the root layer is indexed
+    assert config.resource_item(
+        'wms_services', 's', 'root_layer', 'l2'
+    ) is None
+
+
+def test_resource_index_is_rebuilt_on_reload(config_path):
+    config = resources_config(config_path)
+    index = config.resource_index('print_templates')
+    assert config.resource_index('print_templates') is index
+    config.read_config('default')
+    assert config.resource_index('print_templates') is not index
+    assert config.resource_index('print_templates') == index
+
+
+def test_config_cache_counters(config_path, monkeypatch):
+    monkeypatch.setenv('RUNTIME_CONFIG_CACHE', 'true')
+    stats = {'hits': 0, 'loads': 0, 'reloads': 0, 'entries': 0}
+    assert RuntimeConfig.config_cache_stats() == stats
+
+    config = RuntimeConfig('test', logger).read_config('default')
+    assert config.cached
+    stats.update(loads=1, entries=1)
+    assert RuntimeConfig.config_cache_stats() == stats
+
+    # parsed config is shared until the config file changes
+    other = RuntimeConfig('test', logger).read_config('default')
+    assert other.config is config.config
+    stats.update(hits=1)
+    assert RuntimeConfig.config_cache_stats() == stats
+
+    write_config(config_path, '{"config": {"list": [3]}}')
+    other.read_config('default')
+    assert other.get('list') == [3]
+    assert other.config is not config.config
+    stats.update(reloads=1)
+    assert RuntimeConfig.config_cache_stats() == stats
+
+    # configs of other tenants are cached separately
+    (config_path / 'other').mkdir()
+    with open(config_path / 'other' / 'testConfig.json', 'w') as fh:
+        fh.write('{"config": {}}')
+    RuntimeConfig('test', logger).read_config('other')
+    stats.update(loads=2, entries=2)
+    assert RuntimeConfig.config_cache_stats() == stats
+
+    RuntimeConfig.clear_config_cache()
+    assert RuntimeConfig.config_cache_stats() == {
+        'hits': 0, 'loads': 0, 'reloads': 0, 'entries': 0
+    }
+
+
+@pytest.mark.parametrize('value', [None, 'false', 'invalid'])
+def test_config_cache_is_disabled_by_default(config_path, monkeypatch,
+                                             value):
+    if value is None:
+        monkeypatch.delenv('RUNTIME_CONFIG_CACHE', raising=False)
+    else:
+        monkeypatch.setenv('RUNTIME_CONFIG_CACHE', value)
+
+    config = RuntimeConfig('test', logger).read_config('default')
+    other = RuntimeConfig('test', logger).read_config('default')
+    assert not config.cached
+    assert other.config is not config.config
+    config.get('list').append(3)
+    assert other.get('list') == [1, 2]
+    assert RuntimeConfig.config_cache_stats() == {
+        'hits': 0, 'loads': 0, 'reloads': 0, 'entries': 0
+    }
+
+    # explicitly cached
+    config = RuntimeConfig('test', logger, cached=True)
+    assert config.read_config('default').cached
+    assert RuntimeConfig.config_cache_stats()['loads'] == 1
@@ -0,0 +1,68 @@
+import logging
+
+from qwc_services_core.tenant_handler import TenantHandler
+
+
+logger = logging.getLogger(__name__)
+
+
+class Monitor:
+    """ConfigDB monitor with a manually increased generation."""
+
+    def __init__(self):
+        self.current = 1
+
+    def generation(self):
+        return self.current
+
+
+class Watcher:
+    """Config watcher with a manually increased generation."""
+
+    def __init__(self):
+        self.current = 1
+
+    def generation(self, service_name, tenant):
+        return self.current
+
+    def tenant_generation(self, tenant):
+        return self.current
+
+
+def test_config_db_change_while_building_handler():
+    monitor = Monitor()
+    handler = TenantHandler(
+        logger, config_db_monitor=monitor, config_watcher=Watcher()
+    )
+
+    assert handler.handler('svc', 'svc', 'default') is None
+    # ConfigDB changes while the handler reads its config
+    monitor.current = 2
+    handler.register_handler('svc', 'default', 'handler1')
+    assert handler.handler('svc', 'svc', 'default') is None
+
+    handler.register_handler('svc', 'default', 'handler2')
+    assert handler.handler('svc', 'svc', 'default') == 'handler2'
+
+
+def test_config_file_change_while_building_handler():
+    watcher = Watcher()
+    handler = TenantHandler(
+        logger, config_db_monitor=Monitor(), config_watcher=watcher
+    )
+
+    assert handler.handler('svc', 'svc', 'default') is None
+    watcher.current = 2
+    handler.register_handler('svc', 'default', 'handler1')
+    assert handler.handler('svc', 'svc', 'default') is None
+
+    handler.register_handler('svc', 'default', 'handler2')
+    assert handler.handler('svc', 'svc', 'default') == 'handler2'
+
+
+def test_register_without_lookup():
+    handler = TenantHandler(
+        logger, config_db_monitor=Monitor(), config_watcher=Watcher()
+    )
+    handler.register_handler('svc', 'default', 'handler1')
+    assert handler.handler('svc', 'svc', 'default') == 'handler1'